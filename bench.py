@@ -0,0 +1,738 @@
+# bench.py
+# Benchmark e stress test del livello dati. Non servono all'app in produzione.
+# Senza DATABASE_URL usano un DB SQLite temporaneo (mai cards.db); con Postgres toccano solo le carte che creano.
+# Uso: python bench.py <comando> [opzioni]   (python bench.py -h per l'elenco)
+
+import argparse, os, sys, tempfile, time, threading, random, secrets, subprocess, json, functools
+
+def _load_main():
+    if not os.environ.get("DATABASE_URL"):
+        os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="banca-bench-"), "bench.db")
+    import main
+    main.migrate(log=None)
+    return main
+
+def _make_cards(main, n: int, initial: int):
+    # initial in centesimi, come tutti gli importi nel DB
+    prefix = f"bench-{secrets.token_hex(3)}-"
+    tokens = [main.create_site(f"{prefix}{i}", "0000", initial) for i in range(n)]
+    assert all(tokens), "creazione carte fallita"
+    return prefix, tokens
+
+def _total(main, prefix: str):
+    # somma su tutti gli shard (uno solo senza SQLITE_SHARDS)
+    rows = [main.exec_sql("SELECT COUNT(*), SUM(balance), MIN(balance) FROM cards WHERE name LIKE ?", (prefix + "%",),
+                          fetch="one", shard=shard) for shard in range(main.SHARDS)]
+    mins = [r[2] for r in rows if r[2] is not None]
+    return sum(int(r[0]) for r in rows), sum(int(r[1] or 0) for r in rows), int(min(mins) if mins else 0)
+
+def cmd_transfers(args):
+    # stress test: trasferimenti casuali in parallelo, il totale dei saldi deve restare identico
+    main = _load_main()
+    prefix, tokens = _make_cards(main, args.cards, main.to_cents(args.initial))
+    names = {t: main.get_by_token(t)["name"] for t in tokens}
+    _, total_before, _ = _total(main, prefix)
+    outcome = {}
+    lock = threading.Lock()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        local = {}
+        for _ in range(args.ops):
+            src, dst = rnd.sample(tokens, 2)
+            amount = rnd.choice([1, 5, 10, 25, 50, 100]) * 100
+            res = main.transfer_funds(src, names[dst], amount, "stress")
+            local[res["status"]] = local.get(res["status"], 0) + 1
+        with lock:
+            for k, v in local.items():
+                outcome[k] = outcome.get(k, 0) + v
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - t0
+
+    count, total_after, min_balance = _total(main, prefix)
+    # la riga principale sta nello shard del mittente (le copie mirror non trovano il mittente nella join)
+    logged = sum(main.exec_sql("SELECT COUNT(*) FROM transactions t JOIN cards c ON c.id = t.from_id "
+                               "WHERE t.reason='stress' AND c.name LIKE ?", (prefix + "%",), fetch="one", shard=shard)[0]
+                 for shard in range(main.SHARDS))
+    ops = args.threads * args.ops
+    print(f"{ops} trasferimenti su {count} carte, {args.threads} thread: {elapsed:.2f}s ({ops / elapsed:.0f} op/s)")
+    print(f"esiti: {outcome}")
+    print(f"totale prima {main.fmt_cents(total_before)}, dopo {main.fmt_cents(total_after)}, "
+          f"saldo minimo {main.fmt_cents(min_balance)}, righe log {logged}")
+    ok = total_after == total_before and min_balance >= 0 and logged == outcome.get("ok", 0)
+    print("OK: totale conservato" if ok else "ERRORE: invarianti violate")
+    return 0 if ok else 1
+
+def _fill_transactions(main, card_ids, start: int, stop: int, batch: int = 50000):
+    # righe sintetiche con ts crescente tra carte casuali (inserite a blocchi per non esaurire la memoria)
+    rnd = random.Random(start)
+    base_ts = 1_600_000_000
+    for lo in range(start, stop, batch):
+        rows = []
+        for i in range(lo, min(stop, lo + batch)):
+            a, b = rnd.sample(card_ids, 2)
+            rows.append((base_ts + i, a, b, 100, "bench"))
+        with main.db_conn() as conn:
+            conn.cursor().executemany(main.adapt_sql(
+                "INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)"), rows)
+
+def _time_per_call(fn, tokens, runs: int) -> float:
+    rnd = random.Random(1)
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        fn(rnd.choice(tokens))
+    return (time.perf_counter() - t0) / runs * 1000
+
+def cmd_history(args):
+    # get_recent_transactions con tabella crescente: con gli indici (from_id, ts, id)/(to_id, ts, id) il tempo resta piatto
+    main = _load_main()
+    _, tokens = _make_cards(main, args.cards, 0)
+    tokens = [main.get_by_token(t)["id"] for t in tokens]
+
+    def or_query(card_id):
+        # la vecchia query (OR + ORDER BY ts) per confronto
+        main.exec_sql("SELECT ts, from_id, to_id, amount, reason FROM transactions "
+                      "WHERE from_id = ? OR to_id = ? ORDER BY ts DESC LIMIT 10", (card_id, card_id), fetch="all")
+
+    print(f"{'righe':>12} {'UNION ms':>10} {'OR ms':>10}")
+    filled = 0
+    for size in sorted(int(x) for x in args.sizes.split(",")):
+        _fill_transactions(main, tokens, filled, size)
+        filled = size
+        union_ms = _time_per_call(lambda t: main.get_recent_transactions(t, 10), tokens, args.runs)
+        or_ms = _time_per_call(or_query, tokens, args.runs) if not args.skip_or else float("nan")
+        print(f"{size:>12} {union_ms:>10.3f} {or_ms:>10.3f}")
+    return 0
+
+def cmd_history_pages(args):
+    # pagina dello storico di una carta a profondità crescente: cursore (ts, id) contro OFFSET
+    main = _load_main()
+    _, tokens = _make_cards(main, args.cards, 0)
+    tokens = [main.get_by_token(t)["id"] for t in tokens]
+    _fill_transactions(main, tokens, 0, args.rows)
+    size = 20
+
+    def offset_page(card_id, offset):
+        return main.exec_sql("SELECT id, ts FROM transactions WHERE from_id = ? OR to_id = ? "
+                             f"ORDER BY ts DESC, id DESC LIMIT {size} OFFSET {offset}", (card_id, card_id), fetch="all")
+
+    print(f"{args.rows} righe, {args.cards} carte (~{2 * args.rows // args.cards} righe per carta)")
+    print(f"{'pagina':>8} {'cursore ms':>11} {'OFFSET ms':>10}")
+    depth = 1
+    while depth * size < 2 * args.rows // args.cards:
+        cursors = []
+        for token in tokens[:args.runs]:
+            r = offset_page(token, (depth - 1) * size - 1)[0] if depth > 1 else None
+            cursors.append((token, f"{r[1]}-{r[0]}" if r else ""))
+        t0 = time.perf_counter()
+        for token, cursor in cursors:
+            main.get_transactions_page(token, size, cursor)
+        keyset_ms = (time.perf_counter() - t0) / len(cursors) * 1000
+        t0 = time.perf_counter()
+        for token, _ in cursors:
+            offset_page(token, (depth - 1) * size)
+        offset_ms = (time.perf_counter() - t0) / len(cursors) * 1000
+        print(f"{depth:>8} {keyset_ms:>11.3f} {offset_ms:>10.3f}")
+        depth *= 10
+    return 0
+
+async def _card_client(main, token: str, pin: str = "0000"):
+    # client HTTP (ASGI in-process) con sessione NFC aperta e dispositivo associato alla carta, come dopo tap + PIN
+    import httpx
+    # eccezioni dell'app come risposte 500 (contate come errori), non propagate al benchmark
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app, raise_app_exceptions=False),
+                               base_url="http://bench")
+    await client.get(f"/launch/{token}")
+    await client.post("/unlock", data={"token": token, "pin": pin})
+    return client
+
+def _http_load(main, tokens, names, clients: int, seconds: float):
+    # metà dei client legge /bank, metà scrive con /transfer; ritorna richieste al secondo e p99 (ms) per tipo.
+    # Tap + PIN di tutti i client (32 alla volta) prima di far partire il cronometro: la sessione vale SCAN_WINDOW s.
+    import asyncio
+    counts = {"bank": 0, "transfer": 0, "errors": 0}
+    latencies = {"bank": [], "transfer": []}
+
+    async def worker(i, client, deadline):
+        token = tokens[i % len(tokens)]
+        rnd = random.Random(i)
+        kind = "bank" if i % 2 == 0 else "transfer"
+        others = [names[t] for t in tokens if t != token]
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            if kind == "bank":
+                r = await client.get("/bank")
+            else:
+                r = await client.post("/transfer", data={"from_token": token, "to_name": rnd.choice(others),
+                                                         "amount": "0.01", "reason": "bench"})
+            latencies[kind].append(time.perf_counter() - t0)
+            counts[kind if r.status_code == 200 else "errors"] += 1
+
+    async def run():
+        setup = asyncio.Semaphore(32)
+
+        async def connect(token):
+            async with setup:
+                return await _card_client(main, token)
+
+        conns = await asyncio.gather(*(connect(tokens[i % len(tokens)]) for i in range(clients)))
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*(worker(i, client, deadline) for i, client in enumerate(conns)))
+        for client in conns:
+            await client.aclose()
+        await main.APOOL.close()  # senza lifespan: i thread di aiosqlite terrebbero vivo il processo
+
+    asyncio.run(run())
+    result = {k: v / seconds if k != "errors" else v for k, v in counts.items()}
+    for kind, values in latencies.items():
+        values.sort()
+        result[f"{kind}_p99_ms"] = values[int(len(values) * 0.99)] * 1000 if values else 0.0
+    return result
+
+def cmd_sqlite_profile(args):
+    # throughput di /bank e /transfer con profilo SQLite attivo e disattivo (un processo figlio per modalità)
+    if args.mode:
+        main = _load_main()
+        prefix, tokens = _make_cards(main, args.cards, 100_000_000)
+        names = {t: main.get_by_token(t)["name"] for t in tokens}
+        print(json.dumps(_http_load(main, tokens, names, args.clients, args.seconds)))
+        return 0
+    print(f"{'profilo':>8} {'/bank req/s':>12} {'/transfer req/s':>16} {'errori':>7}")
+    for mode in ("on", "off"):
+        env = dict(os.environ, SQLITE_PROFILE="1" if mode == "on" else "0")
+        env.pop("DATABASE_URL", None)
+        out = subprocess.run([sys.executable, __file__, "sqlite-profile", "--mode", mode, "--clients", str(args.clients),
+                              "--seconds", str(args.seconds), "--cards", str(args.cards)],
+                             env=env, capture_output=True, text=True, check=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(f"{mode:>8} {r['bank']:>12.0f} {r['transfer']:>16.0f} {r['errors']:>7}")
+    return 0
+
+def cmd_render(args):
+    # render_page con impostazioni e pagina base in cache, contro la ricostruzione completa a ogni pagina
+    # (rilettura settings dal DB + f-string dell'intera pagina, come prima della cache)
+    main = _load_main()
+    inner = "<h3>Sessione scaduta</h3>" * 3
+
+    def run(cold: bool) -> float:
+        t0 = time.perf_counter()
+        for _ in range(args.n):
+            if cold:
+                main.settings_changed()
+            main.render_page(inner, "Errore")
+        return args.n / (time.perf_counter() - t0)
+
+    run(False)
+    cold, warm = run(True), run(False)
+    print(f"ricostruzione completa: {cold:>10.0f} pagine/s")
+    print(f"shell pre-renderizzata: {warm:>10.0f} pagine/s  (x{warm / cold:.1f})")
+    return 0
+
+# abbonamento sintetico: (item_code, item_name, weekly_deduction, next_charge_at, started_at, token della carta)
+SUBSCRIBE_SQL = ("INSERT INTO purchases (card_id,item_code,item_name,weekly_deduction,next_charge_at,started_at,active) "
+                 "SELECT id, ?, ?, ?, ?, ?, 1 FROM cards WHERE token = ?")
+
+def cmd_billing(args):
+    # passata di fatturazione su N abbonamenti attivi con scadenze arretrate casuali (fino a --weeks settimane)
+    main = _load_main()
+    rnd = random.Random(7)
+    now = int(time.time())
+    prefix = f"bill-{secrets.token_hex(3)}-"
+    cards = [(f"{prefix}{i}", secrets.token_urlsafe(16), main.hash_pin("0000"), 100_000_000) for i in range(args.cards)]
+    subs, expected = [], {"due": 0, "charges": 0, "amount": 0}
+    for i in range(args.subs):
+        token = cards[i % args.cards][1]
+        next_ts = now - rnd.randint(-WEEK_AHEAD, args.weeks * main.WEEK_SECONDS)
+        subs.append(("moccolone", "Moccolone pencs", 300, next_ts, next_ts - main.WEEK_SECONDS, token))
+        if next_ts <= now:
+            charges = (now - next_ts) // main.WEEK_SECONDS + 1
+            expected["due"] += 1; expected["charges"] += charges; expected["amount"] += 300 * charges
+    with main.db_conn() as conn:
+        c = conn.cursor()
+        c.executemany(main.adapt_sql("INSERT INTO cards (name, token, pin_hash, balance) VALUES (?, ?, ?, ?)"), cards)
+        c.executemany(main.adapt_sql(SUBSCRIBE_SQL), subs)
+    _, before, _ = _total(main, prefix)
+
+    t0 = time.perf_counter()
+    r = main.bill_due_subscriptions(now)
+    elapsed = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    idle = main.bill_due_subscriptions(now)
+    idle_ms = (time.perf_counter() - t0) * 1000
+    _, after, _ = _total(main, prefix)
+
+    print(f"{args.subs} abbonamenti su {args.cards} carte, {expected['due']} scaduti")
+    print(f"passata: {elapsed:.2f}s ({r['subscriptions'] / elapsed:.0f} abbonamenti/s), {r}")
+    print(f"seconda passata (niente da addebitare): {idle_ms:.1f} ms, {idle}")
+    ok = (r["subscriptions"] == expected["due"] and r["charges"] == expected["charges"]
+          and before - after == expected["amount"] and idle["subscriptions"] == 0)
+    print("OK: addebiti come da calcolo" if ok else f"ERRORE: atteso {expected}, saldi -{before - after}")
+    return 0 if ok else 1
+
+def cmd_simulate(args):
+    # proiezione vettoriale dei saldi: array sintetici (default 1M carte x 52 settimane) o, con --db, lettura dal DB
+    main = _load_main()
+    import numpy as np
+    rng = np.random.default_rng(5)
+    now = int(time.time())
+    if args.db:
+        prefix = f"sim-{secrets.token_hex(3)}-"
+        cards = [(f"{prefix}{i}", secrets.token_urlsafe(16), "x", int(b))
+                 for i, b in enumerate(rng.integers(0, 30_000, args.cards))]
+        subs = [("moccolone", "Moccolone pencs", 300, now + int(d), now, cards[int(i)][1])
+                for i, d in zip(rng.integers(0, args.cards, args.subs), rng.integers(-2, 8, args.subs) * main.WEEK_SECONDS // 2)]
+        with main.db_conn() as conn:
+            c = conn.cursor()
+            c.executemany(main.adapt_sql("INSERT INTO cards (name, token, pin_hash, balance) VALUES (?, ?, ?, ?)"), cards)
+            c.executemany(main.adapt_sql(SUBSCRIBE_SQL), subs)
+        r = main.simulate_balances(args.weeks, {"moccolone": 400})
+        print(f"{r['cards']} carte, {r['subscriptions']} abbonamenti, {args.weeks} settimane: "
+              f"lettura {r['load_seconds']}s, proiezione {r['project_seconds']}s")
+        print(f"sotto zero: {r['cross_zero']['count']}, sotto soglia: {r['cross_threshold']['count']}")
+        return 0
+    balance = rng.integers(0, 30_000, args.cards)
+    card_idx = rng.integers(0, args.cards, args.subs)
+    weekly = rng.choice([100, 300, 500, 1000], args.subs)
+    next_ts = now + rng.integers(-3 * main.WEEK_SECONDS, 10 * main.WEEK_SECONDS, args.subs)
+    t0 = time.perf_counter()
+    final, cross_zero, cross_threshold, negative = main.project_balances(balance, card_idx, weekly, next_ts, now, args.weeks)
+    elapsed = time.perf_counter() - t0
+    print(f"{args.cards} carte, {args.subs} abbonamenti, {args.weeks} settimane: {elapsed:.2f}s")
+    print(f"sotto zero: {int((cross_zero > 0).sum())}, sotto soglia: {int((cross_threshold > 0).sum())}, "
+          f"negative a fine periodo: {negative[-1]}")
+    return 0
+
+def cmd_leaderboard(args):
+    # classifica in memoria con molte carte: caricamento, aggiornamento dopo un commit, pagina (top + vicini)
+    main = _load_main()
+    rnd = random.Random(9)
+    prefix = f"lb-{secrets.token_hex(3)}-"
+    cards = [(f"{prefix}{i}", secrets.token_urlsafe(16), "x", rnd.randint(0, 1_000_000)) for i in range(args.cards)]
+    for i in range(0, len(cards), 100_000):
+        with main.db_conn() as conn:
+            conn.cursor().executemany(main.adapt_sql("INSERT INTO cards (name, token, pin_hash, balance) VALUES (?, ?, ?, ?)"),
+                                      cards[i:i + 100_000])
+    tokens = [c[1] for c in cards]
+    t0 = time.perf_counter()
+    main.LEADERBOARD.load()
+    print(f"{len(main.LEADERBOARD._ranks)} carte, caricamento: {time.perf_counter() - t0:.2f}s")
+    update_ms = _time_per_call(lambda t: main.adjust_balance(t, rnd.randint(-5000, 5000)), tokens, args.runs)
+    view_ms = _time_per_call(lambda t: main.LEADERBOARD.view(t, main.LEADERBOARD_TOP, main.LEADERBOARD_NEIGHBOURS),
+                             tokens, args.runs)
+    sql_ms = _time_per_call(lambda t: main.exec_sql("SELECT name,balance,token FROM cards ORDER BY balance DESC, id ASC",
+                                                    fetch="all"), tokens, max(1, args.runs // 100))
+    print(f"adjust_balance + aggiornamento classifica: {update_ms:.3f} ms")
+    print(f"pagina (top {main.LEADERBOARD_TOP} + posizione e vicini): {view_ms:.3f} ms")
+    print(f"vecchia query ORDER BY su tutte le carte: {sql_ms:.1f} ms")
+    rows = main.exec_sql("SELECT id FROM cards ORDER BY balance DESC, id ASC LIMIT 1000", fetch="all")
+    ok = [r[0] for r in rows] == [cid for _, cid in main.LEADERBOARD._ranks.slice(0, 1000)]
+    print("OK: classifica allineata al DB" if ok else "ERRORE: classifica diversa dal DB")
+    return 0 if ok else 1
+
+def cmd_fragments(args):
+    # /lista e /admin con N carte: corpo tabella ricostruito a ogni richiesta contro frammento in cache
+    main = _load_main()
+    from starlette.requests import Request
+    _make_cards(main, args.cards, 1000)
+
+    def request(path):
+        return Request({"type": "http", "method": "GET", "path": path, "headers": [], "query_string": b"",
+                        "scheme": "http", "server": ("bench", 80), "root_path": ""})
+
+    print(f"{'pagina':>8} {'senza cache ms':>15} {'con cache ms':>13}")
+    for name, call in (("lista", lambda: main.lista(request("/lista"), main.ADMIN_KEY)),
+                       ("admin", lambda: main.admin_panel(request("/admin"), main.ADMIN_KEY))):
+        timings = []
+        for cold in (True, False):
+            call()
+            t0 = time.perf_counter()
+            for _ in range(args.n):
+                if cold:
+                    main.FRAGMENT_CACHE.clear()
+                call()
+            timings.append((time.perf_counter() - t0) / args.n * 1000)
+        print(f"{name:>8} {timings[0]:>15.2f} {timings[1]:>13.2f}")
+    return 0
+
+def cmd_card_ids(args):
+    # migrazione 9 (token -> id intero della carta): dimensione file, tabelle e indici e storico carta, prima e dopo.
+    # Solo SQLite: il DB parte dalla versione 8 con le righe nel vecchio formato (token e nomi in ogni riga).
+    if os.environ.get("DATABASE_URL"):
+        print("solo SQLite")
+        return 1
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="banca-bench-"), "bench.db")
+    import main, sqlite3
+    main.migrate(log=None, target=8)
+    rnd = random.Random(11)
+    cards = [(f"c{i}", secrets.token_urlsafe(16)) for i in range(args.cards)]
+    with main.db_conn() as conn:
+        c = conn.cursor()
+        c.executemany("INSERT INTO cards (name, token, pin_hash, balance) VALUES (?, ?, 'x', 0)", cards)
+        for lo in range(0, args.rows, 50000):
+            rows = []
+            for i in range(lo, min(args.rows, lo + 50000)):
+                (an, at), (bn, bt) = rnd.sample(cards, 2)
+                rows.append((1_600_000_000 + i, at, an, bt, bn, 100, "bench"))
+            c.executemany("INSERT INTO transactions (ts,from_token,from_name,to_token,to_name,amount,reason) "
+                          "VALUES (?,?,?,?,?,?,?)", rows)
+        c.executemany("INSERT INTO sessions (sid, token, expires, created_at) VALUES (?, ?, ?, 0)",
+                      [(secrets.token_urlsafe(24), t, 2_000_000_000) for _, t in cards])
+        c.executemany("INSERT INTO purchases (token,item_code,item_name,weekly_deduction,next_charge_at,started_at,active) "
+                      "VALUES (?, 'moccolone', 'Moccolone pencs', 300, 0, 0, 1)", [(t,) for _, t in cards])
+
+    def sizes():
+        conn = sqlite3.connect(main.DB_FILE)
+        conn.execute("VACUUM")
+        pages = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall())
+        conn.close()
+        return os.path.getsize(main.DB_FILE), pages
+
+    def old_history(token):
+        main.exec_sql("""SELECT id, ts, from_name, to_name, amount, reason FROM (
+                             SELECT id, ts, from_name, to_name, amount, reason FROM transactions
+                             WHERE from_token = ? ORDER BY ts DESC, id DESC LIMIT 10) s
+                         UNION
+                         SELECT id, ts, from_name, to_name, amount, reason FROM (
+                             SELECT id, ts, from_name, to_name, amount, reason FROM transactions
+                             WHERE to_token = ? ORDER BY ts DESC, id DESC LIMIT 10) r
+                         ORDER BY ts DESC, id DESC LIMIT 10""", (token, token), fetch="all")
+
+    def scan(key, values):
+        # storico completo (ts, id) di alcune carte lungo i due indici: quanto pesa ogni voce dell'indice
+        t0 = time.perf_counter()
+        for v in values[:args.runs // 10]:
+            for col in ("from", "to"):
+                main.exec_sql(f"SELECT COUNT(*), MAX(ts) FROM transactions WHERE {col}_{key} = ?", (v,), fetch="one")
+        return (time.perf_counter() - t0) / len(values[:args.runs // 10]) * 1000
+
+    size_old, pages_old = sizes()
+    tokens = [t for _, t in cards]
+    old_ms = _time_per_call(old_history, tokens, args.runs)
+    old_scan = scan("token", tokens)
+    main.migrate(log=None)
+    size_new, pages_new = sizes()
+    ids = [r[0] for r in main.exec_sql("SELECT id FROM cards", fetch="all")]
+    new_ms = _time_per_call(lambda i: main.get_recent_transactions(i, 10), ids, args.runs)
+    new_scan = scan("id", ids)
+
+    print(f"{args.rows} transazioni, {args.cards} carte")
+    print(f"{'':<34} {'token (v8)':>12} {'id (v9)':>12}")
+    print(f"{'file DB (KB)':<34} {size_old // 1024:>12} {size_new // 1024:>12}")
+    for old, new in (("transactions", "transactions"), ("idx_transactions_from_ts_id", "idx_transactions_from_id_ts"),
+                     ("idx_transactions_to_ts_id", "idx_transactions_to_id_ts"), ("sessions", "sessions"),
+                     ("purchases", "purchases"), ("idx_purchases_owner", "idx_purchases_card_owner")):
+        print(f"{new + ' (KB)':<34} {pages_old.get(old, 0) // 1024:>12} {pages_new.get(new, 0) // 1024:>12}")
+    print(f"{'storico carta (ms)':<34} {old_ms:>12.3f} {new_ms:>12.3f}")
+    print(f"{'storico completo di una carta (ms)':<34} {old_scan:>12.3f} {new_scan:>12.3f}")
+    return 0
+
+def cmd_async(args):
+    # route del percorso carta con driver async (DB_ASYNC=1) contro gli helper sincroni nel threadpool
+    # (DB_ASYNC=0), con molti client concorrenti: un processo figlio per modalità, stesso DB di partenza
+    if args.mode:
+        main = _load_main()
+        if main.USE_ASYNC_DB != (args.mode == "async"):
+            print("driver async non disponibile (asyncpg / aiosqlite)", file=sys.stderr)
+            return 1
+        main.start_writer()  # con SQLITE_WRITER=1 anche le route scrivono in gruppi
+        prefix, tokens = _make_cards(main, max(args.cards, args.clients), 100_000_000)
+        names = {t: main.get_by_token(t)["name"] for t in tokens}
+        result = _http_load(main, tokens, names, args.clients, args.seconds)
+        main.stop_writer()
+        print(json.dumps(result))
+        return 0
+    print(f"{args.clients} client concorrenti, {args.seconds:g}s per modalità")
+    print(f"{'modalità':>8} {'req/s':>8} {'/bank req/s':>12} {'/transfer req/s':>16} {'p99 /bank ms':>13} "
+          f"{'p99 /transfer ms':>17} {'errori':>7}")
+    for mode in ("sync", "async"):
+        env = dict(os.environ, DB_ASYNC="1" if mode == "async" else "0", BILLING_INTERVAL="0")
+        out = subprocess.run([sys.executable, __file__, "async", "--mode", mode, "--clients", str(args.clients),
+                              "--seconds", str(args.seconds), "--cards", str(args.cards)],
+                             env=env, capture_output=True, text=True, check=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(f"{mode:>8} {r['bank'] + r['transfer']:>8.0f} {r['bank']:>12.0f} {r['transfer']:>16.0f} "
+              f"{r['bank_p99_ms']:>13.1f} {r['transfer_p99_ms']:>17.1f} {r['errors']:>7}")
+    return 0
+
+def cmd_writer(args):
+    # scritture concorrenti da molti thread (trasferimenti, rettifiche, sessioni, movimenti) con e senza il writer
+    # SQLite, con synchronous NORMAL e FULL (un fsync per commit): un processo figlio per combinazione
+    if args.mode:
+        main = _load_main()
+        main.start_writer()  # solo con SQLITE_WRITER=1 (modalità on)
+        prefix, tokens = _make_cards(main, args.cards, 100_000_000)
+        names = {t: main.get_by_token(t)["name"] for t in tokens}
+        ids = {t: main.get_by_token(t)["id"] for t in tokens}
+        latencies, errors = [], {}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + args.seconds
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            local, failed = [], {}
+            while time.perf_counter() < deadline:
+                src, dst = rnd.sample(tokens, 2)
+                op = rnd.randrange(4)
+                t0 = time.perf_counter()
+                try:
+                    if op == 0:
+                        main.transfer_funds(src, names[dst], 1, "bench")
+                    elif op == 1:
+                        main.adjust_balance(src, rnd.choice((-1, 1)))
+                    elif op == 2:
+                        main.create_session_for_token(src)
+                    else:
+                        main.log_transaction(ids[src], None, 0, "bench")
+                except Exception as e:
+                    failed[type(e).__name__] = failed.get(type(e).__name__, 0) + 1
+                    continue
+                local.append(time.perf_counter() - t0)
+            with lock:
+                latencies.extend(local)
+                for k, v in failed.items():
+                    errors[k] = errors.get(k, 0) + v
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        stats = main.WRITER.stats() if main.WRITER else {}
+        main.stop_writer()
+        latencies.sort()
+        print(json.dumps({"ops": len(latencies) / args.seconds, "errors": sum(errors.values()), "error_types": errors,
+                          "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+                          "avg_group": stats.get("avg_group", 1)}))
+        return 0
+    print(f"{args.threads} thread, {args.seconds:g}s per combinazione")
+    print(f"{'synchronous':>11} {'writer':>7} {'scritture/s':>12} {'p99 ms':>8} {'gruppo medio':>13} {'errori':>7}")
+    for sync_mode in args.synchronous.split(","):
+        for mode in ("off", "on"):
+            env = dict(os.environ, SQLITE_SYNCHRONOUS=sync_mode, SQLITE_WRITER="1" if mode == "on" else "0",
+                       BILLING_INTERVAL="0")
+            env.pop("DATABASE_URL", None)
+            out = subprocess.run([sys.executable, __file__, "writer", "--mode", mode, "--threads", str(args.threads),
+                                  "--seconds", str(args.seconds), "--cards", str(args.cards)],
+                                 env=env, capture_output=True, text=True, check=True).stdout
+            r = json.loads(out.strip().splitlines()[-1])
+            print(f"{sync_mode:>11} {mode:>7} {r['ops']:>12.0f} {r['p99_ms']:>8.1f} {r['avg_group']:>13} "
+                  f"{r['errors']:>7}" + (f"  {r['error_types']}" if r["errors"] else ""))
+    return 0
+
+def _slow_commits(delay: float):
+    # disco lento simulato: ogni COMMIT aspetta `delay` s tenendo il lock di scrittura del file, come un fsync su
+    # disco di rete o meccanico (qui l'fsync costa ~0.1 ms e il collo di bottiglia sarebbe solo la CPU)
+    import sqlite3
+
+    class SlowCommit(sqlite3.Connection):
+        def commit(self):
+            if self.in_transaction:
+                time.sleep(delay)
+            super().commit()
+
+    sqlite3.connect = functools.partial(sqlite3.connect, factory=SlowCommit)
+
+def _shards_worker(args):
+    # un processo scrittore (come un worker uvicorn): thread con trasferimenti, rettifiche e sessioni per
+    # args.seconds dall'istante di partenza letto da stdin (dopo "ready": tutti i processi hanno finito gli import)
+    os.environ["DB_PATH"] = args.db
+    if args.commit_delay_ms:
+        _slow_commits(args.commit_delay_ms / 1000)
+    import main
+    with open(args.db + ".tokens") as f:
+        tokens = json.load(f)
+    names = {t: main.get_by_token(t)["name"] for t in tokens}
+    latencies, errors, adjusted = [], {}, [0]
+    lock = threading.Lock()
+    print("ready", flush=True)
+    start = float(sys.stdin.readline())
+    time.sleep(max(0.0, start - time.time()))
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        local, failed, delta = [], {}, 0
+        while time.time() < start + args.seconds:
+            src, dst = rnd.sample(tokens, 2)
+            op = rnd.randrange(3)
+            t0 = time.perf_counter()
+            try:
+                if op == 0:
+                    main.transfer_funds(src, names[dst], 1, "bench")
+                elif op == 1:
+                    d = rnd.choice((-1, 1))
+                    main.adjust_balance(src, d)
+                    delta += d
+                else:
+                    main.create_session_for_token(src)
+            except Exception as e:
+                failed[type(e).__name__] = failed.get(type(e).__name__, 0) + 1
+                continue
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+            adjusted[0] += delta
+            for k, v in failed.items():
+                errors[k] = errors.get(k, 0) + v
+
+    threads = [threading.Thread(target=worker, args=(args.seed * 1000 + i,)) for i in range(args.threads)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    print(json.dumps({"latencies": latencies, "errors": errors, "adjusted": adjusted[0]}))
+    return 0
+
+def cmd_shards(args):
+    # scritture concorrenti da più processi (trasferimenti, rettifiche, sessioni) con il DB SQLite diviso in
+    # 1, 2, 4, 8 file. Alla fine, chiusi i trasferimenti tra shard rimasti aperti: totale dei saldi = iniziale + rettifiche
+    if args.mode == "worker":
+        return _shards_worker(args)
+    if os.environ.get("DATABASE_URL"):
+        print("Lo sharding c'è solo su SQLite: togliere DATABASE_URL")
+        return 1
+    setup = """
+import json, sys, main
+main.migrate(log=None)
+tokens = [main.create_site(f"bench-{i}", "0000", 100_000_000) for i in range(int(sys.argv[1]))]
+json.dump(tokens, open(main.DB_FILE + ".tokens", "w"))
+"""
+    check = """
+import json, main
+in_flight = main.transfers_in_flight()
+main.recover_transfers(min_age=0)
+total = sum(main.exec_sql("SELECT SUM(balance) FROM cards", fetch="one", shard=s)[0] for s in range(main.SHARDS))
+print(json.dumps({"in_flight": in_flight["count"], "total": total}))
+"""
+    print(f"{args.procs} processi x {args.threads} thread, {args.seconds:g}s per combinazione"
+          + (f", commit rallentati di {args.commit_delay_ms:g} ms" if args.commit_delay_ms else ""))
+    print(f"{'synchronous':>11} {'shard':>6} {'scritture/s':>12} {'p99 ms':>8} {'in transito':>12} {'totale':>7} {'errori':>7}")
+    for sync_mode in args.synchronous.split(","):
+        for n in args.shards.split(","):
+            db = os.path.join(tempfile.mkdtemp(prefix="banca-bench-"), "bench.db")
+            env = dict(os.environ, DB_PATH=db, SQLITE_SYNCHRONOUS=sync_mode, SQLITE_SHARDS=n, SQLITE_WRITER="0",
+                       BILLING_INTERVAL="0", PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            subprocess.run([sys.executable, "-c", setup, str(args.cards)], env=env, check=True)
+            procs = [subprocess.Popen([sys.executable, __file__, "shards", "--mode", "worker", "--db", db,
+                                       "--threads", str(args.threads), "--seconds", str(args.seconds), "--seed", str(i),
+                                       "--commit-delay-ms", str(args.commit_delay_ms)],
+                                      env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                     for i in range(args.procs)]
+            for p in procs:
+                assert p.stdout.readline().strip() == "ready"
+            start = time.time() + 0.5  # tutti i processi partono insieme
+            for p in procs:
+                p.stdin.write(f"{start}\n"); p.stdin.flush()
+            results = [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+            r = json.loads(subprocess.run([sys.executable, "-c", check], env=env, capture_output=True, text=True,
+                                          check=True).stdout.strip().splitlines()[-1])
+            latencies = sorted(x for res in results for x in res["latencies"])
+            errors = {}
+            for res in results:
+                for k, v in res["errors"].items():
+                    errors[k] = errors.get(k, 0) + v
+            conserved = r["total"] == args.cards * 100_000_000 + sum(res["adjusted"] for res in results)
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0
+            print(f"{sync_mode:>11} {n:>6} {len(latencies) / args.seconds:>12.0f} {p99:>8.1f} {r['in_flight']:>12} "
+                  f"{'ok' if conserved else 'ERRORE':>7} {sum(errors.values()):>7}" + (f"  {errors}" if errors else ""))
+    return 0
+
+WEEK_AHEAD = 7 * 24 * 3600  # una parte degli abbonamenti scade nella prossima settimana (non ancora dovuti)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark banca")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("transfers", help="stress test concorrente di transfer_funds (conservazione del totale)")
+    p.add_argument("--cards", type=int, default=20)
+    p.add_argument("--initial", type=float, default=100.0)
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--ops", type=int, default=500, help="trasferimenti per thread")
+    p.set_defaults(func=cmd_transfers)
+
+    p = sub.add_parser("history", help="latenza dello storico carta al crescere di transactions (1k -> 10M)")
+    p.add_argument("--sizes", default="1000,10000,100000,1000000", help="es. 1000,100000,1000000,10000000")
+    p.add_argument("--cards", type=int, default=1000)
+    p.add_argument("--runs", type=int, default=200)
+    p.add_argument("--skip-or", action="store_true", help="non misurare la vecchia query OR (lenta su tabelle grandi)")
+    p.set_defaults(func=cmd_history)
+
+    p = sub.add_parser("history-pages", help="storico a pagine: cursore (ts, id) contro OFFSET (es. --rows 10000000)")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--cards", type=int, default=100)
+    p.add_argument("--runs", type=int, default=20, help="carte misurate per profondità")
+    p.set_defaults(func=cmd_history_pages)
+
+    p = sub.add_parser("sqlite-profile", help="/bank e /transfer con profilo SQLite (WAL, busy timeout, ...) on/off")
+    p.add_argument("--clients", type=int, default=32)
+    p.add_argument("--seconds", type=float, default=5.0)
+    p.add_argument("--cards", type=int, default=8)
+    p.add_argument("--mode", choices=["on", "off"], help=argparse.SUPPRESS)
+    p.set_defaults(func=cmd_sqlite_profile)
+
+    p = sub.add_parser("async", help="route async (asyncpg / aiosqlite) contro threadpool: req/s e p99 con 500 client")
+    p.add_argument("--clients", type=int, default=500)
+    p.add_argument("--seconds", type=float, default=10.0, help="meno di SCAN_WINDOW: la sessione del tap scade")
+    p.add_argument("--cards", type=int, default=500, help="almeno una carta per client (dispositivo associato)")
+    p.add_argument("--mode", choices=["sync", "async"], help=argparse.SUPPRESS)
+    p.set_defaults(func=cmd_async)
+
+    p = sub.add_parser("writer", help="scritture concorrenti (SQLite) con e senza writer unico a commit di gruppo")
+    p.add_argument("--threads", type=int, default=64)
+    p.add_argument("--seconds", type=float, default=5.0)
+    p.add_argument("--cards", type=int, default=200)
+    p.add_argument("--synchronous", default="NORMAL,FULL", help="valori di SQLITE_SYNCHRONOUS da provare")
+    p.add_argument("--mode", choices=["on", "off"], help=argparse.SUPPRESS)
+    p.set_defaults(func=cmd_writer)
+
+    p = sub.add_parser("shards", help="scritture concorrenti (SQLite) con il DB diviso in 1, 2, 4, 8 shard")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--seconds", type=float, default=5.0)
+    p.add_argument("--cards", type=int, default=400)
+    p.add_argument("--procs", type=int, default=8, help="processi scrittori (come i worker uvicorn)")
+    p.add_argument("--shards", default="1,2,4,8", help="valori di SQLITE_SHARDS da provare")
+    p.add_argument("--synchronous", default="NORMAL,FULL", help="valori di SQLITE_SYNCHRONOUS da provare")
+    p.add_argument("--commit-delay-ms", type=float, default=0.0,
+                   help="attesa dentro ogni COMMIT (lock preso): simula un disco con fsync lento")
+    p.add_argument("--mode", choices=["worker"], help=argparse.SUPPRESS)
+    p.add_argument("--db", help=argparse.SUPPRESS)
+    p.add_argument("--seed", type=int, default=0, help=argparse.SUPPRESS)
+    p.set_defaults(func=cmd_shards)
+
+    p = sub.add_parser("render", help="throughput di render_page con e senza cache impostazioni/pagina base")
+    p.add_argument("-n", type=int, default=20000)
+    p.set_defaults(func=cmd_render)
+
+    p = sub.add_parser("billing", help="fatturazione a blocchi su molti abbonamenti attivi (default 100k)")
+    p.add_argument("--subs", type=int, default=100_000)
+    p.add_argument("--cards", type=int, default=20_000)
+    p.add_argument("--weeks", type=int, default=10, help="arretrato massimo in settimane")
+    p.set_defaults(func=cmd_billing)
+
+    p = sub.add_parser("simulate", help="proiezione vettoriale dei saldi (default 1M carte x 52 settimane)")
+    p.add_argument("--cards", type=int, default=1_000_000)
+    p.add_argument("--subs", type=int, default=1_000_000)
+    p.add_argument("--weeks", type=int, default=52)
+    p.add_argument("--db", action="store_true", help="carica carte e abbonamenti nel DB e simula da lì (usare meno carte)")
+    p.set_defaults(func=cmd_simulate)
+
+    p = sub.add_parser("leaderboard", help="classifica in memoria con molte carte (default 1M)")
+    p.add_argument("--cards", type=int, default=1_000_000)
+    p.add_argument("--runs", type=int, default=2000)
+    p.set_defaults(func=cmd_leaderboard)
+
+    p = sub.add_parser("card-ids", help="token contro id intero della carta: dimensioni DB/indici e storico (SQLite)")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--cards", type=int, default=1000)
+    p.add_argument("--runs", type=int, default=2000)
+    p.set_defaults(func=cmd_card_ids)
+
+    p = sub.add_parser("fragments", help="/lista e /admin con e senza cache dei frammenti")
+    p.add_argument("--cards", type=int, default=5000)
+    p.add_argument("-n", type=int, default=50)
+    p.set_defaults(func=cmd_fragments)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,10 +1,21 @@
 # main.py
-# Requisiti: fastapi, uvicorn, python-multipart, (opzionale) psycopg2-binary per Postgres
+# Requisiti: fastapi, uvicorn, python-multipart, (opzionali) psycopg2-binary per Postgres, asyncpg / aiosqlite
+# per l'accesso async al DB
 # Avvio: uvicorn main:app --host 0.0.0.0 --port 8000
 
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-import os, sqlite3, secrets, hashlib, time, html as html_lib
+from fastapi import FastAPI, Request, Form, Depends
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import contextmanager, asynccontextmanager
+from collections import OrderedDict
+from dataclasses import dataclass
+import os, sqlite3, secrets, hashlib, hmac, base64, bisect, itertools, time, threading, contextvars, csv, io, json, gzip, asyncio, functools, queue, concurrent.futures, heapq
+import html as html_lib
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock tra processi sull'archivio
+    fcntl = None
 
 # ---------- CONFIG ----------
 DB_FILE = os.environ.get("DB_PATH", "cards.db")
@@ -17,241 +28,1930 @@ USE_PG = DATABASE_URL.startswith("postgres") and psycopg2 is not None
 if DATABASE_URL.startswith("postgres") and not USE_PG:
     print("ATTENZIONE: psycopg2-binary non installato, fallback a SQLite.")
 
+# Repliche di sola lettura (solo Postgres): DATABASE_READ_URL è una lista separata da virgole. Le letture pesanti
+# (classifica, lista, pannello admin, storico, simulazione) vanno alle repliche a turno; scritture e letture che
+# decidono qualcosa (saldi, sessioni, PIN) restano sul primario. Dopo una scrittura la stessa richiesta, e per
+# READ_STICKY_SECONDS s lo stesso browser (cookie), legge solo dal primario: il ritardo delle repliche non si vede.
+DATABASE_READ_URLS = [u.strip() for u in os.environ.get("DATABASE_READ_URL", "").split(",") if u.strip()]
+if DATABASE_READ_URLS and not USE_PG:
+    print("ATTENZIONE: DATABASE_READ_URL ignorato (repliche solo con Postgres).")
+READ_STICKY_SECONDS = float(os.environ.get("READ_STICKY_SECONDS", "5"))
+READ_STICKY_COOKIE = "read_primary_until"
+# replica che non accetta connessioni: esclusa per REPLICA_RETRY_SECONDS s, nel frattempo si legge dal primario
+REPLICA_RETRY_SECONDS = float(os.environ.get("REPLICA_RETRY_SECONDS", "5"))
+
 SESSION_TTL = 60 * 5
 SCAN_WINDOW = 30
 DEVICE_COOKIE_NAME = "device_id"
 SESSION_COOKIE_NAME = "session"
 WEEK_SECONDS = 7 * 24 * 60 * 60
+SHOP_THRESHOLD = 3000  # saldo minimo per usare il negozio (centesimi)
 ADMIN_KEY = os.environ.get("ADMIN_KEY", "bunald")
 
-app = FastAPI()
+# Sessioni: "db" (tabella sessions) oppure "signed" (cookie firmato HMAC con token, creazione e scadenza,
+# verificato senza accessi al DB). In modalità signed il reset/eliminazione di una carta revoca le sessioni
+# tramite una piccola lista di revoche, riletta ogni SESSION_REVOCATION_REFRESH s. Con più worker SESSION_SECRET
+# deve essere uguale per tutti.
+SESSION_MODE = os.environ.get("SESSION_MODE", "db").strip().lower()
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "")
+if SESSION_MODE == "signed" and not SESSION_SECRET:
+    print("ATTENZIONE: SESSION_SECRET non impostato, chiave casuale: le sessioni non sopravvivono al riavvio.")
+    SESSION_SECRET = secrets.token_hex(32)
+SESSION_REVOCATION_REFRESH = float(os.environ.get("SESSION_REVOCATION_REFRESH", "30"))
+SESSION_SWEEP_SECONDS = float(os.environ.get("SESSION_SWEEP_SECONDS", "300"))
+
+# Addebiti ricorrenti: un job in background ogni BILLING_INTERVAL s (0 = disattivato, es. se gira da cron con
+# "python manage_sites.py bill"), a blocchi di BILLING_BATCH abbonamenti per transazione.
+BILLING_INTERVAL = float(os.environ.get("BILLING_INTERVAL", "60"))
+BILLING_BATCH = int(os.environ.get("BILLING_BATCH", "5000"))
+
+# Pool connessioni: con Postgres al massimo DB_POOL_SIZE connessioni aperte (attesa fino a DB_POOL_TIMEOUT s),
+# con SQLite ogni thread tiene fino a DB_POOL_SIZE connessioni inattive. Le connessioni ferme da più di
+# DB_POOL_PING s vengono verificate con SELECT 1 prima di essere riusate.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_PING = float(os.environ.get("DB_POOL_PING", "30"))
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "0") == "1"
+
+# Sharding SQLite (SQLITE_SHARDS=N > 1): ogni carta, con le sue sessioni, i suoi acquisti e i suoi movimenti, sta in
+# uno di N file scelto dall'hash del token (shard 0 = DB_PATH, gli altri accanto: cards.1.db, cards.2.db, ...).
+# Impostazioni, catalogo e revoche restano nello shard 0. Ogni file ha il suo lock di scrittura: le scritture su
+# carte di shard diversi non si aspettano. I trasferimenti tra shard passano da un journal (recover_transfers ogni
+# SHARD_RECOVERY_SECONDS s). Dopo aver cambiato N: "python manage_sites.py rebalance" ad app ferma.
+SQLITE_SHARDS = int(os.environ.get("SQLITE_SHARDS", "1"))
+if SQLITE_SHARDS > 1 and USE_PG:
+    print("ATTENZIONE: SQLITE_SHARDS ignorato (sharding solo con SQLite).")
+SHARDS = 1 if USE_PG else max(1, SQLITE_SHARDS)
+SHARD_RECOVERY_SECONDS = float(os.environ.get("SHARD_RECOVERY_SECONDS", "30"))
+
+# Accesso async al DB per le route del percorso carta (tap, banca, trasferimenti, classifica, storico): asyncpg con
+# Postgres, aiosqlite con SQLite, al massimo DB_POOL_SIZE connessioni. Con DB_ASYNC=0 o senza il driver le stesse
+# route chiamano gli helper sincroni nel threadpool, come con lo sharding (gli helper sincroni scelgono lo shard).
+DB_ASYNC = os.environ.get("DB_ASYNC", "1") == "1"
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+USE_ASYNC_DB = DB_ASYNC and (asyncpg if USE_PG else aiosqlite) is not None and SHARDS == 1
+
+# Writer unico per SQLite (SQLITE_WRITER=1): trasferimenti, saldi, acquisti, sessioni e movimenti diventano intenti
+# in coda a un thread con una sua connessione, eseguiti a gruppi (fino a SQLITE_WRITER_BATCH, raccolti per al massimo
+# SQLITE_WRITER_WINDOW_MS ms) con un solo commit per gruppo. Le scritture così committano subito, non a fine richiesta.
+SQLITE_WRITER = os.environ.get("SQLITE_WRITER", "0") == "1"
+SQLITE_WRITER_WINDOW_MS = float(os.environ.get("SQLITE_WRITER_WINDOW_MS", "2"))
+SQLITE_WRITER_BATCH = int(os.environ.get("SQLITE_WRITER_BATCH", "256"))
+if SQLITE_WRITER and SHARDS > 1:
+    print("ATTENZIONE: SQLITE_WRITER ignorato con SQLITE_SHARDS > 1 (il writer ha una sola connessione).")
+
+# Profilo prestazioni SQLite (SQLITE_PROFILE=0 per disattivarlo), applicato a ogni connessione del pool:
+# WAL (letture e scrittura in parallelo), busy timeout invece di "database is locked", synchronous=NORMAL
+# (sicuro con WAL), mmap e cache più grandi, tabelle temporanee in RAM. Checkpoint WAL ogni SQLITE_CHECKPOINT_SECONDS.
+SQLITE_PROFILE = os.environ.get("SQLITE_PROFILE", "1") == "1"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", "-65536"))  # negativo = KiB (64 MB)
+SQLITE_CHECKPOINT_SECONDS = float(os.environ.get("SQLITE_CHECKPOINT_SECONDS", "60"))
+
+# Cache in memoria delle carte (per token e per nome). Le scritture di questo processo la aggiornano subito;
+# CARD_CACHE_TTL limita quanto può restare vecchia una carta modificata da un altro worker.
+CARD_CACHE = os.environ.get("CARD_CACHE", "1") == "1"
+CARD_CACHE_SIZE = int(os.environ.get("CARD_CACHE_SIZE", "10000"))
+CARD_CACHE_TTL = float(os.environ.get("CARD_CACHE_TTL", "10"))
+# Impostazioni grafiche in memoria (e pagina base pre-renderizzata); /admin/settings le aggiorna subito.
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", "60"))
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "60"))
+
+# Classifica in memoria: caricata all'avvio, aggiornata a ogni commit che tocca una carta e ricaricata per intero
+# ogni LEADERBOARD_RELOAD s (con più worker ognuno vede così anche le modifiche degli altri; 0 = mai).
+LEADERBOARD_TOP = int(os.environ.get("LEADERBOARD_TOP", "10"))
+LEADERBOARD_NEIGHBOURS = int(os.environ.get("LEADERBOARD_NEIGHBOURS", "2"))
+LEADERBOARD_RELOAD = float(os.environ.get("LEADERBOARD_RELOAD", "300"))
+
+# ETag di /leaderboard, /lista e /admin: derivati dalla versione dei dati di questo processo, che cambia solo con
+# le sue scritture (e con il ricaricamento della classifica). Le modifiche di altri worker o della CLI (manage_sites
+# bill / archive) li rendono vecchi: scadono comunque ogni ETAG_WINDOW s (default CARD_CACHE_TTL; 0 = mai).
+ETAG_WINDOW = float(os.environ.get("ETAG_WINDOW", str(CARD_CACHE_TTL)))
+
+# Frammenti HTML (corpi delle tabelle) per versione dei dati: una voce per vista/visitatore, LRU limitata.
+# La versione cambia solo con le scritture di questo processo: le modifiche di altri worker o della CLI
+# (manage_sites bill / archive / creazione carte) compaiono dopo al massimo FRAGMENT_CACHE_TTL s (default
+# CARD_CACHE_TTL, la stessa coerenza delle pagine senza cache dei frammenti; ETAG_WINDOW la riduce ancora).
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", "256"))
+FRAGMENT_CACHE_TTL = float(os.environ.get("FRAGMENT_CACHE_TTL", str(CARD_CACHE_TTL)))
+
+# Archivio: le transazioni più vecchie di ARCHIVE_AFTER_DAYS giorni (0 = mai) passano in segmenti NDJSON gzip
+# in ARCHIVE_DIR, ARCHIVE_BATCH righe per segmento; il job gira ogni ARCHIVE_INTERVAL s.
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", os.path.join(os.path.dirname(DB_FILE) or ".", "archive"))
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH", "50000"))
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "3600"))
 
 # ---------- DB LAYER ----------
-def get_conn():
+def get_conn(path: str = None):
     if USE_PG:
         return psycopg2.connect(DATABASE_URL)
-    return sqlite3.connect(DB_FILE)
+    # le connessioni del pool possono essere restituite da un thread diverso da quello che le ha aperte
+    conn = sqlite3.connect(path or DB_FILE, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    if SQLITE_PROFILE:
+        for pragma in sqlite_pragmas():
+            conn.execute(pragma)
+    return conn
+
+def sqlite_pragmas() -> list:
+    return [
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}",
+        f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}",
+        f"PRAGMA cache_size={SQLITE_CACHE_SIZE}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    def __init__(self, connect, size: int, timeout: float, ping_after: float, per_thread: bool):
+        self.connect = connect
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.per_thread = per_thread
+        self._cond = threading.Condition()
+        self._idle = []            # (conn, ultimo_uso) condivise (Postgres)
+        self._idle_by_thread = {}  # thread ident -> [(conn, ultimo_uso)] (SQLite)
+        self._open = 0
+        self._in_use = 0
+        self._counters = dict.fromkeys(("checkouts", "created", "reused", "discarded", "pings", "waits", "timeouts"), 0)
+
+    def _idle_list(self):
+        if not self.per_thread:
+            return self._idle
+        return self._idle_by_thread.setdefault(threading.get_ident(), [])
+
+    def _prune_dead_threads(self):
+        # chiamato con il lock preso: toglie dal pool le connessioni inattive dei thread terminati
+        alive = {t.ident for t in threading.enumerate()}
+        dead = []
+        for ident in [i for i in self._idle_by_thread if i not in alive]:
+            dead.extend(self._idle_by_thread.pop(ident))
+        self._open -= len(dead)
+        return [conn for conn, _ in dead]
+
+    def _checkout(self, deadline: float):
+        with self._cond:
+            self._counters["checkouts"] += 1
+            while True:
+                idle = self._idle_list()
+                if idle:
+                    self._in_use += 1
+                    return idle.pop()
+                if self.per_thread or self._open < self.size:
+                    self._open += 1; self._in_use += 1
+                    return None, 0.0
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeout(f"Nessuna connessione libera entro {self.timeout}s")
+                self._counters["waits"] += 1
+                self._cond.wait(remaining)
+
+    def _healthy(self, conn, last_used: float) -> bool:
+        if getattr(conn, "closed", 0):
+            return False
+        if time.monotonic() - last_used < self.ping_after:
+            return True
+        with self._cond:
+            self._counters["pings"] += 1
+        try:
+            c = conn.cursor(); c.execute("SELECT 1"); c.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        with self._cond:
+            self._open -= 1; self._in_use -= 1
+            self._counters["discarded"] += 1
+            self._cond.notify()
+        try: conn.close()
+        except Exception: pass
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn, last_used = self._checkout(deadline)
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._cond:
+                        self._open -= 1; self._in_use -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._counters["created"] += 1
+                return conn
+            if self._healthy(conn, last_used):
+                with self._cond:
+                    self._counters["reused"] += 1
+                return conn
+            self._discard(conn)
+
+    def release(self, conn, broken: bool = False):
+        if not broken:
+            try:
+                conn.rollback()  # mai restituire al pool una connessione con una transazione aperta
+            except Exception:
+                broken = True
+        if broken or getattr(conn, "closed", 0):
+            self._discard(conn)
+            return
+        with self._cond:
+            self._in_use -= 1
+            idle = self._idle_list()
+            if len(idle) < self.size:
+                idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+            self._open -= 1
+        conn.close()
+
+    def close_idle(self):
+        # chiude le connessioni inattive di tutti i thread (es. prima di aprire i file in modo esclusivo)
+        with self._cond:
+            idle = self._idle + [item for items in self._idle_by_thread.values() for item in items]
+            self._idle, self._idle_by_thread = [], {}
+            self._open -= len(idle)
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            stale = self._prune_dead_threads() if self.per_thread else []
+            s = dict(self._counters)
+            s.update(backend="postgres" if USE_PG else "sqlite", size=self.size, open=self._open,
+                     in_use=self._in_use, idle=self._open - self._in_use)
+        for conn in stale:
+            conn.close()
+        return s
+
+POOL = ConnectionPool(get_conn, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_PING, per_thread=not USE_PG)
+REPLICA_POOLS = [ConnectionPool(functools.partial(psycopg2.connect, url), DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_PING,
+                                per_thread=False) for url in DATABASE_READ_URLS] if USE_PG else []
+_replica_turn = itertools.count()
+_replica_down_until = {}  # indice della replica -> time.monotonic() fino a cui non si riprova
+
+def _replica_candidates():
+    # indici delle repliche da provare, a turno, saltando quelle segnate come non raggiungibili
+    n = len(REPLICA_POOLS)
+    if not n:
+        return []
+    start, now = next(_replica_turn), time.monotonic()
+    return [i for i in ((start + k) % n for k in range(n)) if _replica_down_until.get(i, 0.0) <= now]
+
+def _replica_down(i: int, e: Exception):
+    # connessione rifiutata: la replica resta fuori per REPLICA_RETRY_SECONDS s (un solo avviso, non uno a richiesta)
+    _replica_down_until[i] = time.monotonic() + REPLICA_RETRY_SECONDS
+    print(f"ATTENZIONE: replica {i} non disponibile, letture dal primario per {REPLICA_RETRY_SECONDS:g}s: {e!r}")
+
+def replica_acquire():
+    # (pool, connessione) di una replica funzionante; None = leggere dal primario. Un pool pieno (PoolTimeout) non
+    # è una replica guasta: l'errore passa al chiamante come per il primario.
+    for i in _replica_candidates():
+        try:
+            return REPLICA_POOLS[i], REPLICA_POOLS[i].acquire()
+        except PoolTimeout:
+            raise
+        except Exception as e:
+            _replica_down(i, e)
+    return None
+
+# ---------- SHARD ----------
+# Instradamento con SQLITE_SHARDS > 1: token -> shard con jump consistent hash (passando da N a N+1 shard si sposta
+# solo ~1/(N+1) delle carte). Gli id delle carte e dei movimenti dello shard i partono da i << SHARD_ID_BITS
+# (contatori AUTOINCREMENT di ogni file, impostati da migrate): da card_id / from_id / to_id si risale allo shard e
+# gli id dei movimenti sono unici tra gli shard (le copie mirror hanno l'id negato). Gli id degli acquisti restano
+# locali al file. Con un solo shard tutto va a POOL / DB_FILE come prima.
+SHARD_ID_BITS = 40
+
+def shard_path(shard: int) -> str:
+    # cards.db -> cards.db, cards.1.db, cards.2.db, ...
+    if shard == 0:
+        return DB_FILE
+    root, ext = os.path.splitext(DB_FILE)
+    return f"{root}.{shard}{ext}"
+
+SHARD_POOLS = [POOL] + [ConnectionPool(functools.partial(get_conn, shard_path(i)), DB_POOL_SIZE, DB_POOL_TIMEOUT,
+                                       DB_POOL_PING, per_thread=True) for i in range(1, SHARDS)]
+
+def _jump_hash(key: int, buckets: int) -> int:
+    # Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+def shard_of(token: str) -> int:
+    if SHARDS == 1:
+        return 0
+    return _jump_hash(int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "big"), SHARDS)
+
+def shard_of_id(card_id):
+    # None per il negozio (id NULL) e per id di shard che non esistono più (carte eliminate prima di un rebalance)
+    if card_id is None:
+        return None
+    shard = int(card_id) >> SHARD_ID_BITS
+    return shard if shard < SHARDS else None
+
+def new_sid(token: str) -> str:
+    # la sessione sta nello shard della carta: con lo sharding il sid finisce con ".<shard>"
+    sid = secrets.token_urlsafe(24)
+    return f"{sid}.{shard_of(token)}" if SHARDS > 1 else sid
+
+def shard_of_sid(sid: str) -> int:
+    head, _, tail = sid.rpartition(".")
+    if SHARDS == 1 or not head or not tail.isdigit() or int(tail) >= SHARDS:
+        return 0
+    return int(tail)
+
+def group_by_shard(keys, route) -> dict:
+    # shard -> chiavi (token, id, ...) secondo route; le chiavi senza shard (route -> None) si scartano
+    groups = {}
+    for key in keys:
+        shard = route(key)
+        if shard is not None:
+            groups.setdefault(shard, []).append(key)
+    return groups
+
+# ---------- UNIT OF WORK ----------
+# Ogni richiesta HTTP usa una sola connessione e una sola transazione: tutti gli helper (exec_sql, get_by_token,
+# adjust_balance, log_transaction, ...) lavorano sulla stessa connessione e il commit avviene una volta sola
+# a fine richiesta; errori e risposte 5xx fanno rollback di tutto. Con lo sharding c'è una connessione per ogni
+# shard toccato, tutte con commit a fine richiesta (non atomico tra file: le scritture su più shard, cioè i
+# trasferimenti tra carte di shard diversi, seguono il protocollo di _transfer_between_shards).
+_current_uow = contextvars.ContextVar("unit_of_work", default=None)
+
+class UnitOfWork:
+    def __init__(self, primary_reads: bool = False):
+        self.conn = None
+        self.shard_conns = {}        # shard (> 0) -> connessione
+        self.changed_tokens = set()  # carte modificate: la cache le scarta di nuovo dopo commit/rollback
+        self.on_close = []           # callback da eseguire dopo commit/rollback
+        self.read_conn = None        # connessione di una replica (read_conn), con il suo pool
+        self._read_pool = None
+        self.primary_reads = primary_reads  # letture solo dal primario (scrittura recente di questo browser)
+        self.wrote = False                  # la richiesta ha scritto: da qui in poi letture dal primario
+
+    @property
+    def active(self) -> bool:
+        return self.conn is not None or self.read_conn is not None or bool(self.shard_conns)
+
+    def connection(self, shard: int = 0):
+        # la connessione viene presa dal pool solo al primo accesso al DB
+        if shard:
+            conn = self.shard_conns.get(shard)
+            if conn is None:
+                conn = self.shard_conns[shard] = SHARD_POOLS[shard].acquire()
+            return conn
+        if self.conn is None:
+            self.conn = POOL.acquire()
+        return self.conn
+
+    def read_connection(self):
+        # replica per le letture della richiesta; None = leggere dal primario (anche se la replica non risponde)
+        if self.primary_reads or self.wrote or not REPLICA_POOLS:
+            return None
+        if self.read_conn is None:
+            picked = replica_acquire()
+            if picked is None:
+                self.primary_reads = True  # per il resto della richiesta, senza riprovare a ogni lettura
+                return None
+            self._read_pool, self.read_conn = picked
+        return self.read_conn
+
+    def close(self, commit: bool):
+        read_conn, self.read_conn = self.read_conn, None
+        if read_conn is not None:
+            self._read_pool.release(read_conn)
+        conns = [(SHARD_POOLS[shard], conn) for shard, conn in self.shard_conns.items()]
+        self.shard_conns = {}
+        if self.conn is not None:
+            conns.append((POOL, self.conn))  # shard 0 per ultimo: create_site vi tiene il lock dei nomi
+            self.conn = None
+        if not conns:
+            return
+        try:
+            if commit:
+                for _, conn in conns:
+                    conn.commit()
+        finally:
+            for pool, conn in conns:
+                pool.release(conn)
+            self.finish()
+
+    def finish(self):
+        # dopo commit/rollback: cache delle carte e callback
+        cards_committed(self.changed_tokens)
+        self.changed_tokens = set()
+        callbacks, self.on_close = self.on_close, []
+        for fn in callbacks:
+            fn()
+
+@contextmanager
+def db_conn(shard: int = 0):
+    uow = _current_uow.get()
+    if uow is not None:
+        # dentro una richiesta (o un blocco già aperto): commit/rollback li fa chi ha aperto la unit of work
+        yield uow.connection(shard)
+        return
+    # fuori da una richiesta (CLI, job): unit of work limitata al blocco, commit se termina senza errori
+    uow = UnitOfWork()
+    reset = _current_uow.set(uow)
+    try:
+        yield uow.connection(shard)
+    except BaseException:
+        _current_uow.reset(reset)
+        uow.close(False)
+        raise
+    _current_uow.reset(reset)
+    uow.close(True)
+
+def note_write():
+    # la richiesta in corso ha scritto: le sue letture successive (e quelle del browser, via cookie) vanno al primario
+    uow = _current_uow.get()
+    if uow is not None:
+        uow.wrote = True
+
+@contextmanager
+def read_conn(shard: int = 0):
+    # connessione per letture pesanti che tollerano qualche secondo di ritardo: una replica a turno se configurata,
+    # altrimenti (o dopo una scrittura, vedi note_write) la stessa di db_conn. Repliche e shard non vanno insieme
+    # (Postgres / SQLite): shard conta solo senza repliche.
+    uow = _current_uow.get()
+    picked = replica_acquire() if uow is None else None
+    if picked is not None:
+        pool, conn = picked
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+        return
+    if uow is not None and uow.read_connection() is not None:
+        yield uow.read_conn
+        return
+    with db_conn(shard) as conn:
+        yield conn
+
+def _detached(fn, *args):
+    # esegue fn fuori dalla unit of work della richiesta (connessione e commit suoi)
+    reset = _current_uow.set(None)
+    try:
+        return fn(*args)
+    finally:
+        _current_uow.reset(reset)
+
+@contextmanager
+def atomic(name: str = "atomic", shard: int = 0):
+    # blocco tutto-o-niente: SAVEPOINT sulla connessione della richiesta (o su una dedicata fuori richiesta).
+    # Su SQLite la transazione parte con BEGIN IMMEDIATE: il lock di scrittura si prende subito e chi arriva
+    # dopo aspetta (busy timeout) invece di fallire al momento di passare da lettura a scrittura.
+    with db_conn(shard) as conn:
+        c = conn.cursor()
+        if not USE_PG and not conn.in_transaction:
+            c.execute("BEGIN IMMEDIATE")
+        c.execute(f"SAVEPOINT {name}")
+        try:
+            yield c
+        except Exception:
+            c.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            c.execute(f"RELEASE SAVEPOINT {name}")
+            raise
+        c.execute(f"RELEASE SAVEPOINT {name}")
+
+# ---------- WRITER SQLITE ----------
+class SQLiteWriter:
+    # Un thread esegue gli intenti di scrittura (fn, argomenti) in gruppi: BEGIN IMMEDIATE, ogni intento nel suo
+    # SAVEPOINT (un errore annulla solo quello), un COMMIT per gruppo. Il Future di ogni intento si risolve dopo il
+    # commit e dopo l'invalidazione delle cache, quindi chi aspetta rilegge già i dati nuovi. Gli intenti usano gli
+    # helper normali: nel thread del writer la unit of work è quella del gruppo.
+    # Ogni helper @writes chiamato da una richiesta committa da solo, indipendentemente dalla richiesta (che non può
+    # più annullarlo): scritture che devono andare insieme stanno in un unico helper (es. bind_card, reset_card).
+    def __init__(self, window: float, batch: int):
+        self.window = window
+        self.batch = max(1, batch)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="sqlite-writer", daemon=True)
+        self._counters = dict.fromkeys(("intents", "groups", "failed", "commit_errors", "max_group"), 0)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(timeout=30)
+        while True:  # intenti arrivati dopo lo stop: non verranno eseguiti
+            try: item = self._queue.get_nowait()
+            except queue.Empty: break
+            if item is not None and item[3].set_running_or_notify_cancel():
+                item[3].set_exception(RuntimeError("writer SQLite fermo"))
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._queue.put((fn, args, kwargs, future))
+        return future
+
+    def _collect(self, first):
+        # primo intento + quelli che arrivano entro la finestra (o già in coda), fino a batch
+        group, stop = [first], False
+        deadline = time.monotonic() + self.window
+        while len(group) < self.batch:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            group.append(item)
+        return group, stop
+
+    def _loop(self):
+        conn = get_conn()
+        try:
+            stop = False
+            while not stop:
+                item = self._queue.get()
+                if item is None:
+                    break
+                group, stop = self._collect(item)
+                self._run(conn, [g for g in group if g[3].set_running_or_notify_cancel()])
+        finally:
+            conn.close()
+
+    def _run(self, conn, group):
+        if not group:
+            return
+        results = []
+        uow = UnitOfWork()
+        uow.conn = conn
+        reset = _current_uow.set(uow)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, kwargs, future in group:
+                try:
+                    with atomic("write_intent"):
+                        results.append((future, fn(*args, **kwargs), None))
+                except Exception as e:
+                    results.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            # gruppo perso (es. lock di un altro processo oltre il busy timeout): falliscono tutti gli intenti
+            try: conn.rollback()
+            except Exception: pass
+            self._counters["commit_errors"] += 1
+            results = [(g[3], None, e) for g in group]
+        finally:
+            _current_uow.reset(reset)
+            uow.conn = None
+            uow.finish()
+        self._counters["intents"] += len(group)
+        self._counters["groups"] += 1
+        self._counters["max_group"] = max(self._counters["max_group"], len(group))
+        for future, value, error in results:
+            if error is not None:
+                self._counters["failed"] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(value)
+
+    def stats(self) -> dict:
+        s = dict(self._counters)
+        s.update(queued=self._queue.qsize(), window_ms=self.window * 1000, batch=self.batch,
+                 avg_group=round(s["intents"] / s["groups"], 2) if s["groups"] else 0)
+        return s
+
+WRITER = None  # SQLiteWriter attivo (start_writer), None = scritture dirette
+
+def start_writer():
+    global WRITER
+    if SQLITE_WRITER and not USE_PG and SHARDS == 1 and WRITER is None:
+        WRITER = SQLiteWriter(SQLITE_WRITER_WINDOW_MS / 1000, SQLITE_WRITER_BATCH).start()
+    return WRITER
+
+def stop_writer():
+    global WRITER
+    writer, WRITER = WRITER, None
+    if writer is not None:
+        writer.stop()
+
+def _in_write_transaction() -> bool:
+    uow = _current_uow.get()
+    return uow is not None and uow.conn is not None and uow.conn.in_transaction
+
+def writes(fn):
+    # helper di scrittura: con il writer attivo diventa un intento in coda (stessa firma, stesso risultato).
+    # Dentro una transazione già aperta (es. il gruppo del writer stesso) gira lì: passare dal writer vorrebbe
+    # dire aspettare un lock tenuto da chi aspetta.
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if WRITER is None or _in_write_transaction():
+            return fn(*args, **kwargs)
+        note_write()
+        return WRITER.submit(fn, *args, **kwargs).result()
+    wrapper.write_intent = fn
+    return wrapper
 
 def adapt_sql(sql: str) -> str:
     return sql.replace("?", "%s") if USE_PG else sql
 
-def exec_sql(sql: str, params=(), fetch=None):
-    conn = get_conn(); c = conn.cursor()
-    c.execute(adapt_sql(sql), params)
-    data = None
-    if fetch == "one":
-        data = c.fetchone()
-    elif fetch == "all":
-        data = c.fetchall()
-    conn.commit()
-    conn.close()
-    return data
-
-def init_db():
+def exec_sql(sql: str, params=(), fetch=None, shard: int = 0):
+    with db_conn(shard) as conn:
+        c = conn.cursor()
+        c.execute(adapt_sql(sql), params)
+        if fetch == "one":
+            return c.fetchone()
+        if fetch == "all":
+            return c.fetchall()
+        return None
+
+def read_sql(sql: str, params=(), fetch="all", shard: int = 0):
+    # come exec_sql, solo SELECT, su read_conn
+    with read_conn(shard) as conn:
+        c = conn.cursor()
+        c.execute(adapt_sql(sql), params)
+        return c.fetchone() if fetch == "one" else c.fetchall()
+
+def read_shards(sql: str, params=(), key=None) -> list:
+    # la stessa SELECT su ogni shard. key: righe già ordinate per key in ogni shard, fuse in un solo ordine
+    # (per "ORDER BY id" basta la concatenazione: gli intervalli di id delle carte crescono con lo shard)
+    parts = [read_sql(sql, params, shard=shard) or [] for shard in range(SHARDS)]
+    if key is None or len(parts) == 1:
+        return [r for part in parts for r in part]
+    return list(heapq.merge(*parts, key=key))
+
+# ---------- SCHEMA / MIGRAZIONI ----------
+# Lo schema si aggiorna solo con "python manage_sites.py migrate" (o AUTO_MIGRATE=1 all'avvio): l'app all'avvio
+# controlla soltanto la versione. Ogni migrazione ha i passi per SQLite e per Postgres e gira in una transazione.
+
+# Indici gestiti: nome -> (tabella, colonne). Le migrazioni li creano con create_index(nome).
+INDEXES = {
+    # storico carta: get_recent_transactions legge i due rami (inviate / ricevute) già ordinati per (ts, id),
+    # anche dal cursore di una pagina successiva. I vecchi indici (token, ts) li sostituisce la migrazione 6,
+    # quelli su token la migrazione 9 (id intero della carta).
+    "idx_transactions_from_ts": ("transactions", "from_token, ts"),
+    "idx_transactions_to_ts": ("transactions", "to_token, ts"),
+    "idx_transactions_from_ts_id": ("transactions", "from_token, ts, id"),
+    "idx_transactions_to_ts_id": ("transactions", "to_token, ts, id"),
+    "idx_transactions_from_id_ts": ("transactions", "from_id, ts, id"),
+    "idx_transactions_to_id_ts": ("transactions", "to_id, ts, id"),
+    # export per intervallo di date
+    "idx_transactions_ts": ("transactions", "ts, id"),
+    # abbonamenti di una carta (negozio)
+    "idx_purchases_token_active": ("purchases", "token, active, next_charge_at"),
+    "idx_purchases_card_active": ("purchases", "card_id, active, next_charge_at"),
+    # passata di fatturazione: abbonamenti attivi in scadenza
+    "idx_purchases_due": ("purchases", "active, next_charge_at"),
+    # /buy: la carta possiede già l'articolo?
+    "idx_purchases_owner": ("purchases", "token, item_code, active"),
+    "idx_purchases_card_owner": ("purchases", "card_id, item_code, active"),
+    # pulizia delle sessioni scadute
+    "idx_sessions_expires": ("sessions", "expires"),
+    # revoca delle sessioni di una carta
+    "idx_sessions_card": ("sessions", "card_id"),
+}
+
+def create_index(name: str) -> str:
+    table, columns = INDEXES[name]
+    return f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})"
+
+# Migrazione 9: le tabelle collegate a una carta tengono solo cards.id; il token resta in cards e i nomi si
+# leggono con una join. Nelle transazioni NULL è la controparte "Negozio" e 0 una carta non più esistente
+# al momento della migrazione (le carte eliminate dopo tengono il loro id, che non viene riusato).
+def _card_id_of(col: str) -> str:
+    return f"CASE WHEN {col} IS NULL THEN NULL ELSE COALESCE((SELECT id FROM cards WHERE cards.token = {col}), 0) END"
+
+MIGRATIONS = [
+    (1, "schema iniziale", {
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS cards(
+                id SERIAL PRIMARY KEY,
+                name TEXT UNIQUE,
+                token TEXT UNIQUE,
+                pin_hash TEXT,
+                balance DOUBLE PRECISION DEFAULT 0,
+                bound_device_id TEXT,
+                token_used INTEGER DEFAULT 0,
+                description TEXT DEFAULT ''
+            )""",
+            """CREATE TABLE IF NOT EXISTS sessions(
+                sid TEXT PRIMARY KEY,
+                token TEXT,
+                expires BIGINT,
+                created_at BIGINT DEFAULT 0
+            )""",
+            """CREATE TABLE IF NOT EXISTS transactions(
+                id SERIAL PRIMARY KEY,
+                ts BIGINT NOT NULL,
+                from_token TEXT,
+                from_name TEXT,
+                to_token TEXT,
+                to_name TEXT,
+                amount DOUBLE PRECISION NOT NULL,
+                reason TEXT
+            )""",
+            """CREATE TABLE IF NOT EXISTS purchases(
+                id SERIAL PRIMARY KEY,
+                token TEXT NOT NULL,
+                item_code TEXT NOT NULL,
+                item_name TEXT NOT NULL,
+                weekly_deduction DOUBLE PRECISION NOT NULL,
+                next_charge_at BIGINT NOT NULL,
+                started_at BIGINT NOT NULL,
+                active INTEGER DEFAULT 1
+            )""",
+            """CREATE TABLE IF NOT EXISTS settings(
+                id INTEGER PRIMARY KEY,
+                bank_name TEXT,
+                logo_url TEXT,
+                gradient_from TEXT,
+                gradient_to TEXT,
+                font_name TEXT
+            )""",
+        ],
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS cards(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE,
+                token TEXT UNIQUE,
+                pin_hash TEXT,
+                balance REAL DEFAULT 0,
+                bound_device_id TEXT,
+                token_used INTEGER DEFAULT 0,
+                description TEXT DEFAULT ''
+            )""",
+            """CREATE TABLE IF NOT EXISTS sessions(
+                sid TEXT PRIMARY KEY,
+                token TEXT,
+                expires INTEGER,
+                created_at INTEGER DEFAULT 0
+            )""",
+            """CREATE TABLE IF NOT EXISTS transactions(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts INTEGER NOT NULL,
+                from_token TEXT,
+                from_name TEXT,
+                to_token TEXT,
+                to_name TEXT,
+                amount REAL NOT NULL,
+                reason TEXT
+            )""",
+            """CREATE TABLE IF NOT EXISTS purchases(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                token TEXT NOT NULL,
+                item_code TEXT NOT NULL,
+                item_name TEXT NOT NULL,
+                weekly_deduction REAL NOT NULL,
+                next_charge_at INTEGER NOT NULL,
+                started_at INTEGER NOT NULL,
+                active INTEGER DEFAULT 1
+            )""",
+            """CREATE TABLE IF NOT EXISTS settings(
+                id INTEGER PRIMARY KEY CHECK(id=1),
+                bank_name TEXT,
+                logo_url TEXT,
+                gradient_from TEXT,
+                gradient_to TEXT,
+                font_name TEXT
+            )""",
+        ],
+        "common": [
+            """INSERT INTO settings (id, bank_name, logo_url, gradient_from, gradient_to, font_name)
+               SELECT 1, 'Banca NFC', '', '#0ea5e9', '#8b5cf6', 'Poppins'
+               WHERE NOT EXISTS (SELECT 1 FROM settings WHERE id = 1)""",
+        ],
+    }),
+    (2, "indici per storico, addebiti e sessioni", {
+        "common": [create_index(n) for n in ("idx_transactions_from_ts", "idx_transactions_to_ts",
+                                             "idx_purchases_token_active", "idx_sessions_expires")],
+    }),
+    (3, "revoche sessioni firmate", {
+        "postgres": ["CREATE TABLE IF NOT EXISTS session_revocations(token TEXT PRIMARY KEY, revoked_at BIGINT NOT NULL)"],
+        "sqlite": ["CREATE TABLE IF NOT EXISTS session_revocations(token TEXT PRIMARY KEY, revoked_at INTEGER NOT NULL)"],
+    }),
+    (4, "indice fatturazione abbonamenti", {
+        "common": [create_index("idx_purchases_due")],
+    }),
+    (5, "catalogo negozio", {
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS catalog(
+                code TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                description TEXT DEFAULT '',
+                upfront DOUBLE PRECISION DEFAULT 0,
+                weekly DOUBLE PRECISION DEFAULT 0,
+                active INTEGER DEFAULT 1,
+                sort INTEGER DEFAULT 0
+            )""",
+        ],
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS catalog(
+                code TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                description TEXT DEFAULT '',
+                upfront REAL DEFAULT 0,
+                weekly REAL DEFAULT 0,
+                active INTEGER DEFAULT 1,
+                sort INTEGER DEFAULT 0
+            )""",
+        ],
+        "common": [
+            """INSERT INTO catalog (code, name, description, upfront, weekly, active, sort)
+               SELECT 'moccolone', 'Moccolone pencs', 'Bonus immediato +35, costo ricorrente -3 Bonsaura / settimana.',
+                      35, 3, 1, 0
+               WHERE NOT EXISTS (SELECT 1 FROM catalog WHERE code = 'moccolone')""",
+            create_index("idx_purchases_owner"),
+        ],
+    }),
+    (6, "indici storico per cursore (ts, id)", {
+        "common": [create_index("idx_transactions_from_ts_id"), create_index("idx_transactions_to_ts_id"),
+                   "DROP INDEX IF EXISTS idx_transactions_from_ts", "DROP INDEX IF EXISTS idx_transactions_to_ts"],
+    }),
+    (7, "indice export per data", {
+        "common": [create_index("idx_transactions_ts")],
+    }),
+    (8, "importi interi in centesimi", {
+        "postgres": [f"ALTER TABLE {t} ALTER COLUMN {col} TYPE BIGINT USING ROUND({col} * 100)"
+                     for t, cols in (("cards", ["balance"]), ("transactions", ["amount"]),
+                                     ("purchases", ["weekly_deduction"]), ("catalog", ["upfront", "weekly"]))
+                     for col in cols],
+        "sqlite": [lambda c: _sqlite_cents_tables(c)],
+    }),
+    (9, "id intero della carta in transazioni, sessioni e acquisti", {
+        # su Postgres lo spazio delle colonne tolte si recupera con VACUUM FULL (o pg_repack)
+        "postgres": [
+            "ALTER TABLE transactions ADD COLUMN from_id INTEGER, ADD COLUMN to_id INTEGER",
+            f"UPDATE transactions SET from_id = {_card_id_of('from_token')}, to_id = {_card_id_of('to_token')}",
+            "DROP INDEX IF EXISTS idx_transactions_from_ts_id",
+            "DROP INDEX IF EXISTS idx_transactions_to_ts_id",
+            "ALTER TABLE transactions DROP COLUMN from_token, DROP COLUMN from_name, DROP COLUMN to_token, DROP COLUMN to_name",
+            "ALTER TABLE sessions ADD COLUMN card_id INTEGER REFERENCES cards(id)",
+            "UPDATE sessions SET card_id = (SELECT id FROM cards WHERE cards.token = sessions.token)",
+            "DELETE FROM sessions WHERE card_id IS NULL",
+            "ALTER TABLE sessions DROP COLUMN token",
+            "ALTER TABLE purchases ADD COLUMN card_id INTEGER REFERENCES cards(id)",
+            "UPDATE purchases SET card_id = (SELECT id FROM cards WHERE cards.token = purchases.token)",
+            "DELETE FROM purchases WHERE card_id IS NULL",
+            "ALTER TABLE purchases ALTER COLUMN card_id SET NOT NULL",
+            "DROP INDEX IF EXISTS idx_purchases_token_active",
+            "DROP INDEX IF EXISTS idx_purchases_owner",
+            "ALTER TABLE purchases DROP COLUMN token",
+        ],
+        "sqlite": [lambda c: _sqlite_card_ids(c)],
+        "common": [create_index(n) for n in ("idx_transactions_from_id_ts", "idx_transactions_to_id_ts",
+                                             "idx_purchases_card_active", "idx_purchases_card_owner",
+                                             "idx_sessions_card")],
+    }),
+    (10, "sharding: copie dei movimenti e journal dei trasferimenti tra shard", {
+        # transfer_journal (shard del mittente): trasferimenti addebitati e non ancora chiusi; transfer_received
+        # (shard del destinatario): xid già gestiti, con l'esito, per non accreditare due volte
+        "postgres": [
+            """CREATE TABLE IF NOT EXISTS transfer_journal(
+                xid TEXT PRIMARY KEY, ts BIGINT NOT NULL, from_id BIGINT NOT NULL, to_id BIGINT NOT NULL,
+                amount BIGINT NOT NULL, reason TEXT, tx_id BIGINT NOT NULL)""",
+            "CREATE TABLE IF NOT EXISTS transfer_received(xid TEXT PRIMARY KEY, received_at BIGINT NOT NULL, credited INTEGER NOT NULL)",
+        ],
+        "sqlite": [
+            """CREATE TABLE IF NOT EXISTS transfer_journal(
+                xid TEXT PRIMARY KEY, ts INTEGER NOT NULL, from_id INTEGER NOT NULL, to_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL, reason TEXT, tx_id INTEGER NOT NULL)""",
+            "CREATE TABLE IF NOT EXISTS transfer_received(xid TEXT PRIMARY KEY, received_at INTEGER NOT NULL, credited INTEGER NOT NULL)",
+        ],
+        # mirror=1: copia di un movimento tra carte di shard diversi, nello shard dell'altra carta (per il suo
+        # storico), con id = -id della riga principale (un id positivo di un altro shard sposterebbe il contatore
+        # AUTOINCREMENT del file nel suo intervallo); export e archivio leggono solo le righe principali
+        "common": ["ALTER TABLE transactions ADD COLUMN mirror INTEGER NOT NULL DEFAULT 0"],
+    }),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _sqlite_rebuild(c, table: str, columns: str, names: str, select: str, indexes: list = None):
+    # SQLite non cambia tipo né toglie colonne indicizzate con ALTER TABLE: la tabella si ricrea con le nuove
+    # colonne, si riempie con `select` (che legge ancora la vecchia) e prende il suo nome. indexes: SQL degli
+    # indici da creare (default: quelli di prima). Il contatore AUTOINCREMENT non torna indietro.
+    if indexes is None:
+        c.execute("SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,))
+        indexes = [r[0] for r in c.fetchall()]
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,))
+    seq = c.fetchone()
+    c.execute(f"CREATE TABLE {table}_new({columns})")
+    c.execute(f"INSERT INTO {table}_new ({names}) {select}")
+    c.execute(f"DROP TABLE {table}")
+    c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    if seq:
+        # id mai riusati, anche se le righe più recenti erano state cancellate
+        c.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
+        c.execute(f"INSERT INTO sqlite_sequence (name, seq) SELECT ?, MAX(?, COALESCE(MAX(id), 0)) FROM {table}",
+                  (table, seq[0]))
+    for sql in indexes:
+        c.execute(sql)
+
+# Migrazione 8 su SQLite: in una colonna REAL anche i valori interi tornano float, quindi le tabelle con importi
+# si ricreano con gli stessi campi e gli importi INTEGER in centesimi.
+_CENTS_TABLES = {
+    "cards": ("""id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, token TEXT UNIQUE, pin_hash TEXT,
+                 balance INTEGER DEFAULT 0, bound_device_id TEXT, token_used INTEGER DEFAULT 0, description TEXT DEFAULT ''""",
+              ["balance"]),
+    "transactions": ("""id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, from_token TEXT, from_name TEXT,
+                        to_token TEXT, to_name TEXT, amount INTEGER NOT NULL, reason TEXT""",
+                     ["amount"]),
+    "purchases": ("""id INTEGER PRIMARY KEY AUTOINCREMENT, token TEXT NOT NULL, item_code TEXT NOT NULL,
+                     item_name TEXT NOT NULL, weekly_deduction INTEGER NOT NULL, next_charge_at INTEGER NOT NULL,
+                     started_at INTEGER NOT NULL, active INTEGER DEFAULT 1""",
+                  ["weekly_deduction"]),
+    "catalog": ("""code TEXT PRIMARY KEY, name TEXT NOT NULL, description TEXT DEFAULT '', upfront INTEGER DEFAULT 0,
+                   weekly INTEGER DEFAULT 0, active INTEGER DEFAULT 1, sort INTEGER DEFAULT 0""",
+                ["upfront", "weekly"]),
+}
+
+def _sqlite_cents_tables(c):
+    for table, (columns, money) in _CENTS_TABLES.items():
+        c.execute(f"SELECT * FROM {table} LIMIT 0")
+        names = [d[0] for d in c.description]
+        select = ", ".join(f"CAST(ROUND({n} * 100) AS INTEGER)" if n in money else n for n in names)
+        _sqlite_rebuild(c, table, columns, ", ".join(names), f"SELECT {select} FROM {table}")
+
+def _sqlite_card_ids(c):
+    _sqlite_rebuild(
+        c, "transactions",
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, from_id INTEGER, to_id INTEGER, "
+        "amount INTEGER NOT NULL, reason TEXT",
+        "id, ts, from_id, to_id, amount, reason",
+        f"SELECT id, ts, {_card_id_of('from_token')}, {_card_id_of('to_token')}, amount, reason FROM transactions",
+        [create_index("idx_transactions_ts")])
+    _sqlite_rebuild(
+        c, "sessions",
+        "sid TEXT PRIMARY KEY, card_id INTEGER REFERENCES cards(id), expires INTEGER, created_at INTEGER DEFAULT 0",
+        "sid, card_id, expires, created_at",
+        "SELECT s.sid, cd.id, s.expires, s.created_at FROM sessions s JOIN cards cd ON cd.token = s.token",
+        [create_index("idx_sessions_expires")])
+    _sqlite_rebuild(
+        c, "purchases",
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, card_id INTEGER NOT NULL REFERENCES cards(id), item_code TEXT NOT NULL, "
+        "item_name TEXT NOT NULL, weekly_deduction INTEGER NOT NULL, next_charge_at INTEGER NOT NULL, "
+        "started_at INTEGER NOT NULL, active INTEGER DEFAULT 1",
+        "id, card_id, item_code, item_name, weekly_deduction, next_charge_at, started_at, active",
+        "SELECT p.id, cd.id, p.item_code, p.item_name, p.weekly_deduction, p.next_charge_at, p.started_at, p.active "
+        "FROM purchases p JOIN cards cd ON cd.token = p.token",
+        [create_index("idx_purchases_due")])
+
+def schema_version(shard: int = 0) -> int:
+    if USE_PG:
+        r = exec_sql("SELECT to_regclass('schema_version') IS NOT NULL", fetch="one")
+    else:
+        r = exec_sql("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='schema_version'", fetch="one",
+                     shard=shard)
+    if not r or not r[0]:
+        return 0
+    r = exec_sql("SELECT MAX(version) FROM schema_version", fetch="one", shard=shard)
+    return int(r[0] or 0)
+
+def _shard_id_floor(c, shard: int):
+    # gli id di carte e movimenti dello shard partono da shard << SHARD_ID_BITS (vedi shard_of_id)
+    floor = shard << SHARD_ID_BITS
+    for table in ("cards", "transactions"):
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,))
+        r = c.fetchone()
+        if r is None:
+            c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, floor))
+        elif r[0] < floor:
+            c.execute("UPDATE sqlite_sequence SET seq=? WHERE name=?", (floor, table))
+
+def migrate(log=print, target: int = None) -> list:
+    # applica le migrazioni mancanti (fino a target, se indicato) al DB, con lo sharding a ogni shard
     if not USE_PG:
         d = os.path.dirname(DB_FILE)
         if d and not os.path.exists(d):
             os.makedirs(d, exist_ok=True)
-    conn = get_conn(); c = conn.cursor()
-    if USE_PG:
-        c.execute("""CREATE TABLE IF NOT EXISTS cards(
-            id SERIAL PRIMARY KEY,
-            name TEXT UNIQUE,
-            token TEXT UNIQUE,
-            pin_hash TEXT,
-            balance DOUBLE PRECISION DEFAULT 0,
-            bound_device_id TEXT,
-            token_used INTEGER DEFAULT 0,
-            description TEXT DEFAULT ''
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-            sid TEXT PRIMARY KEY,
-            token TEXT,
-            expires BIGINT,
-            created_at BIGINT DEFAULT 0
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS transactions(
-            id SERIAL PRIMARY KEY,
-            ts BIGINT NOT NULL,
-            from_token TEXT,
-            from_name TEXT,
-            to_token TEXT,
-            to_name TEXT,
-            amount DOUBLE PRECISION NOT NULL,
-            reason TEXT
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS purchases(
-            id SERIAL PRIMARY KEY,
-            token TEXT NOT NULL,
-            item_code TEXT NOT NULL,
-            item_name TEXT NOT NULL,
-            weekly_deduction DOUBLE PRECISION NOT NULL,
-            next_charge_at BIGINT NOT NULL,
-            started_at BIGINT NOT NULL,
-            active INTEGER DEFAULT 1
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS settings(
-            id INTEGER PRIMARY KEY,
-            bank_name TEXT,
-            logo_url TEXT,
-            gradient_from TEXT,
-            gradient_to TEXT,
-            font_name TEXT
-        )""")
-    else:
-        c.execute("""CREATE TABLE IF NOT EXISTS cards(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE,
-            token TEXT UNIQUE,
-            pin_hash TEXT,
-            balance REAL DEFAULT 0,
-            bound_device_id TEXT,
-            token_used INTEGER DEFAULT 0,
-            description TEXT DEFAULT ''
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-            sid TEXT PRIMARY KEY,
-            token TEXT,
-            expires INTEGER,
-            created_at INTEGER DEFAULT 0
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS transactions(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts INTEGER NOT NULL,
-            from_token TEXT,
-            from_name TEXT,
-            to_token TEXT,
-            to_name TEXT,
-            amount REAL NOT NULL,
-            reason TEXT
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS purchases(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            token TEXT NOT NULL,
-            item_code TEXT NOT NULL,
-            item_name TEXT NOT NULL,
-            weekly_deduction REAL NOT NULL,
-            next_charge_at INTEGER NOT NULL,
-            started_at INTEGER NOT NULL,
-            active INTEGER DEFAULT 1
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS settings(
-            id INTEGER PRIMARY KEY CHECK(id=1),
-            bank_name TEXT,
-            logo_url TEXT,
-            gradient_from TEXT,
-            gradient_to TEXT,
-            font_name TEXT
-        )""")
-    c.execute("SELECT id FROM settings WHERE id = 1")
-    if not c.fetchone():
-        c.execute(adapt_sql(
-            "INSERT INTO settings (id, bank_name, logo_url, gradient_from, gradient_to, font_name) VALUES (1, ?, ?, ?, ?, ?)"
-        ), ("Banca NFC", "", "#0ea5e9", "#8b5cf6", "Poppins"))
-    conn.commit(); conn.close()
-
-init_db()
-
-# ---------- HELPERS CARD ----------
-def hash_pin(pin: str) -> str:
-    return hashlib.sha256(pin.encode()).hexdigest()
-
-def create_site(name: str, pin: str, initial: float = 0.0, description: str = ""):
-    token = secrets.token_urlsafe(16)
+    applied = []
+    for shard in range(SHARDS):
+        where = f" (shard {shard})" if SHARDS > 1 else ""
+        exec_sql(f"""CREATE TABLE IF NOT EXISTS schema_version(
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at {"BIGINT" if USE_PG else "INTEGER"} NOT NULL
+        )""", shard=shard)
+        current = schema_version(shard)
+        for version, name, steps in MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+            with atomic("migration", shard=shard) as c:
+                for step in steps.get("postgres" if USE_PG else "sqlite", []) + steps.get("common", []):
+                    if callable(step):
+                        step(c)
+                    else:
+                        c.execute(step)
+                c.execute(adapt_sql("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)"),
+                          (version, name, int(time.time())))
+            applied.append(version)
+            if log:
+                log(f"Migrazione {version} applicata{where}: {name}")
+        if shard:
+            with atomic("shard_ids", shard=shard) as c:
+                _shard_id_floor(c, shard)
+    return applied
+
+def check_schema():
+    for shard in range(SHARDS):
+        current = schema_version(shard)
+        if current < LATEST_SCHEMA_VERSION:
+            where = f" (shard {shard}, {shard_path(shard)})" if SHARDS > 1 else ""
+            raise RuntimeError(f"Schema DB{where} alla versione {current}, richiesta {LATEST_SCHEMA_VERSION}: "
+                               f"eseguire 'python manage_sites.py migrate'")
+
+# ---------- CACHE ----------
+# Versione dei dati: cresce a ogni scrittura su cards, transactions e settings (subito e di nuovo a fine
+# transazione, come le cache). Il prefisso casuale distingue i riavvii del processo.
+_BOOT_ID = secrets.token_hex(4)
+_version_counter = itertools.count(1)
+_data_version = 0
+
+def _bump_data_version():
+    global _data_version
+    _data_version = next(_version_counter)
+
+def data_changed():
+    _bump_data_version()
+    uow = _current_uow.get()
+    if uow is not None:
+        uow.wrote = True
+        uow.on_close.append(_bump_data_version)
+
+def data_version() -> str:
+    window = f".{int(time.time() // ETAG_WINDOW)}" if ETAG_WINDOW > 0 else ""
+    return f"{_BOOT_ID}.{_data_version}{window}"
+
+class TTLCache:
+    # LRU con scadenza per voce; thread-safe, conta hit/miss
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# Le voci per token contengono la carta, quelle per nome solo il token: un'unica copia dei dati da invalidare.
+CARD_CACHE_STORE = TTLCache(CARD_CACHE_SIZE, CARD_CACHE_TTL)
+_card_generation = 0  # cresce a ogni invalidazione: una lettura dal DB iniziata prima non rientra in cache
+
+def cards_changed(*tokens):
+    # da chiamare a ogni scrittura su cards: scarta subito e di nuovo a fine transazione
+    global _card_generation
+    uow = _current_uow.get()
+    data_changed()
+    for token in tokens:
+        if not token:
+            continue
+        _card_generation += 1
+        CARD_CACHE_STORE.pop(("t", token))
+        if uow is not None:
+            uow.changed_tokens.add(token)
+    if uow is None:
+        cards_committed([t for t in tokens if t])  # fuori da una unit of work la scrittura è già committata
+
+def cards_committed(tokens):
+    global _card_generation
+    for token in tokens:
+        _card_generation += 1
+        CARD_CACHE_STORE.pop(("t", token))
+    if tokens:
+        LEADERBOARD.refresh(tokens)
+        _bump_data_version()  # dopo il refresh: i frammenti della nuova versione vedono la classifica aggiornata
+
+def _card_cacheable(token: str) -> bool:
+    # una carta modificata nella transazione in corso non va in cache finché non c'è il commit
+    uow = _current_uow.get()
+    return CARD_CACHE and not (uow is not None and token in uow.changed_tokens)
+
+# ---------- CLASSIFICA ----------
+class RankedList:
+    # lista ordinata a blocchi (max 2*LOAD chiavi ciascuno) con un albero di Fenwick sulle dimensioni dei blocchi:
+    # inserimento/rimozione O(LOAD + log n), posizione di una chiave e chiave in posizione i in O(log n)
+    LOAD = 500
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._lists = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [b[-1] for b in self._lists]
+        self._len = len(keys)
+        self._reindex()
+
+    def _reindex(self):
+        n = len(self._lists)
+        tree = [0] * (n + 1)
+        for i, b in enumerate(self._lists, start=1):
+            tree[i] += len(b)
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _grow(self, b: int, delta: int):
+        tree, j = self._tree, b + 1
+        while j < len(tree):
+            tree[j] += delta
+            j += j & -j
+
+    def _before(self, b: int) -> int:
+        # chiavi nei blocchi [0, b)
+        tree, total = self._tree, 0
+        while b > 0:
+            total += tree[b]
+            b -= b & -b
+        return total
+
+    def _locate(self, pos: int):
+        # (blocco, offset) della posizione pos, scendendo nell'albero di Fenwick
+        tree, b, step = self._tree, 0, 1 << (len(self._tree).bit_length())
+        while step:
+            if b + step < len(tree) and tree[b + step] <= pos:
+                b += step
+                pos -= tree[b]
+            step >>= 1
+        return b, pos
+
+    def __len__(self):
+        return self._len
+
+    def add(self, key):
+        if not self._lists:
+            self._lists, self._maxes, self._len = [[key]], [key], 1
+            self._reindex()
+            return
+        b = min(bisect.bisect_left(self._maxes, key), len(self._maxes) - 1)
+        block = self._lists[b]
+        bisect.insort(block, key)
+        self._maxes[b] = block[-1]
+        self._len += 1
+        if len(block) > 2 * self.LOAD:
+            self._lists.insert(b + 1, block[self.LOAD:])
+            del block[self.LOAD:]
+            self._maxes[b:b + 1] = [block[-1], self._lists[b + 1][-1]]
+            self._reindex()
+        else:
+            self._grow(b, 1)
+
+    def remove(self, key):
+        b = bisect.bisect_left(self._maxes, key)
+        block = self._lists[b] if b < len(self._lists) else []
+        i = bisect.bisect_left(block, key)
+        if i == len(block) or block[i] != key:
+            raise KeyError(key)
+        del block[i]
+        self._len -= 1
+        if block:
+            self._maxes[b] = block[-1]
+            self._grow(b, -1)
+        else:
+            del self._lists[b], self._maxes[b]
+            self._reindex()
+
+    def rank(self, key) -> int:
+        # quante chiavi precedono key
+        b = bisect.bisect_left(self._maxes, key)
+        if b == len(self._maxes):
+            return self._len
+        return self._before(b) + bisect.bisect_left(self._lists[b], key)
+
+    def slice(self, start: int, stop: int) -> list:
+        start, stop = max(0, start), min(stop, self._len)
+        if start >= stop:
+            return []
+        b, i = self._locate(start)
+        out = []
+        while len(out) < stop - start:
+            out.extend(self._lists[b][i:i + stop - start - len(out)])
+            b, i = b + 1, 0
+        return out
+
+class Leaderboard:
+    # classifica per (-saldo, id): chiavi in RankedList, id -> (token, nome) a parte.
+    # refresh rilegge dal DB le carte appena committate (così i rollback non lasciano tracce).
+    def __init__(self):
+        self.loaded = False
+        self._ranks = RankedList()
+        self._keys = {}    # token -> chiave
+        self._cards = {}   # id -> (token, nome)
+        self._pending = None  # carte aggiornate durante un load(): rilette dopo lo scambio
+        self._recent = {}     # con le repliche, token -> ultimo refresh: il load può non vederlo ancora
+        self._lock = threading.Lock()          # struttura
+        self._refresh_lock = threading.Lock()  # letture DB + aggiornamenti in ordine
+        self.reloads = self.refreshes = 0
+
+    def load(self) -> dict:
+        # la lettura completa non blocca i refresh: chi committa nel frattempo finisce in _pending.
+        # Da una replica: anche le carte aggiornate negli ultimi READ_STICKY_SECONDS s si rileggono dal primario
+        with self._lock:
+            self._pending = set()
+        started = time.monotonic()
+        rows = read_shards("SELECT id, token, name, balance FROM cards")
+        ranks = RankedList((-int(balance or 0), cid) for cid, _, _, balance in rows)
+        keys = {token: (-int(balance or 0), cid) for cid, token, _, balance in rows}
+        cards = {cid: (token, name) for cid, token, name, _ in rows}
+        with self._refresh_lock:
+            with self._lock:
+                pending, self._pending = self._pending, None
+                if self._recent:
+                    self._recent = {t: ts for t, ts in self._recent.items() if ts >= started - READ_STICKY_SECONDS}
+                    pending.update(self._recent)
+                self._ranks, self._keys, self._cards = ranks, keys, cards
+                self.loaded = True
+                self.reloads += 1
+            self._apply(pending)
+        _bump_data_version()  # righe nuove (anche scritte da altri processi): ETag e frammenti da rifare
+        return {"cards": len(rows)}
+
+    def refresh(self, tokens):
+        with self._refresh_lock:
+            with self._lock:
+                if self._pending is not None:
+                    self._pending.update(tokens)
+                if REPLICA_POOLS:
+                    now = time.monotonic()
+                    self._recent.update((t, now) for t in tokens)
+            if self.loaded:
+                self._apply(tokens)
+
+    def _apply(self, tokens):
+        tokens = list(tokens)
+        rows = []
+        for shard, group in group_by_shard(tokens, shard_of).items():
+            for i in range(0, len(group), 500):
+                chunk = group[i:i + 500]
+                rows += exec_sql(f"SELECT id, token, name, balance FROM cards WHERE token IN ({','.join('?' * len(chunk))})",
+                                 tuple(chunk), fetch="all", shard=shard) or []
+        with self._lock:
+            for token in tokens:
+                key = self._keys.pop(token, None)
+                if key is not None:
+                    self._ranks.remove(key)
+                    self._cards.pop(key[1], None)
+            for cid, token, name, balance in rows:
+                key = (-int(balance or 0), cid)
+                self._ranks.add(key)
+                self._keys[token] = key
+                self._cards[cid] = (token, name)
+            self.refreshes += 1
+
+    def _entries(self, start: int, stop: int) -> list:
+        # [(posizione, nome, saldo, token)], posizioni da 1
+        out = []
+        for pos, (neg_balance, cid) in enumerate(self._ranks.slice(start, stop), start=start + 1):
+            token, name = self._cards[cid]
+            out.append((pos, name, -neg_balance, token))
+        return out
+
+    def view(self, token: str, top: int, neighbours: int):
+        # primi `top` + la carta `token` con i vicini; ritorna (righe, posizione della carta o None, totale)
+        with self._lock:
+            rows = self._entries(0, top)
+            key = self._keys.get(token)
+            pos = self._ranks.rank(key) if key is not None else None
+            if pos is not None and pos + neighbours >= top:
+                rows += self._entries(max(top, pos - neighbours), pos + neighbours + 1)
+            return rows, (pos + 1 if pos is not None else None), len(self._ranks)
+
+    def stats(self) -> dict:
+        return {"loaded": self.loaded, "cards": len(self._ranks), "reloads": self.reloads, "refreshes": self.refreshes}
+
+LEADERBOARD = Leaderboard()
+
+def reload_leaderboard():
+    return LEADERBOARD.load()
+
+# ---------- IMPORTI ----------
+# Saldi, movimenti e prezzi sono interi in centesimi (migrazione 8): il SQL somma e confronta solo interi.
+# La conversione avviene ai bordi: to_cents per quello che arriva da form e CLI, fmt_cents / fmt_bonsaura
+# per quello che si mostra o si esporta.
+MAX_CENTS = 10 ** 15
+
+def to_cents(value) -> int:
+    # "12.5", "12,50", 12.5 -> 1250 (arrotondamento al centesimo); ValueError se non è un importo valido
     try:
-        exec_sql("INSERT INTO cards (name, token, pin_hash, balance, description) VALUES (?, ?, ?, ?, ?)",
-                 (name, token, hash_pin(pin), float(initial), description.strip()))
-        return token
-    except Exception:
-        return None
+        d = Decimal(str(value).strip().replace(",", "."))
+    except InvalidOperation:
+        raise ValueError(f"importo non valido: {value!r}")
+    if not d.is_finite():
+        raise ValueError(f"importo non valido: {value!r}")
+    cents = int(d.scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    if abs(cents) > MAX_CENTS:
+        raise ValueError(f"importo fuori scala: {value!r}")
+    return cents
+
+def fmt_cents(cents: int, short: bool = False) -> str:
+    # 1250 -> "12.50" (short: "12.50", ma 300 -> "3")
+    cents = int(cents or 0)
+    units, rest = divmod(abs(cents), 100)
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{units}" if short and not rest else f"{sign}{units}.{rest:02d}"
+
+def fmt_bonsaura(cents: int) -> str:
+    try: return f"{fmt_cents(cents)} Bonsaura"
+    except: return f"{cents} Bonsaura"
 
-def get_by_token(token: str):
-    r = exec_sql(
-        "SELECT id,name,token,pin_hash,balance,bound_device_id,token_used,description FROM cards WHERE token=?",
-        (token,), fetch="one")
-    if not r: return None
-    return {
-        "id": r[0], "name": r[1], "token": r[2], "pin_hash": r[3], "balance": r[4],
-        "bound_device_id": r[5], "token_used": r[6], "description": r[7]
-    }
+# ---------- HELPERS CARD ----------
+CARD_COLUMNS = "id,name,token,pin_hash,balance,bound_device_id,token_used,description"
 
-def get_by_name(name: str):
-    r = exec_sql(
-        "SELECT id,name,token,pin_hash,balance,bound_device_id,token_used,description FROM cards WHERE name=?",
-        (name,), fetch="one")
+def _card_row(r):
     if not r: return None
     return {
         "id": r[0], "name": r[1], "token": r[2], "pin_hash": r[3], "balance": r[4],
         "bound_device_id": r[5], "token_used": r[6], "description": r[7]
     }
 
-def mark_token_used(token: str):
-    exec_sql("UPDATE cards SET token_used=1 WHERE token=?", (token,))
-
-def bind_device_id(token: str, device_id: str):
-    exec_sql("UPDATE cards SET bound_device_id=? WHERE token=?", (device_id, token))
+def hash_pin(pin: str) -> str:
+    return hashlib.sha256(pin.encode()).hexdigest()
 
-def unbind_device_id(token: str):
-    exec_sql("UPDATE cards SET bound_device_id=NULL, token_used=0 WHERE token=?", (token,))
+def create_site(name: str, pin: str, initial: int = 0, description: str = ""):
+    # initial in centesimi
+    token = secrets.token_urlsafe(16)
+    sql = "INSERT INTO cards (name, token, pin_hash, balance, description) VALUES (?, ?, ?, ?, ?)"
+    params = (name, token, hash_pin(pin), int(initial), description.strip())
+    try:
+        if SHARDS == 1:
+            exec_sql(sql, params)
+        else:
+            # nomi unici su tutti gli shard: il lock di scrittura dello shard 0 (fino al commit) mette in fila
+            # le creazioni, anche tra processi
+            with atomic("create_site"):
+                if any(exec_sql("SELECT 1 FROM cards WHERE name=?", (name,), fetch="one", shard=shard)
+                       for shard in range(SHARDS)):
+                    return None
+                exec_sql(sql, params, shard=shard_of(token))
+        cards_changed(token)
+        return token
+    except Exception:
+        return None
 
-def update_balance_by_token(token: str, newbal: float):
-    exec_sql("UPDATE cards SET balance=? WHERE token=?", (float(newbal), token))
+def count_cards() -> int:
+    return sum(exec_sql("SELECT COUNT(*) FROM cards", fetch="one", shard=shard)[0] for shard in range(SHARDS))
 
-def adjust_balance(token: str, delta: float):
-    exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (float(delta), token))
+def _cache_card(card):
+    CARD_CACHE_STORE.set(("t", card["token"]), card)
+    CARD_CACHE_STORE.set(("n", card["name"]), card["token"])
 
-def log_transaction(from_token, from_name, to_token, to_name, amount, reason):
-    exec_sql("INSERT INTO transactions (ts,from_token,from_name,to_token,to_name,amount,reason) VALUES (?,?,?,?,?,?,?)",
-             (int(time.time()), from_token, from_name, to_token, to_name, float(amount), reason))
+def get_by_token(token: str):
+    if CARD_CACHE:
+        card = CARD_CACHE_STORE.get(("t", token))
+        if card is not None:
+            return dict(card)
+    generation = _card_generation
+    card = _card_row(exec_sql(f"SELECT {CARD_COLUMNS} FROM cards WHERE token=?", (token,), fetch="one",
+                              shard=shard_of(token)))
+    if card and generation == _card_generation and _card_cacheable(token):
+        _cache_card(card)
+        return dict(card)
+    return card
 
-def get_recent_transactions(token: str, limit: int = 10):
-    placeholder = "%s" if USE_PG else "?"
-    conn = get_conn(); c = conn.cursor()
-    c.execute(f"""
-        SELECT ts, from_name, to_name, amount, reason
-        FROM transactions
-        WHERE from_token = {placeholder} OR to_token = {placeholder}
-        ORDER BY ts DESC
-        LIMIT {int(limit)}
-    """, (token, token))
-    rows = c.fetchall(); conn.close()
-    return [{"ts": r[0], "from_name": r[1], "to_name": r[2], "amount": r[3], "reason": r[4]} for r in rows]
+def get_by_name(name: str):
+    if CARD_CACHE:
+        token = CARD_CACHE_STORE.get(("n", name))
+        if token is not None:
+            card = get_by_token(token)
+            if card and card["name"] == name:
+                return card
+            CARD_CACHE_STORE.pop(("n", name))  # carta eliminata (o nome riassegnato)
+    generation = _card_generation
+    card = None
+    for shard in range(SHARDS):  # il nome non dice lo shard: si cerca in tutti (poi la cache nome -> token)
+        card = _card_row(exec_sql(f"SELECT {CARD_COLUMNS} FROM cards WHERE name=?", (name,), fetch="one", shard=shard))
+        if card:
+            break
+    if card and generation == _card_generation and _card_cacheable(card["token"]):
+        _cache_card(card)
+        return dict(card)
+    return card
+
+@writes
+def bind_card(token: str, device_id: str):
+    # primo sblocco: dispositivo legato e token segnato come usato insieme (un solo intento, un solo commit)
+    exec_sql("UPDATE cards SET bound_device_id=?, token_used=1 WHERE token=?", (device_id, token),
+             shard=shard_of(token))
+    cards_changed(token)
+
+@writes
+def reset_card(token: str):
+    # reset dall'admin: dispositivo sganciato, token di nuovo usabile e sessioni chiuse nello stesso intento
+    exec_sql("UPDATE cards SET bound_device_id=NULL, token_used=0 WHERE token=?", (token,), shard=shard_of(token))
+    cards_changed(token)
+    revoke_sessions(token)
+
+@writes
+def update_balance_by_token(token: str, newbal: int):
+    exec_sql("UPDATE cards SET balance=? WHERE token=?", (int(newbal), token), shard=shard_of(token))
+    cards_changed(token)
+
+@writes
+def adjust_balance(token: str, delta: int):
+    exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (int(delta), token), shard=shard_of(token))
+    cards_changed(token)
+
+def delete_card(token: str):
+    # sessioni e acquisti puntano a cards.id: vanno via prima della carta. Le transazioni restano (id non riusati)
+    with atomic("delete_card", shard=shard_of(token)) as c:
+        for table in ("sessions", "purchases"):
+            c.execute(adapt_sql(f"DELETE FROM {table} WHERE card_id = (SELECT id FROM cards WHERE token=?)"), (token,))
+        c.execute(adapt_sql("DELETE FROM cards WHERE token=?"), (token,))
+    cards_changed(token)
+
+# Le transazioni tengono solo gli id delle carte (from_id / to_id); i nomi arrivano da una join su cards.
+SHOP_NAME = "Negozio"  # controparte senza carta (id NULL): acquisti e addebiti del negozio
+
+def party_name(card_id, name) -> str:
+    if card_id is None:
+        return SHOP_NAME
+    return name or "(carta eliminata)"
+
+def transaction_copies(from_id, to_id, live=None) -> list:
+    # [(shard, mirror)] delle righe di un movimento: la principale nello shard del mittente (del destinatario per
+    # gli accrediti del negozio o da carte eliminate), una copia mirror=1 nello shard dell'altra carta se diverso.
+    # live(id): la carta esiste (default: sì); senza nessuna carta viva il movimento resta nello shard 0
+    live = live or (lambda card_id: True)
+    parties = [shard_of_id(cid) for cid in (from_id, to_id) if cid is not None and live(cid)]
+    parties = [shard for shard in parties if shard is not None]
+    if not parties:
+        return [(0, 0)]
+    return [(parties[0], 0)] + [(shard, 1) for shard in parties[1:2] if shard != parties[0]]
+
+@writes
+def log_transaction(from_id, to_id, amount, reason):
+    row = (int(time.time()), from_id, to_id, int(amount), reason)
+    (shard, _), *mirrors = transaction_copies(from_id, to_id)
+    with db_conn(shard) as conn:
+        c = conn.cursor()
+        c.execute(adapt_sql("INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)"), row)
+        tx_id = c.lastrowid
+    if mirrors:  # solo SQLite
+        exec_sql("INSERT INTO transactions (id,ts,from_id,to_id,amount,reason,mirror) VALUES (?,?,?,?,?,?,1)",
+                 (-tx_id,) + row, shard=mirrors[0][0])
+    data_changed()
+
+# ---------- TRANSFERS ----------
+@writes
+def transfer_funds(from_token: str, to_name: str, amount: int, reason: str) -> dict:
+    # Addebito condizionato + accredito + log in un'unica transazione. Il saldo non viene mai letto e
+    # riscritto: "balance >= ?" nell'UPDATE impedisce di andare in negativo anche con richieste parallele.
+    # Con lo sharding, se le due carte stanno in shard diversi: _transfer_between_shards.
+    amount = int(amount)  # centesimi
+    if SHARDS > 1:
+        dest = get_by_name(to_name)
+        if dest and shard_of(dest["token"]) != shard_of(from_token):
+            return _transfer_between_shards(from_token, dest, amount, reason)
+    with atomic("transfer", shard=shard_of(from_token)) as c:
+        if USE_PG:
+            # lock delle due righe sempre nello stesso ordine (id) per evitare deadlock tra A->B e B->A
+            c.execute("SELECT token, name, id FROM cards WHERE token=%s OR name=%s ORDER BY id FOR UPDATE",
+                      (from_token, to_name))
+        else:
+            c.execute("SELECT token, name, id FROM cards WHERE token=? OR name=?", (from_token, to_name))
+        rows = c.fetchall()
+        sender = next((r for r in rows if r[0] == from_token), None)
+        dest = next((r for r in rows if r[1] == to_name), None)
+        if not sender:
+            return {"status": "sender_not_found"}
+        if not dest:
+            return {"status": "not_found"}
+        c.execute(adapt_sql("UPDATE cards SET balance = balance - ? WHERE id=? AND balance >= ?"),
+                  (amount, sender[2], amount))
+        if c.rowcount != 1:
+            c.execute(adapt_sql("SELECT balance FROM cards WHERE id=?"), (sender[2],))
+            return {"status": "insufficient_funds", "balance": c.fetchone()[0]}
+        c.execute(adapt_sql("UPDATE cards SET balance = balance + ? WHERE id=?"), (amount, dest[2]))
+        cards_changed(from_token, dest[0])
+        c.execute(adapt_sql("INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)"),
+                  (int(time.time()), sender[2], dest[2], amount, reason))
+    return {"status": "ok", "to_name": dest[1], "amount": amount}
+
+# Trasferimento tra shard: ogni file ha la sua transazione, quindi tre passi.
+#   1. shard del mittente: addebito condizionato, movimento e voce in transfer_journal, un solo commit;
+#   2. shard del destinatario: accredito e copia del movimento (mirror=1), al più una volta per xid
+#      (transfer_received ne tiene l'esito);
+#   3. shard del mittente: la voce di journal si chiude (con rimborso se il destinatario non c'è più).
+# Se il processo si ferma dopo il passo 1, recover_transfers ripete 2 e 3: i punti addebitati arrivano sempre a
+# destinazione, o tornano al mittente. Nel frattempo sono "in viaggio": né nell'uno né nell'altro saldo.
+def _transfer_between_shards(from_token: str, dest: dict, amount: int, reason: str) -> dict:
+    shard = shard_of(from_token)
+    entry = None
+
+    def debit():
+        nonlocal entry
+        with atomic("transfer_out", shard=shard) as c:
+            c.execute("SELECT id FROM cards WHERE token=?", (from_token,))
+            sender = c.fetchone()
+            if not sender:
+                return {"status": "sender_not_found"}
+            c.execute("UPDATE cards SET balance = balance - ? WHERE id=? AND balance >= ?", (amount, sender[0], amount))
+            if c.rowcount != 1:
+                c.execute("SELECT balance FROM cards WHERE id=?", (sender[0],))
+                return {"status": "insufficient_funds", "balance": c.fetchone()[0]}
+            cards_changed(from_token)
+            entry = (secrets.token_hex(12), int(time.time()), sender[0], dest["id"], amount, reason)
+            c.execute("INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)", entry[1:])
+            entry += (c.lastrowid,)
+            c.execute("INSERT INTO transfer_journal (xid,ts,from_id,to_id,amount,reason,tx_id) VALUES (?,?,?,?,?,?,?)",
+                      entry)
+        return {"status": "ok", "to_name": dest["name"], "amount": amount}
+
+    # passi con commit propri, anche dentro una richiesta: l'accredito parte solo dopo il commit dell'addebito
+    note_write()
+    result = _detached(debit)
+    if entry is not None:
+        _detached(_complete_transfer, shard, entry)
+    return result
+
+def _complete_transfer(shard: int, entry) -> bool:
+    # passi 2 e 3 per una voce del journal di `shard`; True se accreditato, False se rimborsato
+    xid, ts, from_id, to_id, amount, reason, tx_id = entry
+    dest_shard = shard_of_id(to_id)
+    credited = False
+    if dest_shard is not None:
+        with atomic("transfer_in", shard=dest_shard) as c:
+            c.execute("SELECT credited FROM transfer_received WHERE xid=?", (xid,))
+            seen = c.fetchone()
+            if seen:
+                credited = bool(seen[0])
+            else:
+                c.execute("SELECT token FROM cards WHERE id=?", (to_id,))
+                dest = c.fetchone()
+                credited = dest is not None
+                c.execute("INSERT INTO transfer_received (xid, received_at, credited) VALUES (?,?,?)",
+                          (xid, int(time.time()), int(credited)))
+                if credited:
+                    c.execute("UPDATE cards SET balance = balance + ? WHERE id=?", (amount, to_id))
+                    c.execute("INSERT INTO transactions (id,ts,from_id,to_id,amount,reason,mirror) VALUES (?,?,?,?,?,?,1)",
+                              (-tx_id, ts, from_id, to_id, amount, reason))
+                    cards_changed(dest[0])
+    with atomic("transfer_done", shard=shard) as c:
+        # chi cancella la voce chiude il trasferimento (e rimborsa): una volta sola anche con più recuperi in parallelo
+        c.execute("DELETE FROM transfer_journal WHERE xid=?", (xid,))
+        if c.rowcount == 1 and not credited:
+            c.execute("SELECT token FROM cards WHERE id=?", (from_id,))
+            sender = c.fetchone()
+            if sender:
+                c.execute("UPDATE cards SET balance = balance + ? WHERE id=?", (amount, from_id))
+                c.execute("INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)",
+                          (int(time.time()), to_id, from_id, amount, f"Rimborso: {reason}"))
+                cards_changed(sender[0])
+    return credited
+
+def recover_transfers(min_age: float = None) -> dict:
+    # chiude le voci di journal più vecchie di min_age s (default SHARD_RECOVERY_SECONDS: quelle più recenti
+    # le sta ancora chiudendo la richiesta che le ha aperte), poi toglie le ricevute che non servono più
+    now = int(time.time())
+    cutoff = now - (SHARD_RECOVERY_SECONDS if min_age is None else min_age)
+    credited = refunded = 0
+    oldest_open = now
+    for shard in range(SHARDS):
+        for entry in exec_sql("SELECT xid, ts, from_id, to_id, amount, reason, tx_id FROM transfer_journal ORDER BY ts",
+                              fetch="all", shard=shard) or []:
+            if entry[1] > cutoff:
+                oldest_open = min(oldest_open, entry[1])
+            elif _complete_transfer(shard, entry):
+                credited += 1
+            else:
+                refunded += 1
+    # una ricevuta serve finché la sua voce di journal è aperta, e la voce è sempre più vecchia della ricevuta
+    for shard in range(SHARDS):
+        exec_sql("DELETE FROM transfer_received WHERE received_at < ?", (oldest_open - 3600,), shard=shard)
+    return {"credited": credited, "refunded": refunded}
+
+def transfers_in_flight() -> dict:
+    # voci di journal aperte: numero e importo (centesimi) addebitati e non ancora accreditati
+    count = amount = 0
+    for shard in range(SHARDS):
+        n, total = exec_sql("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM transfer_journal", fetch="one", shard=shard)
+        count, amount = count + n, amount + total
+    return {"count": count, "amount": amount}
+
+def _card_refs(ids) -> dict:
+    # id -> (token, nome) cercati nello shard di ogni carta: le join su cards vedono solo lo shard locale
+    refs = {}
+    for shard, group in group_by_shard(set(ids), shard_of_id).items():
+        for i in range(0, len(group), 500):
+            chunk = group[i:i + 500]
+            for cid, token, name in read_sql(f"SELECT id, token, name FROM cards WHERE id IN ({','.join('?' * len(chunk))})",
+                                             tuple(chunk), shard=shard) or []:
+                refs[cid] = (token, name)
+    return refs
+
+def _fill_names(rows, pairs) -> list:
+    # righe con (indice id, indice nome) in pairs: con lo sharding i nomi di carte di altri shard (NULL nella
+    # join locale) si leggono dal loro shard
+    if SHARDS == 1 or not rows:
+        return rows
+    missing = [r[i] for r in rows for i, n in pairs if r[i] is not None and r[n] is None]
+    if not missing:
+        return rows
+    refs = _card_refs(missing)
+    out = []
+    for r in rows:
+        r = list(r)
+        for i, n in pairs:
+            if r[n] is None and r[i] in refs:
+                r[n] = refs[r[i]][1]
+        out.append(r)
+    return out
+
+def _recent_transactions_query(card_id: int, limit: int, before):
+    # UNION di due letture indicizzate (from_id, ts, id) e (to_id, ts, id), ciascuna già limitata:
+    # il costo dipende da "limit", non da quante transazioni ci sono in tabella. UNION (non ALL) toglie
+    # i doppioni dei trasferimenti verso se stessi. before=(ts, id): solo le transazioni precedenti (paginazione
+    # a cursore: "ts <= ?" delimita la lettura sull'indice, il resto scarta i pari merito già mostrati).
+    # I nomi si leggono da cards solo per le righe della pagina.
+    limit = int(limit)
+    cond, params = "", ()
+    if before is not None:
+        cond = "AND ts <= ? AND (ts < ? OR id < ?)"
+        params = (int(before[0]), int(before[0]), int(before[1]))
+    return f"""
+        SELECT t.id, t.ts, t.from_id, f.name, t.to_id, d.name, t.amount, t.reason FROM (
+            SELECT id, ts, from_id, to_id, amount, reason FROM (
+                SELECT id, ts, from_id, to_id, amount, reason FROM transactions
+                WHERE from_id = ? {cond} ORDER BY ts DESC, id DESC LIMIT {limit}) sent
+            UNION
+            SELECT id, ts, from_id, to_id, amount, reason FROM (
+                SELECT id, ts, from_id, to_id, amount, reason FROM transactions
+                WHERE to_id = ? {cond} ORDER BY ts DESC, id DESC LIMIT {limit}) received
+            ORDER BY ts DESC, id DESC
+            LIMIT {limit}) t
+        LEFT JOIN cards f ON f.id = t.from_id
+        LEFT JOIN cards d ON d.id = t.to_id
+        ORDER BY t.ts DESC, t.id DESC
+    """, (card_id,) + params + (card_id,) + params
+
+def _transaction_rows(rows) -> list:
+    return [{"id": r[0], "ts": r[1], "from_name": party_name(r[2], r[3]), "to_name": party_name(r[4], r[5]),
+             "amount": r[6], "reason": r[7]} for r in _fill_names(rows or [], ((2, 3), (4, 5)))]
+
+def get_recent_transactions(card_id: int, limit: int = 10, before=None):
+    # con lo sharding lo storico intero della carta sta nel suo shard (copie mirror comprese)
+    shard = shard_of_id(card_id)
+    if shard is None:
+        return []
+    sql, params = _recent_transactions_query(card_id, limit, before)
+    return _transaction_rows(read_sql(sql, params, shard=shard))
+
+def parse_cursor(cursor: str):
+    # "ts-id" -> (ts, id); None se vuoto o non valido
+    ts, _, tid = (cursor or "").partition("-")
+    try: return int(ts), int(tid)
+    except ValueError: return None
+
+def get_transactions_page(card_id: int, limit: int = 20, before: str = ""):
+    # una pagina dello storico e il cursore della successiva (None se è l'ultima)
+    rows = get_recent_transactions(card_id, limit + 1, parse_cursor(before))
+    page = rows[:limit]
+    return page, (f"{page[-1]['ts']}-{page[-1]['id']}" if len(rows) > limit else None)
 
 def fmt_ts(ts: int) -> str:
     try: return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(ts)))
     except: return str(ts)
 
+SETTINGS_CACHE = TTLCache(1, SETTINGS_CACHE_TTL)
+
 def get_settings():
+    # il dict restituito è condiviso (cache): non modificarlo
+    s = SETTINGS_CACHE.get("settings")
+    if s is not None:
+        return s
     r = exec_sql("SELECT bank_name,logo_url,gradient_from,gradient_to,font_name FROM settings WHERE id=1", fetch="one")
     if not r:
-        return {"bank_name":"Banca NFC","logo_url":"","gradient_from":"#0ea5e9","gradient_to":"#8b5cf6","font_name":"Poppins"}
-    return {"bank_name": r[0] or "Banca NFC", "logo_url": r[1] or "", "gradient_from": r[2] or "#0ea5e9",
-            "gradient_to": r[3] or "#8b5cf6", "font_name": r[4] or "Poppins"}
+        s = {"bank_name":"Banca NFC","logo_url":"","gradient_from":"#0ea5e9","gradient_to":"#8b5cf6","font_name":"Poppins"}
+    else:
+        s = {"bank_name": r[0] or "Banca NFC", "logo_url": r[1] or "", "gradient_from": r[2] or "#0ea5e9",
+             "gradient_to": r[3] or "#8b5cf6", "font_name": r[4] or "Poppins"}
+    SETTINGS_CACHE.set("settings", s)
+    return s
+
+def _cache_changed(cache: TTLCache):
+    # scarta subito e di nuovo a fine transazione (una lettura concorrente potrebbe aver rimesso il vecchio valore)
+    cache.clear()
+    uow = _current_uow.get()
+    if uow is not None:
+        uow.on_close.append(cache.clear)
+
+def settings_changed():
+    _cache_changed(SETTINGS_CACHE)
+    data_changed()
 
 def update_settings(bank_name, logo_url, gradient_from, gradient_to, font_name):
     exec_sql("UPDATE settings SET bank_name=?,logo_url=?,gradient_from=?,gradient_to=?,font_name=? WHERE id=1",
              (bank_name.strip(), logo_url.strip(), gradient_from.strip(), gradient_to.strip(), font_name.strip()))
+    settings_changed()
+
+# ---------- CATALOGO ----------
+# Articoli del negozio: upfront è il movimento all'acquisto (+ bonus, - prezzo), weekly l'addebito settimanale
+# (0 = acquisto singolo). Il catalogo intero sta in memoria; le modifiche admin lo invalidano.
+CATALOG_CACHE = TTLCache(1, CATALOG_CACHE_TTL)
+CATALOG_COLUMNS = "code,name,description,upfront,weekly,active,sort"
+
+def get_catalog() -> dict:
+    # code -> articolo, in ordine di vetrina (anche gli articoli disattivati). Condiviso: non modificarlo
+    catalog = CATALOG_CACHE.get("catalog")
+    if catalog is not None:
+        return catalog
+    rows = exec_sql(f"SELECT {CATALOG_COLUMNS} FROM catalog ORDER BY sort, name", fetch="all") or []
+    catalog = {r[0]: {"code": r[0], "name": r[1], "description": r[2] or "", "upfront": int(r[3] or 0),
+                      "weekly": int(r[4] or 0), "active": bool(r[5]), "sort": int(r[6] or 0)} for r in rows}
+    CATALOG_CACHE.set("catalog", catalog)
+    return catalog
+
+def catalog_changed():
+    _cache_changed(CATALOG_CACHE)
+
+def save_catalog_item(code, name, description, upfront, weekly, active, sort):
+    # upfront e weekly in centesimi
+    exec_sql("""INSERT INTO catalog (code, name, description, upfront, weekly, active, sort) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (code) DO UPDATE SET name=excluded.name, description=excluded.description,
+                    upfront=excluded.upfront, weekly=excluded.weekly, active=excluded.active, sort=excluded.sort""",
+             (code, name.strip(), description.strip(), int(upfront), int(weekly), 1 if active else 0, int(sort)))
+    catalog_changed()
+
+def owned_items(card_id: int) -> dict:
+    # item_code -> next_charge_at (0 per gli acquisti singoli) degli articoli attivi della carta
+    shard = shard_of_id(card_id)
+    if shard is None:
+        return {}
+    rows = exec_sql("SELECT item_code, next_charge_at FROM purchases WHERE card_id=? AND active=1", (card_id,),
+                    fetch="all", shard=shard)
+    return {code: int(nxt or 0) for code, nxt in rows or []}
+
+@writes
+def buy_item(token: str, item: dict) -> dict:
+    # acquisto atomico: possesso (idx_purchases_card_owner), movimento iniziale, abbonamento e log insieme.
+    # status: ok, owned, insufficient_funds, not_found
+    now = int(time.time())
+    with atomic("buy", shard=shard_of(token)) as c:
+        c.execute(adapt_sql("SELECT id, balance FROM cards WHERE token=?" + (" FOR UPDATE" if USE_PG else "")), (token,))
+        card = c.fetchone()
+        if not card:
+            return {"status": "not_found"}
+        c.execute(adapt_sql("SELECT 1 FROM purchases WHERE card_id=? AND item_code=? AND active=1"), (card[0], item["code"]))
+        if c.fetchone():
+            return {"status": "owned"}
+        upfront = item["upfront"]
+        if upfront < 0 and card[1] + upfront < 0:
+            return {"status": "insufficient_funds", "balance": card[1]}
+        c.execute(adapt_sql("UPDATE cards SET balance = balance + ? WHERE id=?"), (upfront, card[0]))
+        cards_changed(token)
+        c.execute(adapt_sql("INSERT INTO purchases (card_id,item_code,item_name,weekly_deduction,next_charge_at,started_at,active) "
+                            "VALUES (?,?,?,?,?,?,1)"),
+                  (card[0], item["code"], item["name"], item["weekly"], now + WEEK_SECONDS if item["weekly"] > 0 else 0, now))
+        reason = f"Acquisto {item['name']}"
+        if upfront > 0: reason += f": bonus iniziale +{fmt_cents(upfront, short=True)}"
+        if item["weekly"] > 0: reason += f"; addebito -{fmt_cents(item['weekly'], short=True)}/settimana"
+        row = (now, None, card[0], upfront, reason) if upfront >= 0 else (now, card[0], None, upfront, reason)
+        c.execute(adapt_sql("INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)"), row)
+    return {"status": "ok"}
+
+def fmt_item_terms(item: dict) -> str:
+    parts = []
+    if item["upfront"]: parts.append(f"{'+' if item['upfront'] > 0 else ''}{fmt_cents(item['upfront'], short=True)} subito")
+    if item["weekly"]: parts.append(f"-{fmt_cents(item['weekly'], short=True)}/settimana")
+    return ", ".join(parts) or "gratis"
 
 # ---------- SESSIONS ----------
+_revoked = {}  # token -> revoked_at: le sessioni firmate create fino a quell'istante non valgono più
+
+def _session_signature(payload: str) -> str:
+    mac = hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).decode().rstrip("=")
+
 def create_session_for_token(token: str):
-    sid = secrets.token_urlsafe(24)
     now = int(time.time())
-    exec_sql("INSERT INTO sessions (sid, token, expires, created_at) VALUES (?, ?, ?, ?)"
-             (sid, token, now + SESSION_TTL, now))
+    if SESSION_MODE == "signed":
+        payload = f"{token}.{now}.{now + SESSION_TTL}"
+        return f"{payload}.{_session_signature(payload)}"
+    sid = new_sid(token)
+    _store_session(sid, token, now)
     return sid
 
+@writes
+def _store_session(sid: str, token: str, now: int):
+    exec_sql("INSERT INTO sessions (sid, card_id, expires, created_at) SELECT ?, id, ?, ? FROM cards WHERE token=?",
+             (sid, now + SESSION_TTL, now, token), shard=shard_of(token))
+
 def get_session_info(sid: str):
-    r = exec_sql("SELECT token,expires,created_at FROM sessions WHERE sid=?", (sid,), fetch="one")
+    now = int(time.time())
+    if SESSION_MODE == "signed":
+        parts = sid.split(".")
+        if len(parts) != 4:
+            return None
+        token, created_at, expires, sig = parts
+        if not hmac.compare_digest(sig, _session_signature(f"{token}.{created_at}.{expires}")):
+            return None
+        try: created_at, expires = int(created_at), int(expires)
+        except ValueError: return None
+        if now > expires or created_at <= _revoked.get(token, -1):
+            return None
+        return {"token": token, "expires": expires, "created_at": created_at}
+    r = exec_sql("SELECT c.token, s.expires, s.created_at FROM sessions s JOIN cards c ON c.id = s.card_id WHERE s.sid=?",
+                 (sid,), fetch="one", shard=shard_of_sid(sid))
     if not r: return None
     token, expires, created_at = r
-    now = int(time.time())
     if now > (expires or 0):
-        exec_sql("DELETE FROM sessions WHERE sid=?", (sid,))
-        return None
+        return None  # le righe scadute le toglie il job sweep_sessions
     return {"token": token, "expires": int(expires or 0), "created_at": int(created_at or 0)}
 
+def get_session_card(sid: str):
+    # sessione + carta in una sola lettura: (session, card), con None per le parti mancanti
+    if SESSION_MODE == "signed":
+        session = get_session_info(sid)
+        return session, (get_by_token(session["token"]) if session else None)
+    generation = _card_generation
+    r = exec_sql(f"""SELECT c.token, s.expires, s.created_at, {', '.join('c.' + col for col in CARD_COLUMNS.split(','))}
+                     FROM sessions s LEFT JOIN cards c ON c.id = s.card_id WHERE s.sid=?""", (sid,), fetch="one",
+                 shard=shard_of_sid(sid))
+    if not r or int(time.time()) > (r[1] or 0):
+        return None, None
+    session = {"token": r[0], "expires": int(r[1] or 0), "created_at": int(r[2] or 0)}
+    card = _card_row(r[3:]) if r[3] is not None else None
+    if card and generation == _card_generation and _card_cacheable(card["token"]):
+        _cache_card(card)
+        card = dict(card)
+    return session, card
+
 def delete_session(sid: str):
-    exec_sql("DELETE FROM sessions WHERE sid=?", (sid,))
+    if SESSION_MODE != "signed":
+        exec_sql("DELETE FROM sessions WHERE sid=?", (sid,), shard=shard_of_sid(sid))
+
+def revoke_sessions(token: str):
+    # chiude tutte le sessioni aperte della carta (reset binding, eliminazione)
+    now = int(time.time())
+    if SESSION_MODE == "signed":
+        exec_sql("""INSERT INTO session_revocations (token, revoked_at) VALUES (?, ?)
+                    ON CONFLICT (token) DO UPDATE SET revoked_at = excluded.revoked_at""", (token, now))
+        _revoked[token] = now
+    else:
+        exec_sql("DELETE FROM sessions WHERE card_id = (SELECT id FROM cards WHERE token=?)", (token,),
+                 shard=shard_of(token))
+
+def load_revocations():
+    # solo le revoche più recenti di SESSION_TTL contano: le sessioni più vecchie sono comunque scadute
+    global _revoked
+    cutoff = int(time.time()) - SESSION_TTL
+    exec_sql("DELETE FROM session_revocations WHERE revoked_at < ?", (cutoff,))
+    rows = exec_sql("SELECT token, revoked_at FROM session_revocations", fetch="all") or []
+    _revoked = {token: int(revoked_at) for token, revoked_at in rows}
+    return {"revoked": len(_revoked)}
+
+def sweep_sessions():
+    for shard in range(SHARDS):
+        exec_sql("DELETE FROM sessions WHERE expires < ?", (int(time.time()),), shard=shard)
+    return {"swept_at": int(time.time())}
 
 # ---------- COOKIE / RENDER ----------
 def is_https(request: Request) -> bool:
@@ -262,16 +1962,62 @@ def set_cookie(resp, name, value, max_age=None, httponly=False, request: Request
     resp.set_cookie(name, value, max_age=max_age, samesite="Lax", httponly=httponly,
                     secure=is_https(request) if request else False, path="/")
 
-def render_page(inner_html: str, title: str = "") -> HTMLResponse:
+FRAGMENT_CACHE = TTLCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+
+def fragment(key: tuple, render) -> str:
+    # HTML già renderizzato per (key, versione dei dati); render() viene chiamata solo se manca.
+    # La versione si legge prima di render(): una scrittura concorrente porta a una chiave nuova, mai a una vecchia.
+    full_key = key + (data_version(),)
+    html = FRAGMENT_CACHE.get(full_key)
+    if html is None:
+        html = render()
+        FRAGMENT_CACHE.set(full_key, html)
+    return html
+
+async def afragment(key: tuple, render) -> str:
+    # come fragment, per le route async: render è una coroutine function
+    full_key = key + (data_version(),)
+    html = FRAGMENT_CACHE.get(full_key)
+    if html is None:
+        html = await render()
+        FRAGMENT_CACHE.set(full_key, html)
+    return html
+
+def page_etag(*parts) -> str:
+    # ETag debole: versione dei dati + ciò che cambia la pagina a parità di dati (visitatore, chiave, host)
+    h = hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()[:16] if parts else "0"
+    return f'W/"{data_version()}-{h}"'
+
+def not_modified(request: Request, etag: str):
+    # risposta 304 se il client ha già questa versione, altrimenti None
+    match = request.headers.get("if-none-match", "")
+    if match and (match.strip() == "*" or etag in [m.strip() for m in match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
+
+def with_etag(resp, etag: str):
+    # il browser tiene la pagina ma la riconvalida sempre (dati personali / chiave admin: mai cache condivise)
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+_page_shell = (None, None)  # (settings usate, parti pre-renderizzate)
+
+def page_shell():
+    # pagina base (head, CSS, header) renderizzata una volta per versione delle impostazioni, in byte:
+    # ogni risposta concatena solo prefisso + titolo + corpo + suffisso
+    global _page_shell
     s = get_settings()
-    title_text = title or s["bank_name"]
+    if _page_shell[0] is s:
+        return _page_shell[1]
     font = s["font_name"] or "Poppins"
     google_font = font.replace(" ", "+")
     logo_html = f"<img src='{html_lib.escape(s['logo_url'])}' alt='' style='height:28px;margin-right:10px;border-radius:6px'>" if s["logo_url"] else ""
     header_name = html_lib.escape(s["bank_name"])
-    html = f"""<!doctype html><html lang="it"><head>
+    head = """<!doctype html><html lang="it"><head>
       <meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
-      <title>{html_lib.escape(title_text)}</title>
+      <title>"""
+    middle = f"""</title>
       <link href="https://fonts.googleapis.com/css2?family={google_font}:wght@400;600;700&display=swap" rel="stylesheet">
       <style>
         :root {{ --grad-from:{html_lib.escape(s["gradient_from"])}; --grad-to:{html_lib.escape(s["gradient_to"])}; }}
@@ -297,37 +2043,994 @@ def render_page(inner_html: str, title: str = "") -> HTMLResponse:
           <div class="brand">{logo_html}<span>{header_name}</span></div>
           <div style="display:flex;gap:8px"><a class="btn" href="/">Home</a></div>
         </div>
-        <div class="content">{inner_html}</div>
+        <div class="content">"""
+    suffix = """</div>
       </div></body></html>"""
-    return HTMLResponse(html)
+    parts = (head.encode(), middle.encode(), suffix.encode(), html_lib.escape(s["bank_name"]).encode())
+    _page_shell = (s, parts)
+    return parts
 
-def fmt_bonsaura(a: float) -> str:
-    try: return f"{float(a):.2f} Bonsaura"
-    except: return f"{a} Bonsaura"
+def render_page(inner_html: str, title: str = "") -> HTMLResponse:
+    head, middle, suffix, default_title = page_shell()
+    title_b = html_lib.escape(title).encode() if title else default_title
+    return HTMLResponse(b"".join((head, title_b, middle, inner_html.encode(), suffix)))
+
+async def arender_page(inner_html: str, title: str = "") -> HTMLResponse:
+    # per le route async: con le impostazioni scadute in cache la rilettura va nel threadpool, non nel loop
+    if SETTINGS_CACHE.get("settings") is None:
+        await run_in_threadpool(_detached, get_settings)
+    return render_page(inner_html, title)
+
+# ---------- DB ASINCRONO ----------
+# Copie async degli helper usati dalle route del percorso carta: la richiesta aspetta il DB senza occupare un
+# thread del threadpool. Ogni chiamata prende una connessione da APOOL e fa commit subito, fuori dalla unit of
+# work della richiesta: dopo una scrittura cache, classifica e versione dei dati si aggiornano come per una
+# scrittura già committata. Senza driver async (USE_ASYNC_DB falso) ogni copia chiama quella sincrona nel
+# threadpool, dentro la unit of work della richiesta.
+class AsyncPool:
+    # al massimo `size` connessioni aperte; chi arriva oltre aspetta fino a `timeout` (poi PoolTimeout)
+    def __init__(self, size: int, timeout: float, url: str = None):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.url = url or DATABASE_URL  # Postgres: primario o replica
+        self._sem = None  # creato al primo uso, nel loop dell'app
+        self._idle = []
+        self._open = 0
+        self._counters = dict.fromkeys(("checkouts", "created", "reused", "discarded", "waits", "timeouts"), 0)
+
+    async def _connect(self):
+        if USE_PG:
+            return await asyncpg.connect(self.url)
+        conn = await aiosqlite.connect(DB_FILE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        if SQLITE_PROFILE:
+            for pragma in sqlite_pragmas():
+                await conn.execute(pragma)
+        return conn
+
+    async def acquire(self):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.size)
+        self._counters["checkouts"] += 1
+        if self._sem.locked():
+            self._counters["waits"] += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._counters["timeouts"] += 1
+            raise PoolTimeout(f"Nessuna connessione async libera entro {self.timeout}s")
+        if self._idle:
+            self._counters["reused"] += 1
+            return self._idle.pop()
+        try:
+            conn = await self._connect()
+        except BaseException:
+            self._sem.release()
+            raise
+        self._open += 1
+        self._counters["created"] += 1
+        return conn
+
+    async def release(self, conn, broken: bool = False):
+        try:
+            if not broken:
+                self._idle.append(conn)
+                return
+            self._open -= 1
+            self._counters["discarded"] += 1
+            try: await conn.close()
+            except Exception: pass
+        finally:
+            self._sem.release()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        self._open -= len(idle)
+        for conn in idle:
+            await conn.close()
+        self._sem = None
+
+    def stats(self) -> dict:
+        s = dict(self._counters)
+        s.update(driver="asyncpg" if USE_PG else "aiosqlite", enabled=USE_ASYNC_DB, size=self.size,
+                 open=self._open, idle=len(self._idle))
+        return s
+
+APOOL = AsyncPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+AREPLICA_POOLS = [AsyncPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, url) for url in DATABASE_READ_URLS] if USE_PG else []
+
+async def areplica_acquire():
+    # come replica_acquire (stesse repliche escluse), per le letture async
+    for i in _replica_candidates():
+        try:
+            return AREPLICA_POOLS[i], await AREPLICA_POOLS[i].acquire()
+        except PoolTimeout:
+            raise
+        except Exception as e:
+            _replica_down(i, e)
+    return None
+
+@asynccontextmanager
+async def _aconn(pool: AsyncPool = None, conn=None):
+    # connessione async in autocommit (conn: già presa da pool); dopo un errore viene chiusa (mai una transazione a
+    # metà nel pool)
+    pool = pool or APOOL
+    conn = conn or await pool.acquire()
+    try:
+        yield conn
+    except BaseException:
+        await pool.release(conn, broken=True)
+        raise
+    await pool.release(conn)
+
+@asynccontextmanager
+async def aatomic():
+    # transazione su una connessione async: BEGIN IMMEDIATE su SQLite (come atomic), commit all'uscita
+    async with _aconn() as conn:
+        if USE_PG:
+            async with conn.transaction():
+                yield conn
+            return
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            raise
+        await conn.commit()
+
+def _async_sql(sql: str) -> str:
+    # segnaposto "?" -> "$1, $2, ..." per asyncpg
+    if not USE_PG:
+        return sql
+    parts = sql.split("?")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+async def _arun(conn, sql: str, params=(), fetch=None):
+    # come exec_sql su una connessione async; senza fetch restituisce le righe toccate
+    if USE_PG:
+        sql = _async_sql(sql)
+        if fetch == "one":
+            r = await conn.fetchrow(sql, *params)
+            return tuple(r) if r is not None else None
+        if fetch == "all":
+            return [tuple(r) for r in await conn.fetch(sql, *params)]
+        status = await conn.execute(sql, *params)  # es. "UPDATE 1", "INSERT 0 1"
+        count = status.rsplit(" ", 1)[-1]
+        return int(count) if count.isdigit() else 0
+    # aiosqlite: ogni await è un passaggio al thread della connessione, quindi uno solo per istruzione
+    if fetch == "one":
+        rows = await conn.execute_fetchall(sql, params)
+        return rows[0] if rows else None
+    if fetch == "all":
+        return await conn.execute_fetchall(sql, params)
+    return (await conn.execute(sql, params)).rowcount
+
+async def _acards_committed(*tokens):
+    # dopo una scrittura async già committata; la classifica rilegge i saldi con il driver sincrono
+    global _card_generation
+    note_write()
+    tokens = [t for t in tokens if t]
+    for token in tokens:
+        _card_generation += 1
+        CARD_CACHE_STORE.pop(("t", token))
+    await run_in_threadpool(_detached, cards_committed, tokens)
+
+def async_or_sync(sync_fn):
+    # la copia async decorata usa sync_fn nel threadpool quando l'accesso async non è disponibile;
+    # con il writer SQLite attivo le scritture (@writes) vanno in coda senza occupare un thread
+    intent = getattr(sync_fn, "write_intent", None)
+
+    def decorate(async_fn):
+        @functools.wraps(async_fn)
+        async def wrapper(*args, **kwargs):
+            if intent is not None and WRITER is not None:
+                note_write()
+                return await asyncio.wrap_future(WRITER.submit(intent, *args, **kwargs))
+            if not USE_ASYNC_DB:
+                return await run_in_threadpool(sync_fn, *args, **kwargs)
+            return await async_fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@async_or_sync(exec_sql)
+async def aexec_sql(sql: str, params=(), fetch=None):
+    async with _aconn() as conn:
+        return await _arun(conn, sql, params, fetch)
+
+@async_or_sync(read_sql)
+async def aread_sql(sql: str, params=(), fetch="all"):
+    # come read_sql: una replica a turno, salvo scritture recenti della richiesta o del browser
+    uow = _current_uow.get()
+    picked = None if uow is not None and (uow.primary_reads or uow.wrote) else await areplica_acquire()
+    if picked is None:
+        return await aexec_sql(sql, params, fetch)
+    async with _aconn(*picked) as conn:
+        return await _arun(conn, sql, params, fetch)
+
+@async_or_sync(read_shards)
+async def aread_shards(sql: str, params=(), key=None):
+    # l'accesso async c'è solo senza sharding: un solo DB
+    return await aread_sql(sql, params)
+
+@async_or_sync(get_by_token)
+async def aget_by_token(token: str):
+    if CARD_CACHE:
+        card = CARD_CACHE_STORE.get(("t", token))
+        if card is not None:
+            return dict(card)
+    generation = _card_generation
+    card = _card_row(await aexec_sql(f"SELECT {CARD_COLUMNS} FROM cards WHERE token=?", (token,), fetch="one"))
+    if card and generation == _card_generation and _card_cacheable(token):
+        _cache_card(card)
+        return dict(card)
+    return card
+
+@async_or_sync(get_by_name)
+async def aget_by_name(name: str):
+    if CARD_CACHE:
+        token = CARD_CACHE_STORE.get(("n", name))
+        if token is not None:
+            card = await aget_by_token(token)
+            if card and card["name"] == name:
+                return card
+            CARD_CACHE_STORE.pop(("n", name))
+    generation = _card_generation
+    card = _card_row(await aexec_sql(f"SELECT {CARD_COLUMNS} FROM cards WHERE name=?", (name,), fetch="one"))
+    if card and generation == _card_generation and _card_cacheable(card["token"]):
+        _cache_card(card)
+        return dict(card)
+    return card
+
+@async_or_sync(log_transaction)
+async def alog_transaction(from_id, to_id, amount, reason):
+    await aexec_sql("INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)",
+                    (int(time.time()), from_id, to_id, int(amount), reason))
+    note_write()
+    _bump_data_version()
+
+@async_or_sync(transfer_funds)
+async def atransfer_funds(from_token: str, to_name: str, amount: int, reason: str) -> dict:
+    # stessa logica di transfer_funds (addebito condizionato, accredito e log in una transazione)
+    amount = int(amount)
+    async with aatomic() as conn:
+        if USE_PG:
+            rows = await _arun(conn, "SELECT token, name, id FROM cards WHERE token=? OR name=? ORDER BY id FOR UPDATE",
+                               (from_token, to_name), fetch="all")
+        else:
+            rows = await _arun(conn, "SELECT token, name, id FROM cards WHERE token=? OR name=?",
+                               (from_token, to_name), fetch="all")
+        sender = next((r for r in rows if r[0] == from_token), None)
+        dest = next((r for r in rows if r[1] == to_name), None)
+        if not sender:
+            return {"status": "sender_not_found"}
+        if not dest:
+            return {"status": "not_found"}
+        if await _arun(conn, "UPDATE cards SET balance = balance - ? WHERE id=? AND balance >= ?",
+                       (amount, sender[2], amount)) != 1:
+            r = await _arun(conn, "SELECT balance FROM cards WHERE id=?", (sender[2],), fetch="one")
+            return {"status": "insufficient_funds", "balance": r[0]}
+        await _arun(conn, "UPDATE cards SET balance = balance + ? WHERE id=?", (amount, dest[2]))
+        await _arun(conn, "INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)",
+                    (int(time.time()), sender[2], dest[2], amount, reason))
+    await _acards_committed(from_token, dest[0])
+    return {"status": "ok", "to_name": dest[1], "amount": amount}
+
+@async_or_sync(get_recent_transactions)
+async def aget_recent_transactions(card_id: int, limit: int = 10, before=None):
+    sql, params = _recent_transactions_query(card_id, limit, before)
+    return _transaction_rows(await aread_sql(sql, params))
+
+@async_or_sync(get_transactions_page)
+async def aget_transactions_page(card_id: int, limit: int = 20, before: str = ""):
+    rows = await aget_recent_transactions(card_id, limit + 1, parse_cursor(before))
+    page = rows[:limit]
+    return page, (f"{page[-1]['ts']}-{page[-1]['id']}" if len(rows) > limit else None)
+
+async def acreate_session_for_token(token: str):
+    if SESSION_MODE == "signed":
+        return create_session_for_token(token)  # solo firma HMAC, niente DB
+    now = int(time.time())
+    sid = new_sid(token)
+    await _astore_session(sid, token, now)
+    return sid
+
+@async_or_sync(_store_session)
+async def _astore_session(sid: str, token: str, now: int):
+    # CAST: asyncpg non deduce il tipo dei parametri nella lista di una SELECT (sarebbero text)
+    await aexec_sql("""INSERT INTO sessions (sid, card_id, expires, created_at)
+                       SELECT ?, id, CAST(? AS BIGINT), CAST(? AS BIGINT) FROM cards WHERE token=?""",
+                    (sid, now + SESSION_TTL, now, token))
+
+@async_or_sync(get_session_info)
+async def aget_session_info(sid: str):
+    if SESSION_MODE == "signed":
+        return get_session_info(sid)
+    r = await aexec_sql("SELECT c.token, s.expires, s.created_at FROM sessions s JOIN cards c ON c.id = s.card_id WHERE s.sid=?",
+                        (sid,), fetch="one")
+    if not r or int(time.time()) > (r[1] or 0):
+        return None
+    return {"token": r[0], "expires": int(r[1] or 0), "created_at": int(r[2] or 0)}
+
+@async_or_sync(get_session_card)
+async def aget_session_card(sid: str):
+    if SESSION_MODE == "signed":
+        session = get_session_info(sid)
+        return session, (await aget_by_token(session["token"]) if session else None)
+    generation = _card_generation
+    r = await aexec_sql(f"""SELECT c.token, s.expires, s.created_at, {', '.join('c.' + col for col in CARD_COLUMNS.split(','))}
+                            FROM sessions s LEFT JOIN cards c ON c.id = s.card_id WHERE s.sid=?""", (sid,), fetch="one")
+    if not r or int(time.time()) > (r[1] or 0):
+        return None, None
+    session = {"token": r[0], "expires": int(r[1] or 0), "created_at": int(r[2] or 0)}
+    card = _card_row(r[3:]) if r[3] is not None else None
+    if card and generation == _card_generation and _card_cacheable(card["token"]):
+        _cache_card(card)
+        card = dict(card)
+    return session, card
 
 # ---------- RECURRING CHARGES ----------
-def apply_recurring_charges(token: str):
+def bill_due_subscriptions(now: int = None, batch: int = None) -> dict:
+    # Una passata su tutti gli abbonamenti attivi scaduti (indice idx_purchases_due), a blocchi: per ogni
+    # abbonamento gli addebiti arretrati si contano in forma chiusa, poi saldi, scadenze e movimenti del blocco
+    # vanno al DB con executemany in una sola transazione. Su Postgres SKIP LOCKED lascia le righe già prese
+    # da un altro worker; su SQLite BEGIN IMMEDIATE serializza le passate.
+    now = int(time.time()) if now is None else int(now)
+    batch = batch or BILLING_BATCH
+    lock = " FOR UPDATE OF p SKIP LOCKED" if USE_PG else ""
+    subscriptions = charges_total = 0
+    amount_total = 0
+    for shard in range(SHARDS):  # ogni carta ha abbonamenti e movimenti nel suo shard
+        while True:
+            with atomic("billing", shard=shard) as c:
+                c.execute(adapt_sql(f"""SELECT p.id, p.card_id, cd.token, p.item_name, p.weekly_deduction, p.next_charge_at
+                                        FROM purchases p LEFT JOIN cards cd ON cd.id = p.card_id
+                                        WHERE p.active = 1 AND p.next_charge_at > 0 AND p.next_charge_at <= ?
+                                        ORDER BY p.next_charge_at LIMIT ?{lock}"""), (now, batch))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                debits, schedule, log = {}, [], []
+                for pid, card_id, token, item_name, weekly, next_ts in rows:
+                    charges = (now - int(next_ts)) // WEEK_SECONDS + 1
+                    amount = int(weekly) * charges
+                    debits[(card_id, token)] = debits.get((card_id, token), 0) + amount
+                    schedule.append((int(next_ts) + charges * WEEK_SECONDS, pid))
+                    log.append((now, card_id, None, -amount,
+                                f"Addebito {item_name} (-{fmt_cents(weekly, short=True)}/settimana) x{charges}"))
+                    charges_total += charges
+                    amount_total += amount
+                # carte in ordine di id, come transfer_funds: su Postgres niente deadlock tra fatturazione e trasferimenti
+                c.executemany(adapt_sql("UPDATE cards SET balance = balance - ? WHERE id=?"),
+                              [(amount, card_id) for (card_id, _), amount in sorted(debits.items())])
+                c.executemany(adapt_sql("UPDATE purchases SET next_charge_at=? WHERE id=?"), schedule)
+                c.executemany(adapt_sql("INSERT INTO transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)"), log)
+                cards_changed(*(token for _, token in debits if token))
+                subscriptions += len(rows)
+            if len(rows) < batch:
+                break
+    return {"subscriptions": subscriptions, "charges": charges_total, "amount": amount_total}
+
+# ---------- SIMULAZIONE ----------
+# Proiezione dei saldi con gli abbonamenti attivi (es. prima di cambiare un prezzo settimanale): carte e
+# abbonamenti in array NumPy, una settimana alla volta con operazioni vettoriali. NumPy serve solo qui.
+# Importi in centesimi (int64); le somme per carta di bincount sono float64, esatte fino a 2**53 centesimi.
+
+def project_balances(balance, card_idx, weekly, next_ts, now: int, weeks: int, threshold: int = SHOP_THRESHOLD):
+    # balance: saldo per carta; card_idx/weekly/next_ts: un elemento per abbonamento (indice della carta).
+    # Settimana 0 = addebiti arretrati (come la prossima passata di fatturazione), poi ogni abbonamento addebita
+    # una volta per settimana a partire dalla sua prima scadenza. Ritorna saldi finali, settimana del primo
+    # passaggio sotto zero / sotto soglia (-1 = mai) e numero di carte negative a ogni settimana.
+    import numpy as np
+    n = len(balance)
+    bal = np.asarray(balance, dtype=np.int64).copy()
+    card_idx = np.asarray(card_idx, dtype=np.int64)
+    weekly = np.asarray(weekly, dtype=np.int64)
+    next_ts = np.asarray(next_ts, dtype=np.int64)
+    overdue = next_ts <= now
+    missed = np.where(overdue, (now - next_ts) // WEEK_SECONDS + 1, 0)
+    bal -= np.bincount(card_idx, weights=weekly * missed, minlength=n).astype(np.int64)
+    # prima settimana (>= 1) in cui l'abbonamento addebita: da lì il costo settimanale della carta sale di weekly
+    start = np.where(overdue, 1, -((now - next_ts) // WEEK_SECONDS))
+    order = np.argsort(start, kind="stable")
+    start, card_idx, weekly = start[order], card_idx[order], weekly[order]
+    bounds = np.searchsorted(start, np.arange(1, weeks + 2))
+    below_zero, below_threshold = bal < 0, bal < threshold
+    cross_zero = np.full(n, -1, dtype=np.int32)
+    cross_threshold = np.full(n, -1, dtype=np.int32)
+    rate = np.zeros(n, dtype=np.int64)
+    negative = [int(below_zero.sum())]
+    for week in range(1, weeks + 1):
+        lo, hi = bounds[week - 1], bounds[week]
+        if hi > lo:
+            rate += np.bincount(card_idx[lo:hi], weights=weekly[lo:hi], minlength=n).astype(np.int64)
+        bal -= rate
+        now_zero, now_threshold = bal < 0, bal < threshold
+        cross_zero[now_zero & ~below_zero] = week
+        cross_threshold[now_threshold & ~below_threshold] = week
+        below_zero, below_threshold = below_zero | now_zero, below_threshold | now_threshold
+        negative.append(int(now_zero.sum()))
+    return bal, cross_zero, cross_threshold, negative
+
+def simulate_balances(weeks: int = 52, prices: dict = None, limit: int = 50) -> dict:
+    # prices: item_code -> nuovo addebito settimanale (centesimi) da simulare al posto di quello attuale
+    import numpy as np
+    t0 = time.perf_counter()
     now = int(time.time())
-    r = exec_sql("SELECT name FROM cards WHERE token=?", (token,), fetch="one")
-    from_name = r[0] if r else ""
-    conn = get_conn(); c = conn.cursor()
-    c.execute(adapt_sql("SELECT id,item_name,weekly_deduction,next_charge_at FROM purchases WHERE token=? AND active=1"), (token,))
-    rows = c.fetchall()
-    for pid, item_name, weekly, next_ts in rows:
-        ts = int(next_ts or 0)
-        charges = 0
-        while ts and ts <= now:
-            charges += 1
-            ts += WEEK_SECONDS
-        if charges > 0:
-            amount = float(weekly) * charges
-            c.execute(adapt_sql("UPDATE cards SET balance = balance - ? WHERE token=?"), (amount, token))
-            c.execute(adapt_sql("UPDATE purchases SET next_charge_at=? WHERE id=?"), (ts, pid))
-            c.execute(adapt_sql(
-                "INSERT INTO transactions (ts,from_token,from_name,to_token,to_name,amount,reason) VALUES (?,?,?,?,?,?,?)"),
-                (now, token, from_name, None, "Negozio", -amount,
-                 f"Addebito {item_name} (-{weekly:.0f}/settimana) x{charges}"))
-    conn.commit(); conn.close()
+    cards, subs = [], []
+    for shard in range(SHARDS):  # id crescenti anche tra shard: searchsorted vale sulla concatenazione
+        with read_conn(shard) as conn:  # carte e abbonamenti dalla stessa connessione (stessa replica)
+            c = conn.cursor()
+            c.execute("SELECT id, name, balance FROM cards ORDER BY id")
+            cards += c.fetchall()
+            c.execute("""SELECT c.id, p.item_code, p.weekly_deduction, p.next_charge_at
+                         FROM purchases p JOIN cards c ON c.id = p.card_id
+                         WHERE p.active = 1 AND p.next_charge_at > 0""")
+            subs += c.fetchall()
+    ids = np.fromiter((r[0] for r in cards), dtype=np.int64, count=len(cards))
+    balance = np.fromiter((r[2] or 0 for r in cards), dtype=np.int64, count=len(cards))
+    card_idx = np.searchsorted(ids, np.fromiter((r[0] for r in subs), dtype=np.int64, count=len(subs)))
+    weekly = np.fromiter((r[2] or 0 for r in subs), dtype=np.int64, count=len(subs))
+    next_ts = np.fromiter((r[3] for r in subs), dtype=np.int64, count=len(subs))
+    if prices:
+        codes = np.array([r[1] for r in subs], dtype=object)
+        for code, price in prices.items():
+            weekly[codes == code] = int(price)
+    loaded = time.perf_counter()
+    final, cross_zero, cross_threshold, negative = project_balances(balance, card_idx, weekly, next_ts, now, weeks)
+    done = time.perf_counter()
+
+    def report(cross):
+        hit = np.flatnonzero(cross > 0)
+        hit = hit[np.lexsort((final[hit], cross[hit]))][:limit]  # prima i più vicini
+        return {"count": int((cross > 0).sum()),
+                "cards": [{"name": cards[i][1], "balance": int(balance[i]), "week": int(cross[i]),
+                           "final": int(final[i])} for i in hit]}
+
+    return {"weeks": weeks, "cards": len(cards), "subscriptions": len(subs), "prices": prices or {},
+            "negative_now": int((balance < 0).sum()), "negative_by_week": negative,
+            "cross_zero": report(cross_zero), "cross_threshold": report(cross_threshold),
+            "load_seconds": round(loaded - t0, 3), "project_seconds": round(done - loaded, 3)}
+
+def parse_prices(text: str) -> dict:
+    # "moccolone=4, vip=6.5" -> {"moccolone": 400, "vip": 650} (centesimi)
+    prices = {}
+    for part in text.replace(",", " ").split():
+        code, _, price = part.partition("=")
+        prices[code.strip().lower()] = to_cents(price)
+    return prices
+
+# ---------- ARCHIVIO ----------
+# Segmenti in sola aggiunta: seg-<ts_min>-<id_min>.ndjson.gz (righe complete in ordine (ts, id)) con accanto
+# .cards.gz (i token delle carte presenti). index.jsonl ha una riga per segmento (file, righe, intervalli
+# ts/id): si scrive dopo il segmento e prima di cancellare le righe dal DB. Se il processo si ferma tra le due
+# cose, la passata successiva ricancella le righe dell'ultimo segmento prima di proseguire. Gli importi sono in
+# centesimi nei segmenti con "unit": "cents"; quelli scritti prima della migrazione 8 si convertono in lettura.
+# Con lo sharding ogni shard ha i suoi segmenti (seg-<ts_min>-<id_min>-s<shard>, "shard" nell'indice) e vi
+# finiscono solo le righe principali: le copie mirror=1 si cancellano e basta.
+ARCHIVE_FIELDS = ["id", "ts", "from_token", "from_name", "to_token", "to_name", "amount", "reason"]
+
+def _archive_path(name: str) -> str:
+    return os.path.join(ARCHIVE_DIR, name)
+
+def _write_file(name: str, data: bytes):
+    # scrittura atomica: file temporaneo, fsync, rename
+    tmp = _archive_path(name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, _archive_path(name))
+
+def archive_segments() -> list:
+    try:
+        with open(_archive_path("index.jsonl"), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def _segment_rows(segment: dict):
+    cents = segment.get("unit") == "cents"
+    with gzip.open(_archive_path(segment["file"]), "rt", encoding="utf-8") as f:
+        for line in f:
+            r = json.loads(line)
+            if not cents:
+                r["amount"] = to_cents(r["amount"])
+            yield r
+
+def _segment_cards(segment: dict) -> set:
+    with gzip.open(_archive_path(segment["cards"]), "rt", encoding="utf-8") as f:
+        return set(f.read().split())
+
+def _delete_archived(ids: list, ts_max: int, shard: int = 0):
+    # "ts <= ts_max": mai righe più recenti del segmento, anche con id ripartiti da capo (DB ricreato)
+    with atomic("archive_delete", shard=shard) as c:
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            c.execute(adapt_sql(f"DELETE FROM transactions WHERE ts <= ? AND id IN ({','.join('?' * len(chunk))})"),
+                      (ts_max,) + tuple(chunk))
+    data_changed()
+
+@contextmanager
+def _archive_lock():
+    # un solo archiviatore alla volta anche con più worker; None se un altro processo sta già archiviando
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(_archive_path(".lock"), "w") as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+        yield True
+
+def archive_transactions(older_than_days: float = None, batch: int = None) -> dict:
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    batch = batch or ARCHIVE_BATCH
+    cutoff = int(time.time() - days * 86400)
+    archived = segments = 0
+    with _archive_lock() as locked:
+        if not locked:
+            return {"skipped": "archiviazione già in corso"}
+        done = archive_segments()
+        if done:
+            # righe dell'ultimo segmento rimaste nel DB (interruzione dopo la scrittura del segmento)
+            _delete_archived([r["id"] for r in _segment_rows(done[-1])], done[-1]["ts_max"], done[-1].get("shard", 0))
+        for shard in range(SHARDS):
+            canonical = ""
+            if SHARDS > 1:
+                exec_sql("DELETE FROM transactions WHERE mirror = 1 AND ts < ?", (cutoff,), shard=shard)
+                canonical = " AND t.mirror = 0"
+            while True:
+                # nei segmenti token e nomi delle carte si scrivono per esteso: restano leggibili anche senza la tabella cards
+                rows = exec_sql(f"""SELECT t.id, t.ts, t.from_id, f.token, f.name, t.to_id, d.token, d.name, t.amount, t.reason
+                                    FROM transactions t LEFT JOIN cards f ON f.id = t.from_id LEFT JOIN cards d ON d.id = t.to_id
+                                    WHERE t.ts < ?{canonical} ORDER BY t.ts, t.id LIMIT ?""", (cutoff, batch),
+                                fetch="all", shard=shard) or []
+                if not rows:
+                    break
+                if SHARDS > 1:
+                    refs = _card_refs([r[i] for r in rows for i in (2, 5) if r[i] is not None and r[i + 1] is None])
+                    rows = [tuple(r[:3]) + (tuple(r[3:5]) if r[3] is not None else refs.get(r[2], (None, None)))
+                            + tuple(r[5:6]) + (tuple(r[6:8]) if r[6] is not None else refs.get(r[5], (None, None)))
+                            + tuple(r[8:]) for r in rows]
+                rows = [(r[0], r[1], r[3], party_name(r[2], r[4]), r[6], party_name(r[5], r[7]), r[8], r[9]) for r in rows]
+                name = f"seg-{rows[0][1]}-{rows[0][0]}" + (f"-s{shard}" if shard else "")
+                body = "".join(json.dumps(dict(zip(ARCHIVE_FIELDS, r)), ensure_ascii=False) + "\n" for r in rows)
+                cards = sorted({t for r in rows for t in (r[2], r[4]) if t})
+                _write_file(name + ".ndjson.gz", gzip.compress(body.encode("utf-8")))
+                _write_file(name + ".cards.gz", gzip.compress("\n".join(cards).encode("utf-8")))
+                entry = {"file": name + ".ndjson.gz", "cards": name + ".cards.gz", "rows": len(rows), "unit": "cents",
+                         "ts_min": rows[0][1], "ts_max": rows[-1][1],
+                         "id_min": min(r[0] for r in rows), "id_max": max(r[0] for r in rows)}
+                if SHARDS > 1:
+                    entry["shard"] = shard
+                with open(_archive_path("index.jsonl"), "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                _delete_archived([r[0] for r in rows], rows[-1][1], shard)
+                archived += len(rows)
+                segments += 1
+                if len(rows) < batch:
+                    break
+    return {"archived": archived, "segments": segments, "cutoff": cutoff}
+
+def _archived_rows(segments: list, since, until, token):
+    for segment in segments:
+        if (since is not None and segment["ts_max"] < since) or (until is not None and segment["ts_min"] >= until):
+            continue
+        if token and token not in _segment_cards(segment):
+            continue
+        for r in _segment_rows(segment):
+            if (since is not None and r["ts"] < since) or (until is not None and r["ts"] >= until):
+                continue
+            if token and token not in (r["from_token"], r["to_token"]):
+                continue
+            yield (r["id"], r["ts"], r["from_name"], r["to_name"], r["amount"], r["reason"])
+
+def iter_archived(since: int = None, until: int = None, token: str = None, batch: int = 2000):
+    # blocchi di righe archiviate nello stesso formato di iter_transactions; si aprono solo i segmenti che
+    # si sovrappongono all'intervallo e, con un filtro carta, che contengono la carta. I segmenti di shard
+    # diversi si fondono in ordine (ts, id).
+    by_shard = {}
+    for segment in archive_segments():
+        by_shard.setdefault(segment.get("shard", 0), []).append(segment)
+    streams = [_archived_rows(segments, since, until, token) for segments in by_shard.values()]
+    rows = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda r: (r[1], r[0]))
+    yield from _batched(rows, batch)
+
+def _batched(rows, batch: int):
+    out = []
+    for r in rows:
+        out.append(r)
+        if len(out) >= batch:
+            yield out
+            out = []
+    if out:
+        yield out
+
+# ---------- EXPORT ----------
+# Export delle transazioni in streaming: una connessione dedicata (la risposta viene inviata dopo la fine della
+# richiesta), righe lette a blocchi con un cursore lato server su Postgres e fetchmany su SQLite.
+# Importi come testo decimale esatto ("12.50"), come li mostra la pagina.
+EXPORT_BATCH = 2000
+EXPORT_COLUMNS = ["id", "ts", "time", "from_name", "to_name", "amount", "reason"]
+
+def parse_day(day: str):
+    # "YYYY-MM-DD" (ora locale) -> epoch dell'inizio del giorno; None se vuoto
+    if not day: return None
+    return int(time.mktime(time.strptime(day, "%Y-%m-%d")))
+
+def _stream_query(shard: int, sql: str, params, batch: int):
+    # righe una alla volta da una connessione dedicata, lette a blocchi di `batch`
+    pool = SHARD_POOLS[shard]
+    conn = pool.acquire()
+    try:
+        if USE_PG:
+            c = conn.cursor(name=f"export_{secrets.token_hex(4)}")
+            c.itersize = batch
+        else:
+            c = conn.cursor()
+        c.execute(adapt_sql(sql), tuple(params))
+        while True:
+            rows = c.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+        c.close()
+    finally:
+        conn.rollback()  # sola lettura: chiude la transazione (e il cursore lato server)
+        pool.release(conn)
+
+def iter_transactions(since: int = None, until: int = None, token: str = None, batch: int = EXPORT_BATCH):
+    # blocchi di righe (id, ts, from_name, to_name, amount, reason) in ordine (ts, id); since incluso, until escluso.
+    # Con lo sharding: per una carta basta il suo shard (copie comprese), per tutte si fondono le righe
+    # principali (mirror = 0) di ogni shard.
+    cond, params = [], []
+    if since is not None: cond.append("ts >= ?"); params.append(int(since))
+    if until is not None: cond.append("ts < ?"); params.append(int(until))
+    cols = "id, ts, from_id, to_id, amount, reason"
+    if token:
+        # i due rami indicizzati (carta, ts, id), come lo storico carta; UNION toglie i trasferimenti a se stessi
+        where = " AND ".join(cond)
+        extra = f" AND {where}" if where else ""
+        card = "(SELECT id FROM cards WHERE token = ?)"
+        inner = (f"SELECT {cols} FROM transactions WHERE from_id = {card}{extra} UNION "
+                 f"SELECT {cols} FROM transactions WHERE to_id = {card}{extra}")
+        params = [token] + params + [token] + params
+        shards = [shard_of(token)]
+    else:
+        if SHARDS > 1:
+            cond.append("mirror = 0")
+        where = " AND ".join(cond)
+        inner = f"SELECT {cols} FROM transactions{' WHERE ' + where if where else ''}"
+        shards = range(SHARDS)
+    sql = f"""SELECT t.id, t.ts, t.from_id, f.name, t.to_id, d.name, t.amount, t.reason FROM ({inner}) t
+              LEFT JOIN cards f ON f.id = t.from_id LEFT JOIN cards d ON d.id = t.to_id ORDER BY t.ts, t.id"""
+    # sempre dal primario: su una replica in ritardo le righe appena archiviate comparirebbero due volte
+    streams = [_stream_query(shard, sql, params, batch) for shard in shards]
+    rows = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda r: (r[1], r[0]))
+    for block in _batched(rows, batch):
+        block = _fill_names(block, ((2, 3), (4, 5)))
+        # abs: l'id della riga principale anche per le copie mirror (id negato)
+        yield [(abs(r[0]), r[1], party_name(r[2], r[3]), party_name(r[4], r[5]), r[6], r[7]) for r in block]
+
+def export_transactions(fmt: str = "csv", since: int = None, until: int = None, token: str = None):
+    # testo CSV (con intestazione) o NDJSON, un pezzo per blocco di righe: prima l'archivio, poi la tabella
+    if fmt == "csv":
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(EXPORT_COLUMNS)
+        yield buf.getvalue()
+    for rows in itertools.chain(iter_archived(since, until, token), iter_transactions(since, until, token)):
+        if fmt == "csv":
+            buf.seek(0); buf.truncate()
+            w.writerows((r[0], r[1], fmt_ts(r[1]), r[2] or "", r[3] or "", fmt_cents(r[4]), r[5] or "") for r in rows)
+            yield buf.getvalue()
+        else:
+            yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, (r[0], r[1], fmt_ts(r[1]), r[2], r[3], fmt_cents(r[4]), r[5]))),
+                                     ensure_ascii=False) + "\n" for r in rows)
+
+# ---------- REBALANCE SHARD ----------
+# Dopo un cambio di SQLITE_SHARDS ogni carta va nello shard che le assegna shard_of, con acquisti e movimenti
+# (le sessioni si cancellano: il sid indica il vecchio shard). Offline, ad app ferma: una sola connessione con
+# tutti i file collegati (ATTACH) e journal_mode=DELETE, così ogni commit è atomico su tutti i file. Prima si
+# chiudono i trasferimenti tra shard rimasti a metà; i file oltre SHARDS (riduzione) si svuotano.
+REBALANCE_BATCH = 200  # carte spostate per commit
+
+def _rebalance_live(conn, dbs):
+    def live(card_id):
+        f = card_id >> SHARD_ID_BITS
+        return f < len(dbs) and conn.execute(f"SELECT 1 FROM {dbs[f]}.cards WHERE id=?", (card_id,)).fetchone() is not None
+    return live
+
+def _rebalance_settle(conn, dbs) -> int:
+    # come _complete_transfer, ma nella transazione della connessione con tutti i file
+    live = _rebalance_live(conn, dbs)
+    settled = 0
+    for db in dbs:
+        for xid, ts, from_id, to_id, amount, reason, tx_id in conn.execute(
+                f"SELECT xid, ts, from_id, to_id, amount, reason, tx_id FROM {db}.transfer_journal").fetchall():
+            dest = dbs[to_id >> SHARD_ID_BITS] if to_id >> SHARD_ID_BITS < len(dbs) else None
+            seen = dest and conn.execute(f"SELECT credited FROM {dest}.transfer_received WHERE xid=?", (xid,)).fetchone()
+            if seen:
+                credited = bool(seen[0])
+            else:
+                credited = live(to_id)
+                if credited:
+                    conn.execute(f"UPDATE {dest}.cards SET balance = balance + ? WHERE id=?", (amount, to_id))
+                    conn.execute(f"""INSERT INTO {dest}.transactions (id,ts,from_id,to_id,amount,reason,mirror)
+                                     VALUES (?,?,?,?,?,?,1)""", (-tx_id, ts, from_id, to_id, amount, reason))
+            if not credited and live(from_id):
+                conn.execute(f"UPDATE {db}.cards SET balance = balance + ? WHERE id=?", (amount, from_id))
+                conn.execute(f"INSERT INTO {db}.transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)",
+                             (int(time.time()), to_id, from_id, amount, f"Rimborso: {reason}"))
+            conn.execute(f"DELETE FROM {db}.transfer_journal WHERE xid=?", (xid,))
+            settled += 1
+    for db in dbs:
+        conn.execute(f"DELETE FROM {db}.transfer_received")
+    return settled
+
+def _table_columns(conn, db: str, table: str, skip=()) -> str:
+    return ", ".join(r[1] for r in conn.execute(f"PRAGMA {db}.table_info({table})") if r[1] not in skip)
+
+def _rebalance_move(conn, dbs, src: int, card_id: int, dst: int) -> int:
+    # copia la carta in dst (nuovo id nell'intervallo di dst), sposta gli acquisti e riscrive i suoi movimenti
+    # (righe principali da tutti i file, con un nuovo id nello shard di arrivo, e copie secondo transaction_copies);
+    # ritorna i movimenti riscritti
+    s, d = dbs[src], dbs[dst]
+    cols = _table_columns(conn, s, "cards", skip=("id",))
+    new_id = conn.execute(f"INSERT INTO {d}.cards ({cols}) SELECT {cols} FROM {s}.cards WHERE id=?", (card_id,)).lastrowid
+    cols = _table_columns(conn, s, "purchases", skip=("id", "card_id"))
+    conn.execute(f"INSERT INTO {d}.purchases (card_id, {cols}) SELECT ?, {cols} FROM {s}.purchases WHERE card_id=?",
+                 (new_id, card_id))
+    conn.execute(f"DELETE FROM {s}.purchases WHERE card_id=?", (card_id,))
+    conn.execute(f"DELETE FROM {s}.sessions WHERE card_id=?", (card_id,))
+    conn.execute(f"DELETE FROM {s}.cards WHERE id=?", (card_id,))
+    rows = []
+    for db in dbs:
+        rows += conn.execute(f"""SELECT ts, from_id, to_id, amount, reason FROM {db}.transactions
+                                 WHERE mirror = 0 AND (from_id = ? OR to_id = ?) ORDER BY ts, id""",
+                             (card_id, card_id)).fetchall()
+        conn.execute(f"DELETE FROM {db}.transactions WHERE from_id = ? OR to_id = ?", (card_id, card_id))
+    live = _rebalance_live(conn, dbs)
+    for ts, from_id, to_id, amount, reason in sorted(rows, key=lambda r: r[0]):
+        from_id = new_id if from_id == card_id else from_id
+        to_id = new_id if to_id == card_id else to_id
+        (shard, _), *mirrors = transaction_copies(from_id, to_id, live)
+        tx_id = conn.execute(f"INSERT INTO {dbs[shard]}.transactions (ts,from_id,to_id,amount,reason) VALUES (?,?,?,?,?)",
+                             (ts, from_id, to_id, amount, reason)).lastrowid
+        for shard, _ in mirrors:
+            conn.execute(f"""INSERT INTO {dbs[shard]}.transactions (id,ts,from_id,to_id,amount,reason,mirror)
+                             VALUES (?,?,?,?,?,?,1)""", (-tx_id, ts, from_id, to_id, amount, reason))
+    return len(rows)
+
+def rebalance_shards(log=print, dry_run: bool = False) -> dict:
+    if USE_PG:
+        return {"skipped": "lo sharding c'è solo su SQLite"}
+    migrate(log=log)
+    files = SHARDS
+    while os.path.exists(shard_path(files)):
+        files += 1
+    for pool in SHARD_POOLS:
+        pool.close_idle()
+    conn = sqlite3.connect(DB_FILE, isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if files - 1 > limit:
+            raise RuntimeError(f"{files} file di shard: SQLite ne collega al massimo {limit + 1} in una connessione")
+        dbs = ["main"] + [f"s{i}" for i in range(1, files)]
+        for i in range(1, files):
+            conn.execute(f"ATTACH DATABASE ? AS s{i}", (shard_path(i),))
+        for i in range(SHARDS, files):
+            version = conn.execute(f"SELECT MAX(version) FROM s{i}.schema_version").fetchone()[0]
+            if version != LATEST_SCHEMA_VERSION:
+                raise RuntimeError(f"{shard_path(i)} è alla versione {version}: migrarlo prima con SQLITE_SHARDS={i + 1}")
+        moves = [(i, card_id, shard_of(token)) for i, db in enumerate(dbs)
+                 for card_id, token in conn.execute(f"SELECT id, token FROM {db}.cards ORDER BY id").fetchall()
+                 if shard_of(token) != i]
+        pending = sum(conn.execute(f"SELECT COUNT(*) FROM {db}.transfer_journal").fetchone()[0] for db in dbs)
+        result = {"shards": SHARDS, "files": files, "cards": len(moves), "transfers": pending, "transactions": 0,
+                  "extra_files": [shard_path(i) for i in range(SHARDS, files)]}
+        if dry_run or (not moves and not pending and files == SHARDS):
+            return result
+        modes = [conn.execute(f"PRAGMA {db}.journal_mode").fetchone()[0] for db in dbs]
+        try:
+            for db in dbs:
+                try:
+                    mode = conn.execute(f"PRAGMA {db}.journal_mode=DELETE").fetchone()[0]
+                except sqlite3.OperationalError:
+                    mode = None
+                if mode != "delete":
+                    raise RuntimeError("impossibile uscire dal WAL: il DB è aperto da un altro processo (fermare l'app)")
+            conn.execute("BEGIN IMMEDIATE")
+            _rebalance_settle(conn, dbs)
+            conn.execute("COMMIT")
+            for k in range(0, len(moves), REBALANCE_BATCH):
+                conn.execute("BEGIN IMMEDIATE")
+                for src, card_id, dst in moves[k:k + REBALANCE_BATCH]:
+                    result["transactions"] += _rebalance_move(conn, dbs, src, card_id, dst)
+                conn.execute("COMMIT")
+                if log:
+                    log(f"Carte spostate: {min(k + REBALANCE_BATCH, len(moves))}/{len(moves)}")
+            # nei file in più restano solo movimenti tra carte eliminate: vanno nello shard 0
+            conn.execute("BEGIN IMMEDIATE")
+            for db in dbs[SHARDS:]:
+                conn.execute(f"""INSERT INTO main.transactions (ts,from_id,to_id,amount,reason)
+                                 SELECT ts, from_id, to_id, amount, reason FROM {db}.transactions WHERE mirror = 0 ORDER BY ts, id""")
+                for table in ("transactions", "purchases", "sessions"):
+                    conn.execute(f"DELETE FROM {db}.{table}")
+            conn.execute("COMMIT")
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for db, mode in zip(dbs, modes):
+                conn.execute(f"PRAGMA {db}.journal_mode={mode}")
+        return result
+    finally:
+        conn.close()
+
+# ---------- JOB PERIODICI ----------
+class PeriodicJob:
+    # esegue fn ogni `interval` secondi in un thread daemon, finché stop() non viene chiamato
+    def __init__(self, name: str, interval: float, fn, first_delay: float = None):
+        self.name = name
+        self.interval = interval
+        self.first_delay = interval if first_delay is None else first_delay
+        self.fn = fn
+        self.runs = 0
+        self.errors = 0
+        self.last_result = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=f"job-{name}", daemon=True)
+
+    def _loop(self):
+        delay = self.first_delay
+        while not self._stop.wait(delay):
+            delay = self.interval
+            try:
+                self.last_result = self.fn()
+                self.runs += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"ATTENZIONE: job {self.name} fallito: {e!r}")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 5)
+
+    def stats(self) -> dict:
+        return {"interval": self.interval, "runs": self.runs, "errors": self.errors, "last_result": self.last_result}
+
+JOBS = {}
+
+def wal_checkpoint():
+    # PASSIVE: copia nel DB le pagine WAL possibili senza bloccare lettori e scrittori (somma su tutti gli shard)
+    out = {"busy": 0, "log_pages": 0, "checkpointed": 0}
+    for shard in range(SHARDS):
+        busy, log_pages, checkpointed = exec_sql("PRAGMA wal_checkpoint(PASSIVE)", fetch="one", shard=shard)
+        out["busy"] += busy; out["log_pages"] += log_pages; out["checkpointed"] += checkpointed
+    return out
+
+def start_jobs():
+    start_writer()
+    LEADERBOARD.load()
+    if LEADERBOARD_RELOAD > 0:
+        JOBS["leaderboard"] = PeriodicJob("leaderboard", LEADERBOARD_RELOAD, reload_leaderboard).start()
+    if not USE_PG and SQLITE_PROFILE and SQLITE_CHECKPOINT_SECONDS > 0:
+        JOBS["wal_checkpoint"] = PeriodicJob("wal_checkpoint", SQLITE_CHECKPOINT_SECONDS, wal_checkpoint).start()
+    if SESSION_MODE == "signed":
+        load_revocations()
+        JOBS["session_revocations"] = PeriodicJob("session_revocations", SESSION_REVOCATION_REFRESH, load_revocations).start()
+    elif SESSION_SWEEP_SECONDS > 0:
+        JOBS["session_sweep"] = PeriodicJob("session_sweep", SESSION_SWEEP_SECONDS, sweep_sessions).start()
+    if ARCHIVE_AFTER_DAYS > 0 and ARCHIVE_INTERVAL > 0:
+        JOBS["archive"] = PeriodicJob("archive", ARCHIVE_INTERVAL, archive_transactions).start()
+    if BILLING_INTERVAL > 0:
+        # prima passata subito all'avvio: recupera gli addebiti maturati mentre l'app era ferma
+        JOBS["billing"] = PeriodicJob("billing", BILLING_INTERVAL, bill_due_subscriptions, first_delay=0).start()
+    if SHARDS > 1:
+        # trasferimenti tra shard rimasti a metà (processo interrotto tra addebito e accredito)
+        JOBS["transfer_recovery"] = PeriodicJob("transfer_recovery", SHARD_RECOVERY_SECONDS, recover_transfers,
+                                                first_delay=0).start()
+
+def stop_jobs():
+    for job in JOBS.values():
+        job.stop()
+    JOBS.clear()
+    stop_writer()
+
+# ---------- APP ----------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # nessun lavoro sullo schema durante le richieste: qui solo il controllo di versione
+    if AUTO_MIGRATE:
+        await run_in_threadpool(migrate)
+    await run_in_threadpool(check_schema)
+    await run_in_threadpool(start_jobs)
+    yield
+    await run_in_threadpool(stop_jobs)
+    for pool in [APOOL] + AREPLICA_POOLS:
+        await pool.close()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def unit_of_work_middleware(request: Request, call_next):
+    uow = UnitOfWork(primary_reads=read_sticky(request))
+    reset = _current_uow.set(uow)
+    try:
+        response = await call_next(request)
+    except Exception:
+        if uow.active:
+            await run_in_threadpool(uow.close, False)
+        raise
+    finally:
+        _current_uow.reset(reset)
+    if uow.active:
+        await run_in_threadpool(uow.close, response.status_code < 500)
+    if uow.wrote and REPLICA_POOLS:
+        # read-your-writes: per qualche secondo questo browser legge dal primario
+        until = int(time.time() + READ_STICKY_SECONDS) + 1
+        set_cookie(response, READ_STICKY_COOKIE, str(until), max_age=int(READ_STICKY_SECONDS) + 1,
+                   httponly=True, request=request)
+    return response
+
+def read_sticky(request: Request) -> bool:
+    if not REPLICA_POOLS:
+        return False
+    try: return float(request.cookies.get(READ_STICKY_COOKIE) or 0) > time.time()
+    except ValueError: return False
+
+# ---------- CONTESTO CARTA ----------
+class PageError(Exception):
+    # errore da mostrare come pagina (sollevabile anche dalle dipendenze); message è testo semplice, status vale per
+    # le risposte JSON (le pagine HTML restano 200 come le altre pagine di errore)
+    def __init__(self, message: str, title: str = "", status: int = 401):
+        super().__init__(message)
+        self.message, self.title, self.status = message, title, status
+
+    @property
+    def inner_html(self) -> str:
+        return f"<h3>{html_lib.escape(self.message)}</h3>"
+
+@app.exception_handler(PageError)
+async def page_error_handler(request: Request, exc: PageError):
+    if request.url.path.endswith(".json"):
+        return JSONResponse({"error": exc.message}, exc.status)
+    return await arender_page(exc.inner_html, exc.title)
+
+@dataclass
+class CardContext:
+    session: dict
+    card: dict
+    device_id: str = None
+
+    @property
+    def token(self) -> str:
+        return self.card["token"]
+
+    @property
+    def card_id(self) -> int:
+        return self.card["id"]
+
+async def card_context(request: Request) -> CardContext:
+    # dipendenza per le pagine dopo il tap: sessione valida, entro SCAN_WINDOW, carta esistente e dispositivo associato
+    sid = request.cookies.get(SESSION_COOKIE_NAME)
+    if not sid: raise PageError("Sessione mancante", "Richiesto")
+    session, card = await aget_session_card(sid)
+    if not session: raise PageError("Sessione scaduta", "Scaduta")
+    if int(time.time()) - session["created_at"] > SCAN_WINDOW:
+        raise PageError("Sessione non valida", "Errore")
+    if not card: raise PageError("Tag non valido", "Errore", 404)
+    device_id = request.cookies.get(DEVICE_COOKIE_NAME)
+    if card["bound_device_id"] and card["bound_device_id"] != device_id:
+        raise PageError("Accesso non autorizzato", "Bloccato", 403)
+    return CardContext(session, card, device_id)
 
 # ---------- ROUTES ----------
 @app.get("/", response_class=HTMLResponse)
@@ -351,11 +3054,12 @@ def go(dest: str = "", key: str = ""):
     return render_page("<h3>Destinazione non valida</h3>", "Errore")
 
 @app.get("/create", response_class=HTMLResponse)
-def create_via_link(request: Request, name: str = "", code: str = "", initial: float = 0.0, desc: str = ""):
+def create_via_link(request: Request, name: str = "", code: str = "", initial: str = "0", desc: str = ""):
     if not name or not code:
         return render_page("<h3>Parametri mancanti (?name=&code=)</h3>", "Errore")
-    r = exec_sql("SELECT COUNT(*) FROM cards", fetch="one")
-    if (r[0] if r else 0) >= 10:
+    try: initial = to_cents(initial or 0)
+    except ValueError: return render_page("<h3>Saldo iniziale non valido</h3>", "Errore")
+    if count_cards() >= 10:
         return render_page("<h3>Limite 10 carte raggiunto</h3>", "Limite")
     token = create_site(name, code, initial, desc)
     if not token:
@@ -371,37 +3075,39 @@ def create_via_link(request: Request, name: str = "", code: str = "", initial: f
 
 @app.get("/launch/{token}")
 @app.head("/launch/{token}")
-def launch(token: str, request: Request):
-    site = get_by_token(token)
+async def launch(token: str, request: Request):
+    site = await aget_by_token(token)
     if not site:
-        return render_page("<h3>Tag non valido</h3>", "Errore")
+        return await arender_page("<h3>Tag non valido</h3>", "Errore")
     device_id = request.cookies.get(DEVICE_COOKIE_NAME)
     if site["bound_device_id"] and device_id != site["bound_device_id"]:
-        return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
+        return await arender_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
     resp = RedirectResponse("/card", 302)
+    if request.method == "HEAD":
+        return resp  # anteprime/controlli del link: nessuna sessione, nessun cookie
     if not device_id:
         device_id = secrets.token_hex(16)
         set_cookie(resp, DEVICE_COOKIE_NAME, device_id, max_age=60*60*24*365, httponly=True, request=request)
-    sid = create_session_for_token(token)
+    sid = await acreate_session_for_token(token)
     set_cookie(resp, SESSION_COOKIE_NAME, sid, max_age=SESSION_TTL, httponly=True, request=request)
     return resp
 
 @app.get("/card", response_class=HTMLResponse)
-def card_from_session(request: Request):
+async def card_from_session(request: Request):
     sid = request.cookies.get(SESSION_COOKIE_NAME)
     if not sid:
-        return render_page(f"<h3>Sessione mancante</h3><p>Tap NFC (entro {SCAN_WINDOW}s).</p>", "Richiesto NFC")
-    session = get_session_info(sid)
+        return await arender_page(f"<h3>Sessione mancante</h3><p>Tap NFC (entro {SCAN_WINDOW}s).</p>", "Richiesto NFC")
+    session = await aget_session_info(sid)
     if not session:
-        return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
+        return await arender_page("<h3>Sessione scaduta</h3>", "Scaduta")
     if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-        return render_page("<h3>Sessione non valida (scaduto timeout NFC)</h3>", "Non valida")
-    site = get_by_token(session["token"])
+        return await arender_page("<h3>Sessione non valida (scaduto timeout NFC)</h3>", "Non valida")
+    site = await aget_by_token(session["token"])
     if not site:
-        return render_page("<h3>Tag non valido</h3>", "Errore")
+        return await arender_page("<h3>Tag non valido</h3>", "Errore")
     device_id = request.cookies.get(DEVICE_COOKIE_NAME)
     if site["bound_device_id"] and site["bound_device_id"] != device_id:
-        return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
+        return await arender_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
     inner = f"""
       <h2>{html_lib.escape(site['name'])}</h2>
       <p><strong>Saldo:</strong> {fmt_bonsaura(site['balance'])}</p>
@@ -414,7 +3120,7 @@ def card_from_session(request: Request):
       </form>
       <p class="muted">Completa entro {SCAN_WINDOW}s dal tap.</p>
     """
-    return render_page(inner, site["name"])
+    return await arender_page(inner, site["name"])
 
 @app.post("/unlock", response_class=HTMLResponse)
 def unlock(request: Request, token: str = Form(...), pin: str = Form(...)):
@@ -426,14 +3132,15 @@ def unlock(request: Request, token: str = Form(...), pin: str = Form(...)):
     if not device_id:
         return render_page("<h3>Cookie dispositivo mancante (rifai tap)</h3>", "Errore")
     if not site["bound_device_id"]:
-        bind_device_id(token, device_id)
-        mark_token_used(token)
+        bind_card(token, device_id)
         site = get_by_token(token)
     if site["bound_device_id"] != device_id:
         return render_page("<h3>Dispositivo non autorizzato</h3>", "Bloccato")
-    apply_recurring_charges(site["token"])
-    site = get_by_token(token)
-    can_shop = site["balance"] >= 30.0
+    can_shop = site["balance"] >= SHOP_THRESHOLD
+    items = [i for i in get_catalog().values() if i["active"]]
+    items_html = (f'<p class="muted">Nel negozio: ' + ", ".join(
+        f"“{html_lib.escape(i['name'])}” ({fmt_item_terms(i)})" for i in items[:3])
+        + (f" e altri {len(items) - 3}" if len(items) > 3 else "") + ".</p>") if items else ""
     shop_btn = '<a class="btn" href="/shop">Negozio</a>' if can_shop else '<button class="btn" disabled>Negozio (saldo &lt; 30)</button>'
     inner = f"""
       <h2>Benvenuto, {html_lib.escape(site['name'])}</h2>
@@ -443,76 +3150,76 @@ def unlock(request: Request, token: str = Form(...), pin: str = Form(...)):
         <div><a class="btn primary" href="/bank">Banca</a></div>
         <div>{shop_btn}</div>
       </div>
-      <p class="muted">Oggetto disponibile: “Moccolone pencs” (+35 subito, -3/settimana).</p>
+      {items_html}
     """
     return render_page(inner, "Menu")
 
 @app.get("/leaderboard", response_class=HTMLResponse)
-def leaderboard(request: Request):
-    sid = request.cookies.get(SESSION_COOKIE_NAME)
-    if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-    session = get_session_info(sid)
-    if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-    if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-        return render_page("<h3>Sessione non valida</h3>", "Errore")
-    apply_recurring_charges(session["token"])
-    rows = exec_sql("SELECT name,balance,token FROM cards ORDER BY balance DESC, id ASC", fetch="all")
+async def leaderboard(request: Request, ctx: CardContext = Depends(card_context)):
+    etag = page_etag("leaderboard", ctx.token)
+    cached = not_modified(request, etag)
+    if cached: return cached
+    if not LEADERBOARD.loaded:
+        await run_in_threadpool(_detached, LEADERBOARD.load)
     palette = ["#ef4444","#f97316","#f59e0b","#eab308","#84cc16","#22c55e","#06b6d4","#3b82f6","#8b5cf6","#db2777"]
-    body = []
-    for idx, r in enumerate(rows or [], start=1):
-        name, balance, token = r
-        me = token == session["token"]
-        color = palette[(idx-1)%len(palette)]
-        mark = " — tu" if me else ""
-        body.append(f"""
+
+    def render_rows():
+        rows, my_pos, total = LEADERBOARD.view(ctx.token, LEADERBOARD_TOP, LEADERBOARD_NEIGHBOURS)
+        body = []
+        last = 0
+        for idx, name, balance, token in rows:
+            if idx > last + 1:
+                body.append('<tr><td colspan=3 class=muted>…</td></tr>')
+            last = idx
+            me = token == ctx.token
+            color = palette[(idx-1)%len(palette)]
+            mark = " — tu" if me else ""
+            body.append(f"""
           <tr style="border-left:8px solid {html_lib.escape(color)};{'font-weight:700;background:rgba(0,0,0,0.03);' if me else ''}">
             <td>#{idx}</td><td>{html_lib.escape(name)}{mark}</td><td>{fmt_bonsaura(balance)}</td>
           </tr>
         """)
+        if total > last:
+            body.append('<tr><td colspan=3 class=muted>…</td></tr>')
+        position = f'<p class="muted">La tua posizione: #{my_pos} su {total}</p>' if my_pos else ""
+        return position, ''.join(body) or '<tr><td colspan=3 class=muted>Nessuna carta</td></tr>'
+
+    position, body = fragment(("leaderboard", ctx.token), render_rows)
     inner = f"""
       <h2>Classifica Bonsaura</h2>
+      {position}
       <table><thead><tr><th>Pos</th><th>Banca</th><th>Punti</th></tr></thead>
-      <tbody>{''.join(body) or '<tr><td colspan=3 class=muted>Nessuna carta</td></tr>'}</tbody></table>
+      <tbody>{body}</tbody></table>
       <div class="grid cols-2" style="margin-top:12px">
         <div><a class="btn secondary" href="/bank">Banca</a></div>
         <div><a class="btn" href="/">Home</a></div>
       </div>
     """
-    return render_page(inner, "Classifica")
+    return with_etag(await arender_page(inner, "Classifica"), etag)
 
 @app.get("/bank", response_class=HTMLResponse)
-def bank(request: Request):
-    sid = request.cookies.get(SESSION_COOKIE_NAME)
-    if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-    session = get_session_info(sid)
-    if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-    if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-        return render_page("<h3>Sessione non valida</h3>", "Errore")
-    apply_recurring_charges(session["token"])
-    site = get_by_token(session["token"])
-    if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-    device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-    if site["bound_device_id"] and site["bound_device_id"] != device_id:
-        return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
+async def bank(ctx: CardContext = Depends(card_context)):
+    site = ctx.card
 
     # Menu a tendina con banche disponibili (escludi se stesso)
-    dest_rows = exec_sql("SELECT name FROM cards WHERE token <> ? ORDER BY name", (site["token"]), fetch="all")
-    # psycopg2 richiede tupla per singolo parametro; garantiamolo:
-    if isinstance(dest_rows, type(None)):
-        dest_rows = []
-    if isinstance((site["token"]), str):
-        dest_rows = exec_sql("SELECT name FROM cards WHERE token <> ? ORDER BY name", (site["token"],), fetch="all") or []
-    options_html = "".join(
-        f"<option value=\"{html_lib.escape(n[0])}\">{html_lib.escape(n[0])}</option>" for n in dest_rows
-    )
-
-    recent = get_recent_transactions(site["token"], limit=10)
-    rows_html = "".join(
-        f"<tr><td>{fmt_ts(t['ts'])}</td><td>{html_lib.escape(t['from_name'] or '-')}</td>"
-        f"<td>{html_lib.escape(t['to_name'] or '-')}</td><td>{fmt_bonsaura(t['amount'])}</td>"
-        f"<td>{html_lib.escape(t['reason'] or '')}</td></tr>"
-        for t in recent
-    ) or '<tr><td colspan="5" class="muted">Nessuna transazione</td></tr>'
+    async def render_options():
+        dest_rows = await aread_shards("SELECT name FROM cards WHERE token <> ? ORDER BY name", (site["token"],),
+                                       key=lambda r: r[0])
+        return "".join(
+            f"<option value=\"{html_lib.escape(n[0])}\">{html_lib.escape(n[0])}</option>" for n in dest_rows
+        )
+
+    async def render_history():
+        recent = await aget_recent_transactions(site["id"], limit=10)
+        return "".join(
+            f"<tr><td>{fmt_ts(t['ts'])}</td><td>{html_lib.escape(t['from_name'] or '-')}</td>"
+            f"<td>{html_lib.escape(t['to_name'] or '-')}</td><td>{fmt_bonsaura(t['amount'])}</td>"
+            f"<td>{html_lib.escape(t['reason'] or '')}</td></tr>"
+            for t in recent
+        ) or '<tr><td colspan="5" class="muted">Nessuna transazione</td></tr>'
+
+    options_html = await afragment(("bank-options", site["token"]), render_options)
+    rows_html = await afragment(("bank-history", site["token"]), render_history)
 
     inner = f"""
       <h2>{html_lib.escape(site['name'])}</h2>
@@ -537,46 +3244,78 @@ def bank(request: Request):
         <thead><tr><th>Data</th><th>Da</th><th>A</th><th>Importo</th><th>Motivazione</th></tr></thead>
         <tbody>{rows_html}</tbody>
       </table>
+      <p><a class="btn secondary" href="/bank/history">Tutte le operazioni</a></p>
+    """
+    return await arender_page(inner, site["name"])
+
+HISTORY_PAGE_SIZE = 20
+
+@app.get("/bank/history", response_class=HTMLResponse)
+async def bank_history(before: str = "", ctx: CardContext = Depends(card_context)):
+    page, next_cursor = await aget_transactions_page(ctx.card_id, HISTORY_PAGE_SIZE, before)
+    rows_html = "".join(
+        f"<tr><td>{fmt_ts(t['ts'])}</td><td>{html_lib.escape(t['from_name'] or '-')}</td>"
+        f"<td>{html_lib.escape(t['to_name'] or '-')}</td><td>{fmt_bonsaura(t['amount'])}</td>"
+        f"<td>{html_lib.escape(t['reason'] or '')}</td></tr>"
+        for t in page
+    ) or '<tr><td colspan="5" class="muted">Nessuna transazione</td></tr>'
+    nav = []
+    if before:
+        nav.append('<a class="btn secondary" href="/bank/history">Più recenti</a>')
+    if next_cursor:
+        nav.append(f'<a class="btn secondary" href="/bank/history?before={html_lib.escape(next_cursor)}">Più vecchie</a>')
+    nav.append('<a class="btn primary" href="/bank">Banca</a>')
+    inner = f"""
+      <h2>Operazioni di {html_lib.escape(ctx.card['name'])}</h2>
+      <table>
+        <thead><tr><th>Data</th><th>Da</th><th>A</th><th>Importo</th><th>Motivazione</th></tr></thead>
+        <tbody>{rows_html}</tbody>
+      </table>
+      <div class="grid cols-3" style="margin-top:12px">{''.join(f'<div>{b}</div>' for b in nav)}</div>
     """
-    return render_page(inner, site["name"])
+    return await arender_page(inner, "Operazioni")
+
+@app.get("/bank/history.json")
+async def bank_history_json(before: str = "", limit: int = HISTORY_PAGE_SIZE, ctx: CardContext = Depends(card_context)):
+    page, next_cursor = await aget_transactions_page(ctx.card_id, max(1, min(int(limit), 100)), before)
+    items = [{**t, "amount": fmt_cents(t["amount"])} for t in page]
+    return JSONResponse({"items": items, "next": next_cursor})
 
 @app.post("/transfer", response_class=HTMLResponse)
-def transfer(request: Request,
-             from_token: str = Form(...),
-             to_name: str = Form(...),
-             amount: str = Form(...),
-             reason: str = Form(...)):
-    from_site = get_by_token(from_token)
-    if not from_site: return render_page("<h3>Mittente non trovato</h3>", "Errore")
+async def transfer(request: Request,
+                   from_token: str = Form(...),
+                   to_name: str = Form(...),
+                   amount: str = Form(...),
+                   reason: str = Form(...)):
+    from_site = await aget_by_token(from_token)
+    if not from_site: return await arender_page("<h3>Mittente non trovato</h3>", "Errore")
     device_id = request.cookies.get(DEVICE_COOKIE_NAME)
     if not from_site["bound_device_id"] or from_site["bound_device_id"] != device_id:
-        return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
+        return await arender_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
 
     to_name = (to_name or "").strip()
     if not to_name:
-        return render_page("<h3>Seleziona una banca destinataria</h3>", "Errore")
+        return await arender_page("<h3>Seleziona una banca destinataria</h3>", "Errore")
 
     reason = (reason or "").strip()
-    if not reason: return render_page("<h3>Motivazione obbligatoria</h3>", "Errore")
-    if len(reason) > 300: return render_page("<h3>Motivazione troppo lunga</h3>", "Errore")
-
-    try: amt = float(amount)
-    except: return render_page("<h3>Importo non valido</h3>", "Errore")
-    if amt <= 0: return render_page("<h3>Importo deve essere positivo</h3>", "Errore")
-    if from_site["balance"] < amt:
-        return render_page(f"<h3>Saldo insufficiente ({fmt_bonsaura(from_site['balance'])})</h3>", "Errore")
-
-    dest = get_by_name(to_name)
-    if not dest:
-        return render_page(
+    if not reason: return await arender_page("<h3>Motivazione obbligatoria</h3>", "Errore")
+    if len(reason) > 300: return await arender_page("<h3>Motivazione troppo lunga</h3>", "Errore")
+
+    try: amt = to_cents(amount)
+    except ValueError: return await arender_page("<h3>Importo non valido</h3>", "Errore")
+    if amt <= 0: return await arender_page("<h3>Importo deve essere positivo</h3>", "Errore")
+
+    result = await atransfer_funds(from_site["token"], to_name, amt, reason)
+    if result["status"] == "insufficient_funds":
+        return await arender_page(f"<h3>Saldo insufficiente ({fmt_bonsaura(result['balance'])})</h3>", "Errore")
+    if result["status"] == "not_found":
+        return await arender_page(
             f"<h3>Banca '{html_lib.escape(to_name)}' non trovata</h3>"
             f"<p>Nessun punto inviato.</p>"
             f"<p><a href='/bank'>Torna</a></p>", "Errore")
-
-    update_balance_by_token(from_site["token"], from_site["balance"] - amt)
-    update_balance_by_token(dest["token"], dest["balance"] + amt)
-    log_transaction(from_site["token"], from_site["name"], dest["token"], dest["name"], amt, reason)
-    return render_page(
+    if result["status"] != "ok":
+        return await arender_page("<h3>Mittente non trovato</h3>", "Errore")
+    return await arender_page(
         f"<h3>Trasferimento di {fmt_bonsaura(amt)} a {html_lib.escape(to_name)} eseguito.</h3>"
         f"<p>Motivazione: {html_lib.escape(reason)}</p><p><a href='/card'>Torna</a></p>", "OK")
 
@@ -585,13 +3324,16 @@ def require_key(key: str) -> bool:
     return key == ADMIN_KEY
 
 @app.get("/lista", response_class=HTMLResponse)
-def lista(key: str = ""):
+def lista(request: Request, key: str = ""):
     if not require_key(key):
         return render_page("<h3>Accesso negato</h3>", "403")
-    rows = exec_sql("SELECT name,balance,bound_device_id,token_used,description FROM cards ORDER BY id", fetch="all")
-    body = ""
-    for name, balance, bound, used, desc in rows or []:
-        body += f"""
+    etag = page_etag("lista")
+    cached = not_modified(request, etag)
+    if cached: return cached
+
+    def render_rows():
+        rows = read_shards("SELECT name,balance,bound_device_id,token_used,description FROM cards ORDER BY id")
+        return "".join(f"""
           <tr>
             <td>{html_lib.escape(name)}</td>
             <td>{fmt_bonsaura(balance)}</td>
@@ -599,7 +3341,9 @@ def lista(key: str = ""):
             <td>{'sì' if used else 'no'}</td>
             <td>{html_lib.escape(desc or '')}</td>
           </tr>
-        """
+        """ for name, balance, bound, used, desc in rows or [])
+
+    body = fragment(("lista",), render_rows)
     inner = f"""
       <h2>Lista carte</h2>
       <table>
@@ -608,20 +3352,23 @@ def lista(key: str = ""):
       </table>
       <p class="muted">I token non sono mostrati.</p>
     """
-    return render_page(inner, "Lista carte")
+    return with_etag(render_page(inner, "Lista carte"), etag)
 
 @app.get("/admin", response_class=HTMLResponse)
 def admin_panel(request: Request, key: str = ""):
     if not require_key(key):
         return render_page("<h3>Accesso negato</h3>", "403")
-    s = get_settings()
     base = str(request.base_url).rstrip("/")
-    rows = exec_sql("SELECT name,token,balance,bound_device_id,description FROM cards ORDER BY id", fetch="all")
-    cards_html = ""
-    for name, token, balance, bound, desc in rows or []:
+    etag = page_etag("admin", key, base)
+    cached = not_modified(request, etag)
+    if cached: return cached
+    s = get_settings()
+    key_e = html_lib.escape(key)
+
+    def render_row(name, token, balance, bound, desc):
         token_e = html_lib.escape(token)
         url_nfc = html_lib.escape(f"{base}/launch/{token}")
-        cards_html += f"""
+        return f"""
           <tr>
             <td>{html_lib.escape(name)}<br>
               <span class="muted">token:</span> <code class="mono">{token_e}</code><br>
@@ -635,24 +3382,30 @@ def admin_panel(request: Request, key: str = ""):
             <td>{html_lib.escape(desc or '')}</td>
             <td style="min-width:260px">
               <form style="display:inline-block" method="post" action="/admin/adjust">
-                <input type="hidden" name="key" value="{html_lib.escape(key)}">
+                <input type="hidden" name="key" value="{key_e}">
                 <input type="hidden" name="token" value="{token_e}">
                 <input name="delta" type="number" step="0.01" placeholder="+/-" required style="width:110px">
                 <button class="btn success" type="submit">Applica</button>
               </form>
               <form style="display:inline-block" method="post" action="/admin/reset">
-                <input type="hidden" name="key" value="{html_lib.escape(key)}">
+                <input type="hidden" name="key" value="{key_e}">
                 <input type="hidden" name="token" value="{token_e}">
                 <button class="btn secondary" type="submit">Reset bind</button>
               </form>
               <form style="display:inline-block" method="post" action="/admin/delete">
-                <input type="hidden" name="key" value="{html_lib.escape(key)}">
+                <input type="hidden" name="key" value="{key_e}">
                 <input type="hidden" name="token" value="{token_e}">
                 <button class="btn danger" type="submit" onclick="return confirm('Eliminare?')">Elimina</button>
               </form>
             </td>
           </tr>
         """
+
+    def render_rows():
+        rows = read_shards("SELECT name,token,balance,bound_device_id,description FROM cards ORDER BY id")
+        return "".join(render_row(*r) for r in rows or [])
+
+    cards_html = fragment(("admin", key, base), render_rows)
     inner = f"""
       <h2>Admin</h2>
       <div class="grid cols-2">
@@ -680,6 +3433,15 @@ def admin_panel(request: Request, key: str = ""):
             </form>
         </div>
       </div>
+      <p><a class="btn secondary" href="/admin/catalog?key={html_lib.escape(key)}">Catalogo negozio</a>
+         <a class="btn secondary" href="/admin/simulate?key={html_lib.escape(key)}">Simulazione saldi</a></p>
+      <form method="get" action="/admin/export" style="display:flex;gap:6px;flex-wrap:wrap;align-items:center">
+        <input type="hidden" name="key" value="{key_e}">
+        <select name="format"><option value="csv">CSV</option><option value="ndjson">NDJSON</option></select>
+        <input name="since" type="date" title="Dal"> <input name="until" type="date" title="Al">
+        <input name="card" placeholder="Carta (tutte)">
+        <button class="btn secondary" type="submit">Esporta transazioni</button>
+      </form>
       <h3>Carte</h3>
       <table>
         <thead><tr><th>Nome/Token</th><th>Saldo</th><th>Binding</th><th>Descrizione</th><th>Azioni</th></tr></thead>
@@ -693,41 +3455,43 @@ def admin_panel(request: Request, key: str = ""):
         }}
       </script>
     """
-    return render_page(inner, "Admin")
+    return with_etag(render_page(inner, "Admin"), etag)
 
 @app.post("/admin/create", response_class=HTMLResponse)
-def admin_create(name: str = Form(""), pin: str = Form(""), initial: float = Form(0.0),
+def admin_create(name: str = Form(""), pin: str = Form(""), initial: str = Form("0"),
                  desc: str = Form(""), key: str = Form("")):
     if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
     if not name or not pin: return render_page("<h3>Nome e PIN richiesti</h3>", "Errore")
-    cnt = exec_sql("SELECT COUNT(*) FROM cards", fetch="one")[0]
-    if cnt >= 10: return render_page("<h3>Limite 10 carte raggiunto</h3>", "Limite")
+    try: initial = to_cents(initial or 0)
+    except ValueError: return render_page("<h3>Saldo iniziale non valido</h3>", "Errore")
+    if count_cards() >= 10: return render_page("<h3>Limite 10 carte raggiunto</h3>", "Limite")
     token = create_site(name, pin, initial, desc)
     if not token: return render_page("<h3>Nome già esistente</h3>", "Errore")
     return RedirectResponse(f"/admin?key={key}", 302)
 
 @app.post("/admin/adjust", response_class=HTMLResponse)
-def admin_adjust(token: str = Form(""), delta: float = Form(0.0), key: str = Form("")):
+def admin_adjust(token: str = Form(""), delta: str = Form("0"), key: str = Form("")):
     if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
     site = get_by_token(token)
     if not site: return render_page("<h3>Carta non trovata</h3>", "Errore")
-    try: float(delta)
-    except: return render_page("<h3>Delta non valido</h3>", "Errore")
-    adjust_balance(token, float(delta))
+    try: delta = to_cents(delta)
+    except ValueError: return render_page("<h3>Delta non valido</h3>", "Errore")
+    adjust_balance(token, delta)
     return RedirectResponse(f"/admin?key={key}", 302)
 
 @app.post("/admin/reset", response_class=HTMLResponse)
 def admin_reset(token: str = Form(""), key: str = Form("")):
     if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
     if not get_by_token(token): return render_page("<h3>Token non trovato</h3>", "Errore")
-    unbind_device_id(token)
+    reset_card(token)
     return RedirectResponse(f"/admin?key={key}", 302)
 
 @app.post("/admin/delete", response_class=HTMLResponse)
 def admin_delete(token: str = Form(""), key: str = Form("")):
     if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
     if not get_by_token(token): return render_page("<h3>Token non trovato</h3>", "Errore")
-    exec_sql("DELETE FROM cards WHERE token=?", (token,))
+    revoke_sessions(token)
+    delete_card(token)
     return RedirectResponse(f"/admin?key={key}", 302)
 
 @app.post("/admin/settings", response_class=HTMLResponse)
@@ -739,41 +3503,167 @@ def admin_settings(bank_name: str = Form(""), logo_url: str = Form(""),
                     gradient_to or "#8b5cf6", font_name or "Poppins")
     return RedirectResponse(f"/admin?key={key}", 302)
 
-# ---------- SHOP ----------
-@app.get("/shop", response_class=HTMLResponse)
-def shop(request: Request):
-    sid = request.cookies.get(SESSION_COOKIE_NAME)
-    if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-    session = get_session_info(sid)
-    if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-    if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-        return render_page("<h3>Sessione non valida</h3>", "Errore")
-    apply_recurring_charges(session["token"])
-    site = get_by_token(session["token"])
-    if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-    if site["balance"] < 30.0:
+@app.get("/admin/catalog", response_class=HTMLResponse)
+def admin_catalog(key: str = ""):
+    if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
+    key_e = html_lib.escape(key)
+    rows = exec_sql(f"SELECT {CATALOG_COLUMNS} FROM catalog ORDER BY sort, name", fetch="all") or []
+    subs = {}
+    for code, n in read_shards("SELECT item_code, COUNT(*) FROM purchases WHERE active=1 GROUP BY item_code"):
+        subs[code] = subs.get(code, 0) + n
+
+    def item_form(code="", name="", description="", upfront=0, weekly=0, active=1, sort=0, label="Salva"):
+        code_field = (f'<input type="hidden" name="code" value="{html_lib.escape(code)}"><code class="mono">{html_lib.escape(code)}</code>'
+                      if code else '<input name="code" placeholder="codice (a-z, 0-9, -, _)" required>')
+        return f"""
+          <form method="post" action="/admin/catalog">
+            <input type="hidden" name="key" value="{key_e}">
+            {code_field}
+            <input name="name" placeholder="Nome" value="{html_lib.escape(name)}" required>
+            <input name="description" placeholder="Descrizione" value="{html_lib.escape(description or '')}">
+            <input name="upfront" type="number" step="0.01" value="{fmt_cents(upfront)}" title="All'acquisto (+ bonus, - prezzo)">
+            <input name="weekly" type="number" step="0.01" min="0" value="{fmt_cents(weekly)}" title="Addebito settimanale (0 = singolo)">
+            <input name="sort" type="number" step="1" value="{int(sort or 0)}" title="Ordine">
+            <label><input name="active" type="checkbox" value="1" {'checked' if active else ''}> in vendita</label>
+            <button class="btn primary" type="submit">{label}</button>
+          </form>"""
+
+    items_html = "".join(f"""
+        <tr><td>{item_form(*r)}</td><td>{subs.get(r[0], 0)}</td></tr>""" for r in rows)
+    inner = f"""
+      <h2>Catalogo negozio</h2>
+      <p class="muted">All'acquisto: importo con segno (+ bonus, - prezzo). Settimanale: addebito ricorrente, 0 = acquisto singolo.</p>
+      <table>
+        <thead><tr><th>Articolo</th><th>Attivi</th></tr></thead>
+        <tbody>{items_html or '<tr><td colspan=2 class=muted>Nessun articolo</td></tr>'}</tbody>
+      </table>
+      <h3>Nuovo articolo</h3>
+      {item_form(label="Crea")}
+      <p><a class="btn" href="/admin?key={key_e}">Admin</a></p>
+    """
+    return render_page(inner, "Catalogo")
+
+@app.post("/admin/catalog", response_class=HTMLResponse)
+def admin_catalog_save(code: str = Form(""), name: str = Form(""), description: str = Form(""),
+                       upfront: str = Form("0"), weekly: str = Form("0"), sort: int = Form(0),
+                       active: str = Form(""), key: str = Form("")):
+    if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
+    code = code.strip().lower()
+    if not code or not all(ch.isascii() and (ch.isalnum() or ch in "-_") for ch in code) or not name.strip():
+        return render_page("<h3>Codice o nome non valido</h3>", "Errore")
+    try: upfront, weekly = to_cents(upfront or 0), to_cents(weekly or 0)
+    except ValueError: return render_page("<h3>Importo non valido</h3>", "Errore")
+    if weekly < 0:
+        return render_page("<h3>Addebito settimanale non valido</h3>", "Errore")
+    save_catalog_item(code, name, description, upfront, weekly, active == "1", sort)
+    return RedirectResponse(f"/admin/catalog?key={key}", 302)
+
+@app.get("/admin/simulate", response_class=HTMLResponse)
+def admin_simulate(key: str = "", weeks: int = 0, prices: str = ""):
+    if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
+    key_e = html_lib.escape(key)
+    form = f"""
+      <h2>Simulazione saldi</h2>
+      <form method="get" action="/admin/simulate">
+        <input type="hidden" name="key" value="{key_e}">
+        <input name="weeks" type="number" min="1" max="520" value="{weeks or 52}" title="Settimane">
+        <input name="prices" placeholder="nuovi prezzi, es. moccolone=4" value="{html_lib.escape(prices)}">
+        <button class="btn primary" type="submit">Simula</button>
+      </form>
+    """
+    if not weeks:
+        return render_page(form + f'<p><a class="btn" href="/admin?key={key_e}">Admin</a></p>', "Simulazione")
+    try: price_map = parse_prices(prices)
+    except ValueError: return render_page("<h3>Prezzi non validi</h3>", "Errore")
+    try: r = simulate_balances(max(1, min(weeks, 520)), price_map)
+    except ImportError: return render_page("<h3>Simulazione non disponibile: installare numpy</h3>", "Errore")
+
+    def table(rep, label):
+        rows = "".join(f"<tr><td>{html_lib.escape(c['name'])}</td><td>{fmt_bonsaura(c['balance'])}</td>"
+                       f"<td>{c['week']}</td><td>{fmt_bonsaura(c['final'])}</td></tr>" for c in rep["cards"])
+        return f"""
+      <h3>{label}: {rep['count']}</h3>
+      <table><thead><tr><th>Carta</th><th>Saldo ora</th><th>Settimana</th><th>Saldo finale</th></tr></thead>
+      <tbody>{rows or '<tr><td colspan=4 class=muted>Nessuna</td></tr>'}</tbody></table>"""
+
+    inner = form + f"""
+      <p class="muted">{r['cards']} carte, {r['subscriptions']} abbonamenti attivi, {r['weeks']} settimane
+        (lettura {r['load_seconds']}s, proiezione {r['project_seconds']}s). Negative ora: {r['negative_now']},
+        a fine periodo: {r['negative_by_week'][-1]}.</p>
+      {table(r['cross_zero'], 'Vanno sotto zero')}
+      {table(r['cross_threshold'], f'Scendono sotto {fmt_cents(SHOP_THRESHOLD, short=True)} (negozio bloccato)')}
+      <p><a class="btn" href="/admin?key={key_e}">Admin</a></p>
+    """
+    return render_page(inner, "Simulazione")
+
+@app.get("/admin/export")
+def admin_export(key: str = "", format: str = "csv", since: str = "", until: str = "", card: str = ""):
+    if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
+    if format not in ("csv", "ndjson"): return render_page("<h3>Formato non valido</h3>", "Errore")
+    try: start, end = parse_day(since), parse_day(until)
+    except ValueError: return render_page("<h3>Data non valida (AAAA-MM-GG)</h3>", "Errore")
+    if end is not None: end += 24 * 3600  # "fino a" incluso
+    token = None
+    if card:
+        site = get_by_name(card.strip())
+        if not site: return render_page("<h3>Carta non trovata</h3>", "Errore")
+        token = site["token"]
+    filename = f"transazioni{'-' + since if since else ''}{'-' + until if until else ''}.{format}"
+    media = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(export_transactions(format, start, end, token), media_type=media,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/admin/stats")
+def admin_stats(key: str = ""):
+    if not require_key(key): return JSONResponse({"error": "accesso negato"}, 403)
+    segments = archive_segments()
+    return JSONResponse({"pool": POOL.stats(), "async_pool": APOOL.stats(),
+                         "replicas": {"pools": [p.stats() for p in REPLICA_POOLS],
+                                      "async_pools": [p.stats() for p in AREPLICA_POOLS]},
+                         "writer": WRITER.stats() if WRITER else None,
+                         "shards": {"count": SHARDS, "pools": [p.stats() for p in SHARD_POOLS[1:]],
+                                    "in_flight": transfers_in_flight()},
+                         "card_cache": {"enabled": CARD_CACHE, **CARD_CACHE_STORE.stats()},
+                         "settings_cache": SETTINGS_CACHE.stats(), "catalog_cache": CATALOG_CACHE.stats(),
+                         "leaderboard": LEADERBOARD.stats(), "fragment_cache": FRAGMENT_CACHE.stats(),
+                         "archive": {"segments": len(segments), "rows": sum(seg["rows"] for seg in segments)},
+                         "jobs": {name: job.stats() for name, job in JOBS.items()}})
+
+# ---------- SHOP ----------
+@app.get("/shop", response_class=HTMLResponse)
+def shop(ctx: CardContext = Depends(card_context)):
+    site = ctx.card
+    if site["balance"] < SHOP_THRESHOLD:
         return render_page("<h3>Negozio bloccato</h3><p>Saldo minimo 30.</p>", "Negozio")
-    r = exec_sql("SELECT next_charge_at FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                 (site["token"],), fetch="one")
-    status_html = ""
-    action_html = ""
-    if r:
-        nxt = time.strftime("%Y-%m-%d", time.localtime(int(r[0] or 0)))
-        status_html = f"<p class='muted'>Moccolone attivo. Prossimo addebito: {html_lib.escape(nxt)} (-3/settimana)</p>"
-    else:
-        action_html = """
+    owned = owned_items(site["id"])
+    items_html = []
+    for item in get_catalog().values():
+        if not item["active"] and item["code"] not in owned:
+            continue
+        name_e = html_lib.escape(item["name"])
+        if item["code"] in owned:
+            nxt = owned[item["code"]]
+            if nxt:
+                nxt = time.strftime("%Y-%m-%d", time.localtime(nxt))
+                action = f"<p class='muted'>{name_e} attivo. Prossimo addebito: {html_lib.escape(nxt)} (-{fmt_cents(item['weekly'], short=True)}/settimana)</p>"
+            else:
+                action = f"<p class='muted'>{name_e} già acquistato.</p>"
+        else:
+            action = f"""
           <form method="post" action="/buy">
-            <input type="hidden" name="item_code" value="moccolone">
-            <button class="btn success" type="submit">Compra "Moccolone pencs" (+35, poi -3/settimana)</button>
+            <input type="hidden" name="item_code" value="{html_lib.escape(item['code'])}">
+            <button class="btn success" type="submit">Compra "{name_e}" ({fmt_item_terms(item)})</button>
           </form>
         """
+        items_html.append(f"""
+      <div class="content" style="margin:0 0 12px 0">
+        <h3>{name_e}</h3>
+        <p>{html_lib.escape(item['description'])}</p>
+        {action}
+      </div>""")
     inner = f"""
       <h2>Negozio</h2>
-      <div class="content" style="margin:0">
-        <h3>Moccolone pencs</h3>
-        <p>Bonus immediato +35, costo ricorrente -3 Bonsaura / settimana.</p>
-        {status_html}{action_html}
-      </div>
+      {''.join(items_html) or '<p class="muted">Nessun articolo in vendita</p>'}
       <p class="muted">Saldo attuale: {fmt_bonsaura(site['balance'])}</p>
       <div class="grid cols-3">
         <a class="btn secondary" href="/leaderboard">Classifica</a>
@@ -784,1671 +3674,18 @@ def shop(request: Request):
     return render_page(inner, "Negozio")
 
 @app.post("/buy", response_class=HTMLResponse)
-def buy(request: Request, item_code: str = Form(...)):
-    sid = request.cookies.get(SESSION_COOKIE_NAME)
-    if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-    session = get_session_info(sid)
-    if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-    if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-        return render_page("<h3>Sessione non valida</h3>", "Errore")
-    apply_recurring_charges(session["token"])
-    site = get_by_token(session["token"])
-    if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-    if site["balance"] < 30.0:
+def buy(item_code: str = Form(...), ctx: CardContext = Depends(card_context)):
+    site = ctx.card
+    if site["balance"] < SHOP_THRESHOLD:
         return render_page("<h3>Negozio bloccato (saldo < 30)</h3>", "Negozio")
-    if item_code != "moccolone":
+    item = get_catalog().get(item_code)
+    if not item or not item["active"]:
         return render_page("<h3>Articolo non valido</h3>", "Errore")
-    r = exec_sql("SELECT 1 FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                 (site["token"],), fetch="one")
-    if r:
-        return render_page("<h3>Già possiedi Moccolone</h3><p><a href='/shop'>Indietro</a></p>", "Negozio")
-    now = int(time.time())
-    exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (35.0, site["token"]))
-    exec_sql("INSERT INTO purchases (token,item_code,item_name,weekly_deduction,next_charge_at,started_at,active) VALUES (?,?,?,?,?,?,1)",
-             (site["token"], "moccolone", "Moccolone pencs", 3.0, now + WEEK_SECONDS, now))
-    log_transaction(None, "Negozio", site["token"], site["name"], 35.0,
-                    "Acquisto Moccolone: bonus iniziale +35; addebito -3/settimana")
-    # main.py
-    # Requisiti: fastapi, uvicorn, python-multipart, (opzionale) psycopg2-binary per Postgres
-    # Avvio: uvicorn main:app --host 0.0.0.0 --port 8000
-
-    from fastapi import FastAPI, Request, Form
-    from fastapi.responses import HTMLResponse, RedirectResponse
-    import os, sqlite3, secrets, hashlib, time, html as html_lib
-
-    # ---------- CONFIG ----------
-    DB_FILE = os.environ.get("DB_PATH", "cards.db")
-    DATABASE_URL = os.environ.get("DATABASE_URL", "").strip()
-    try:
-        import psycopg2
-    except ImportError:
-        psycopg2 = None
-    USE_PG = DATABASE_URL.startswith("postgres") and psycopg2 is not None
-    if DATABASE_URL.startswith("postgres") and not USE_PG:
-        print("ATTENZIONE: psycopg2-binary non installato, fallback a SQLite.")
-
-    SESSION_TTL = 60 * 5
-    SCAN_WINDOW = 30
-    DEVICE_COOKIE_NAME = "device_id"
-    SESSION_COOKIE_NAME = "session"
-    WEEK_SECONDS = 7 * 24 * 60 * 60
-    ADMIN_KEY = os.environ.get("ADMIN_KEY", "bunald")
-
-    app = FastAPI()
-
-    # ---------- DB LAYER ----------
-    def get_conn():
-        if USE_PG:
-            return psycopg2.connect(DATABASE_URL)
-        return sqlite3.connect(DB_FILE)
-
-    def adapt_sql(sql: str) -> str:
-        return sql.replace("?", "%s") if USE_PG else sql
-
-    def exec_sql(sql: str, params=(), fetch=None):
-        conn = get_conn(); c = conn.cursor()
-        c.execute(adapt_sql(sql), params)
-        data = None
-        if fetch == "one":
-            data = c.fetchone()
-        elif fetch == "all":
-            data = c.fetchall()
-        conn.commit()
-        conn.close()
-        return data
-
-    def init_db():
-        if not USE_PG:
-            d = os.path.dirname(DB_FILE)
-            if d and not os.path.exists(d):
-                os.makedirs(d, exist_ok=True)
-        conn = get_conn(); c = conn.cursor()
-        if USE_PG:
-            c.execute("""CREATE TABLE IF NOT EXISTS cards(
-                id SERIAL PRIMARY KEY,
-                name TEXT UNIQUE,
-                token TEXT UNIQUE,
-                pin_hash TEXT,
-                balance DOUBLE PRECISION DEFAULT 0,
-                bound_device_id TEXT,
-                token_used INTEGER DEFAULT 0,
-                description TEXT DEFAULT ''
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-                sid TEXT PRIMARY KEY,
-                token TEXT,
-                expires BIGINT,
-                created_at BIGINT DEFAULT 0
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS transactions(
-                id SERIAL PRIMARY KEY,
-                ts BIGINT NOT NULL,
-                from_token TEXT,
-                from_name TEXT,
-                to_token TEXT,
-                to_name TEXT,
-                amount DOUBLE PRECISION NOT NULL,
-                reason TEXT
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS purchases(
-                id SERIAL PRIMARY KEY,
-                token TEXT NOT NULL,
-                item_code TEXT NOT NULL,
-                item_name TEXT NOT NULL,
-                weekly_deduction DOUBLE PRECISION NOT NULL,
-                next_charge_at BIGINT NOT NULL,
-                started_at BIGINT NOT NULL,
-                active INTEGER DEFAULT 1
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS settings(
-                id INTEGER PRIMARY KEY,
-                bank_name TEXT,
-                logo_url TEXT,
-                gradient_from TEXT,
-                gradient_to TEXT,
-                font_name TEXT
-            )""")
-        else:
-            c.execute("""CREATE TABLE IF NOT EXISTS cards(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE,
-                token TEXT UNIQUE,
-                pin_hash TEXT,
-                balance REAL DEFAULT 0,
-                bound_device_id TEXT,
-                token_used INTEGER DEFAULT 0,
-                description TEXT DEFAULT ''
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-                sid TEXT PRIMARY KEY,
-                token TEXT,
-                expires INTEGER,
-                created_at INTEGER DEFAULT 0
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS transactions(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ts INTEGER NOT NULL,
-                from_token TEXT,
-                from_name TEXT,
-                to_token TEXT,
-                to_name TEXT,
-                amount REAL NOT NULL,
-                reason TEXT
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS purchases(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                token TEXT NOT NULL,
-                item_code TEXT NOT NULL,
-                item_name TEXT NOT NULL,
-                weekly_deduction REAL NOT NULL,
-                next_charge_at INTEGER NOT NULL,
-                started_at INTEGER NOT NULL,
-                active INTEGER DEFAULT 1
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS settings(
-                id INTEGER PRIMARY KEY CHECK(id=1),
-                bank_name TEXT,
-                logo_url TEXT,
-                gradient_from TEXT,
-                gradient_to TEXT,
-                font_name TEXT
-            )""")
-        c.execute("SELECT id FROM settings WHERE id = 1")
-        if not c.fetchone():
-            c.execute(adapt_sql(
-                "INSERT INTO settings (id, bank_name, logo_url, gradient_from, gradient_to, font_name) VALUES (1, ?, ?, ?, ?, ?)"
-            ), ("Banca NFC", "", "#0ea5e9", "#8b5cf6", "Poppins"))
-        conn.commit(); conn.close()
-
-    init_db()
-
-    # ---------- HELPERS CARD ----------
-    def hash_pin(pin: str) -> str:
-        return hashlib.sha256(pin.encode()).hexdigest()
-
-    def create_site(name: str, pin: str, initial: float = 0.0, description: str = ""):
-        token = secrets.token_urlsafe(16)
-        try:
-            exec_sql("INSERT INTO cards (name, token, pin_hash, balance, description) VALUES (?, ?, ?, ?, ?)",
-                     (name, token, hash_pin(pin), float(initial), description.strip()))
-            return token
-        except Exception:
-            return None
-
-    def get_by_token(token: str):
-        r = exec_sql(
-            "SELECT id,name,token,pin_hash,balance,bound_device_id,token_used,description FROM cards WHERE token=?",
-            (token,), fetch="one")
-        if not r: return None
-        return {
-            "id": r[0], "name": r[1], "token": r[2], "pin_hash": r[3], "balance": r[4],
-            "bound_device_id": r[5], "token_used": r[6], "description": r[7]
-        }
-
-    def get_by_name(name: str):
-        r = exec_sql(
-            "SELECT id,name,token,pin_hash,balance,bound_device_id,token_used,description FROM cards WHERE name=?",
-            (name,), fetch="one")
-        if not r: return None
-        return {
-            "id": r[0], "name": r[1], "token": r[2], "pin_hash": r[3], "balance": r[4],
-            "bound_device_id": r[5], "token_used": r[6], "description": r[7]
-        }
-
-    def mark_token_used(token: str):
-        exec_sql("UPDATE cards SET token_used=1 WHERE token=?", (token,))
-
-    def bind_device_id(token: str, device_id: str):
-        exec_sql("UPDATE cards SET bound_device_id=? WHERE token=?", (device_id, token))
-
-    def unbind_device_id(token: str):
-        exec_sql("UPDATE cards SET bound_device_id=NULL, token_used=0 WHERE token=?", (token,))
-
-    def update_balance_by_token(token: str, newbal: float):
-        exec_sql("UPDATE cards SET balance=? WHERE token=?", (float(newbal), token))
-
-    def adjust_balance(token: str, delta: float):
-        exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (float(delta), token))
-
-    def log_transaction(from_token, from_name, to_token, to_name, amount, reason):
-        exec_sql("INSERT INTO transactions (ts,from_token,from_name,to_token,to_name,amount,reason) VALUES (?,?,?,?,?,?,?)",
-                 (int(time.time()), from_token, from_name, to_token, to_name, float(amount), reason))
-
-    def get_recent_transactions(token: str, limit: int = 10):
-        placeholder = "%s" if USE_PG else "?"
-        conn = get_conn(); c = conn.cursor()
-        c.execute(f"""
-            SELECT ts, from_name, to_name, amount, reason
-            FROM transactions
-            WHERE from_token = {placeholder} OR to_token = {placeholder}
-            ORDER BY ts DESC
-            LIMIT {int(limit)}
-        """, (token, token))
-        rows = c.fetchall(); conn.close()
-        return [{"ts": r[0], "from_name": r[1], "to_name": r[2], "amount": r[3], "reason": r[4]} for r in rows]
-
-    def fmt_ts(ts: int) -> str:
-        try: return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(ts)))
-        except: return str(ts)
-
-    def get_settings():
-        r = exec_sql("SELECT bank_name,logo_url,gradient_from,gradient_to,font_name FROM settings WHERE id=1", fetch="one")
-        if not r:
-            return {"bank_name":"Banca NFC","logo_url":"","gradient_from":"#0ea5e9","gradient_to":"#8b5cf6","font_name":"Poppins"}
-        return {"bank_name": r[0] or "Banca NFC", "logo_url": r[1] or "", "gradient_from": r[2] or "#0ea5e9",
-                "gradient_to": r[3] or "#8b5cf6", "font_name": r[4] or "Poppins"}
-
-    def update_settings(bank_name, logo_url, gradient_from, gradient_to, font_name):
-        exec_sql("UPDATE settings SET bank_name=?,logo_url=?,gradient_from=?,gradient_to=?,font_name=? WHERE id=1",
-                 (bank_name.strip(), logo_url.strip(), gradient_from.strip(), gradient_to.strip(), font_name.strip()))
-
-    # ---------- SESSIONS ----------
-    def create_session_for_token(token: str):
-        sid = secrets.token_urlsafe(24)
-        now = int(time.time())
-        exec_sql("INSERT INTO sessions (sid, token, expires, created_at) VALUES (?, ?, ?, ?)",
-                 (sid, token, now + SESSION_TTL, now))
-        return sid
-
-    def get_session_info(sid: str):
-        r = exec_sql("SELECT token,expires,created_at FROM sessions WHERE sid=?", (sid,), fetch="one")
-        if not r: return None
-        token, expires, created_at = r
-        now = int(time.time())
-        if now > (expires or 0):
-            exec_sql("DELETE FROM sessions WHERE sid=?", (sid,))
-            return None
-        return {"token": token, "expires": int(expires or 0), "created_at": int(created_at or 0)}
-
-    def delete_session(sid: str):
-        exec_sql("DELETE FROM sessions WHERE sid=?", (sid,))
-
-    # ---------- COOKIE / RENDER ----------
-    def is_https(request: Request) -> bool:
-        xf = request.headers.get("x-forwarded-proto", "")
-        return (request.url.scheme == "https") or ("https" in xf)
-
-    def set_cookie(resp, name, value, max_age=None, httponly=False, request: Request = None):
-        resp.set_cookie(name, value, max_age=max_age, samesite="Lax", httponly=httponly,
-            secure=is_https(request) if request else False, path="/")
-
-    def render_page(inner_html: str, title: str = "") -> HTMLResponse:
-        s = get_settings()
-        title_text = title or s["bank_name"]
-        font = s["font_name"] or "Poppins"
-        google_font = font.replace(" ", "+")
-        logo_html = f"<img src='{html_lib.escape(s['logo_url'])}' alt='' style='height:28px;margin-right:10px;border-radius:6px'>" if s["logo_url"] else ""
-        header_name = html_lib.escape(s["bank_name"])
-        html = f"""<!doctype html><html lang="it"><head>
-          <meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
-          <title>{html_lib.escape(title_text)}</title>
-          <link href="https://fonts.googleapis.com/css2?family={google_font}:wght@400;600;700&display=swap" rel="stylesheet">
-          <style>
-            :root {{ --grad-from:{html_lib.escape(s["gradient_from"])}; --grad-to:{html_lib.escape(s["gradient_to"])}; }}
-            body {{ margin:0;font-family:'{font}',system-ui,-apple-system,Segoe UI,Roboto,Arial,sans-serif;
-              background:linear-gradient(135deg,var(--grad-from),var(--grad-to));min-height:100vh;color:#0f172a; }}
-            .wrap {{ max-width:980px;margin:0 auto;padding:16px; }}
-            .nav {{ display:flex;justify-content:space-between;align-items:center;background:rgba(255,255,255,0.85);
-              backdrop-filter:blur(6px);border:1px solid rgba(255,255,255,0.6);border-radius:14px;padding:10px 14px;margin:16px 0; }}
-            .brand {{ display:flex;align-items:center;font-weight:700;font-size:18px; }}
-            .content {{ background:rgba(255,255,255,0.92);border:1px solid rgba(255,255,255,0.6);border-radius:16px;padding:18px;margin:16px 0; }}
-            .btn {{ display:inline-block;padding:10px 14px;border:none;border-radius:10px;cursor:pointer;font-weight:600;
-              text-decoration:none;color:#0f172a;background:#e2e8f0; }}
-            .btn.primary {{ background:#0ea5e9;color:#fff; }} .btn.secondary {{ background:#64748b;color:#fff; }}
-            .btn.danger {{ background:#ef4444;color:#fff; }} .btn.success {{ background:#10b981;color:#fff; }}
-            input,select,textarea {{ width:100%;padding:10px;border:1px solid #e2e8f0;border-radius:10px;box-sizing:border-box;margin-top:6px;margin-bottom:8px; }}
-            table {{ width:100%;border-collapse:collapse; }} th,td {{ padding:10px;border-bottom:1px solid #e2e8f0;text-align:left; }}
-            .muted {{ color:#475569;font-size:13px; }} .pill {{ display:inline-block;padding:2px 8px;border-radius:999px;background:#e2e8f0;font-size:12px; }}
-            .mono {{ font-family:ui-monospace,Consolas,monospace; }} .grid {{ display:grid;gap:12px; }}
-            @media(min-width:720px) {{ .grid.cols-2 {{ grid-template-columns:1fr 1fr; }} .grid.cols-3 {{ grid-template-columns:1fr 1fr 1fr; }} }}
-          </style></head><body>
-          <div class="wrap">
-            <div class="nav">
-              <div class="brand">{logo_html}<span>{header_name}</span></div>
-              <div style="display:flex;gap:8px"><a class="btn" href="/">Home</a></div>
-            </div>
-            <div class="content">{inner_html}</div>
-          </div></body></html>"""
-        return HTMLResponse(html)
-
-    def fmt_bonsaura(a: float) -> str:
-        try: return f"{float(a):.2f} Bonsaura"
-        except: return f"{a} Bonsaura"
-
-    # ---------- RECURRING CHARGES ----------
-    def apply_recurring_charges(token: str):
-        now = int(time.time())
-        r = exec_sql("SELECT name FROM cards WHERE token=?", (token,), fetch="one")
-        from_name = r[0] if r else ""
-        conn = get_conn(); c = conn.cursor()
-        c.execute(adapt_sql("SELECT id,item_name,weekly_deduction,next_charge_at FROM purchases WHERE token=? AND active=1"), (token,))
-        rows = c.fetchall()
-        for pid, item_name, weekly, next_ts in rows:
-            ts = int(next_ts or 0)
-            charges = 0
-            while ts and ts <= now:
-                charges += 1
-                ts += WEEK_SECONDS
-            if charges > 0:
-                amount = float(weekly) * charges
-                c.execute(adapt_sql("UPDATE cards SET balance = balance - ? WHERE token=?"), (amount, token))
-                c.execute(adapt_sql("UPDATE purchases SET next_charge_at=? WHERE id=?"), (ts, pid))
-                c.execute(adapt_sql(
-                    "INSERT INTO transactions (ts,from_token,from_name,to_token,to_name,amount,reason) VALUES (?,?,?,?,?,?,?)"),
-                    (now, token, from_name, None, "Negozio", -amount,
-                     f"Addebito {item_name} (-{weekly:.0f}/settimana) x{charges}"))
-        conn.commit(); conn.close()
-
-    # ---------- ROUTES ----------
-    @app.get("/", response_class=HTMLResponse)
-    def home():
-        inner = f"""
-          <h2>Benvenuto</h2>
-          <p class="muted">Accedi al pannello amministrativo o visualizza la lista carte. Inserisci la key.</p>
-          <form class="grid cols-3" method="get" action="/go">
-            <div><input name="key" placeholder="Chiave admin" required></div>
-            <div><button class="btn primary" type="submit" name="dest" value="admin">Admin</button></div>
-            <div><button class="btn secondary" type="submit" name="dest" value="lista">Lista</button></div>
-          </form>
-          <p class="muted">Per usare una carta: tap NFC su /launch/&lt;token&gt; (valido per {SCAN_WINDOW}s).</p>
-        """
-        return render_page(inner, "Home")
-
-    @app.get("/go")
-    def go(dest: str = "", key: str = ""):
-        if dest == "admin": return RedirectResponse(f"/admin?key={key}", 302)
-        if dest == "lista": return RedirectResponse(f"/lista?key={key}", 302)
-        return render_page("<h3>Destinazione non valida</h3>", "Errore")
-
-    @app.get("/create", response_class=HTMLResponse)
-    def create_via_link(request: Request, name: str = "", code: str = "", initial: float = 0.0, desc: str = ""):
-        if not name or not code:
-            return render_page("<h3>Parametri mancanti (?name=&code=)</h3>", "Errore")
-        r = exec_sql("SELECT COUNT(*) FROM cards", fetch="one")
-        if (r[0] if r else 0) >= 10:
-            return render_page("<h3>Limite 10 carte raggiunto</h3>", "Limite")
-        token = create_site(name, code, initial, desc)
-        if not token:
-            return render_page("<h3>Nome già esistente</h3>", "Errore")
-        base = str(request.base_url).rstrip("/")
-        url = f"{base}/launch/{token}"
-        inner = f"""
-          <h3>✅ Carta '{html_lib.escape(name)}' creata</h3>
-          <p>Saldo iniziale: {fmt_bonsaura(initial)}</p>
-          <p>URL NFC:</p><pre class="mono">{html_lib.escape(url)}</pre>
-        """
-        return render_page(inner, "Carta creata")
-
-    @app.get("/launch/{token}")
-    @app.head("/launch/{token}")
-    def launch(token: str, request: Request):
-        site = get_by_token(token)
-        if not site:
-            return render_page("<h3>Tag non valido</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if site["bound_device_id"] and device_id != site["bound_device_id"]:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-        resp = RedirectResponse("/card", 302)
-        if not device_id:
-            device_id = secrets.token_hex(16)
-            set_cookie(resp, DEVICE_COOKIE_NAME, device_id, max_age=60*60*24*365, httponly=True, request=request)
-        sid = create_session_for_token(token)
-        set_cookie(resp, SESSION_COOKIE_NAME, sid, max_age=SESSION_TTL, httponly=True, request=request)
-        return resp
-
-    @app.get("/card", response_class=HTMLResponse)
-    def card_from_session(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid:
-            return render_page(f"<h3>Sessione mancante</h3><p>Tap NFC (entro {SCAN_WINDOW}s).</p>", "Richiesto NFC")
-        session = get_session_info(sid)
-        if not session:
-            return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida (scaduto timeout NFC)</h3>", "Non valida")
-        site = get_by_token(session["token"])
-        if not site:
-            return render_page("<h3>Tag non valido</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if site["bound_device_id"] and site["bound_device_id"] != device_id:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-        inner = f"""
-          <h2>{html_lib.escape(site['name'])}</h2>
-          <p><strong>Saldo:</strong> {fmt_bonsaura(site['balance'])}</p>
-          <p class="muted">{html_lib.escape(site.get('description') or '')}</p>
-          <h4>Accedi</h4>
-          <form method="post" action="/unlock">
-            <input type="hidden" name="token" value="{html_lib.escape(site['token'])}">
-            <input name="pin" type="password" placeholder="PIN" required>
-            <button class="btn primary" type="submit">Accedi</button>
-          </form>
-          <p class="muted">Completa entro {SCAN_WINDOW}s dal tap.</p>
-        """
-        return render_page(inner, site["name"])
-
-    @app.post("/unlock", response_class=HTMLResponse)
-    def unlock(request: Request, token: str = Form(...), pin: str = Form(...)):
-        site = get_by_token(token)
-        if not site: return render_page("<h3>Token non valido</h3>", "Errore")
-        if site["pin_hash"] != hash_pin(pin):
-            return render_page("<h3>PIN errato</h3><p><a href='/card'>Riprova</a></p>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if not device_id:
-            return render_page("<h3>Cookie dispositivo mancante (rifai tap)</h3>", "Errore")
-        if not site["bound_device_id"]:
-            bind_device_id(token, device_id)
-            mark_token_used(token)
-            site = get_by_token(token)
-        if site["bound_device_id"] != device_id:
-            return render_page("<h3>Dispositivo non autorizzato</h3>", "Bloccato")
-        apply_recurring_charges(site["token"])
-        site = get_by_token(token)
-        can_shop = site["balance"] >= 30.0
-        shop_btn = '<a class="btn" href="/shop">Negozio</a>' if can_shop else '<button class="btn" disabled>Negozio (saldo &lt; 30)</button>'
-        inner = f"""
-          <h2>Benvenuto, {html_lib.escape(site['name'])}</h2>
-          <p class="muted">Saldo: {fmt_bonsaura(site['balance'])}</p>
-          <div class="grid cols-3">
-            <div><a class="btn secondary" href="/leaderboard">Classifica</a></div>
-            <div><a class="btn primary" href="/bank">Banca</a></div>
-            <div>{shop_btn}</div>
-          </div>
-          <p class="muted">Oggetto disponibile: “Moccolone pencs” (+35 subito, -3/settimana).</p>
-        """
-        return render_page(inner, "Menu")
-
-    @app.get("/leaderboard", response_class=HTMLResponse)
-    def leaderboard(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        rows = exec_sql("SELECT name,balance,token FROM cards ORDER BY balance DESC, id ASC", fetch="all")
-        palette = ["#ef4444","#f97316","#f59e0b","#eab308","#84cc16","#22c55e","#06b6d4","#3b82f6","#8b5cf6","#db2777"]
-        body = []
-        for idx, r in enumerate(rows or [], start=1):
-            name, balance, token = r
-            me = token == session["token"]
-            color = palette[(idx-1)%len(palette)]
-            mark = " — tu" if me else ""
-            body.append(f"""
-              <tr style="border-left:8px solid {html_lib.escape(color)};{'font-weight:700;background:rgba(0,0,0,0.03);' if me else ''}">
-                <td>#{idx}</td><td>{html_lib.escape(name)}{mark}</td><td>{fmt_bonsaura(balance)}</td>
-              </tr>
-            """)
-        inner = f"""
-          <h2>Classifica Bonsaura</h2>
-          <table><thead><tr><th>Pos</th><th>Banca</th><th>Punti</th></tr></thead>
-          <tbody>{''.join(body) or '<tr><td colspan=3 class=muted>Nessuna carta</td></tr>'}</tbody></table>
-          <div class="grid cols-2" style="margin-top:12px">
-            <div><a class="btn secondary" href="/bank">Banca</a></div>
-            <div><a class="btn" href="/">Home</a></div>
-          </div>
-        """
-        return render_page(inner, "Classifica")
-
-    @app.get("/bank", response_class=HTMLResponse)
-    def bank(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        site = get_by_token(session["token"])
-        if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if site["bound_device_id"] and site["bound_device_id"] != device_id:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-
-        # Menu a tendina con banche disponibili (escluso se stesso)
-        dest_rows = exec_sql("SELECT name FROM cards WHERE token <> ? ORDER BY name", (site["token"],), fetch="all") or []
-        options_html = "".join(
-            f"<option value=\"{html_lib.escape(n[0])}\">{html_lib.escape(n[0])}</option>" for n in dest_rows
-        )
-
-        recent = get_recent_transactions(site["token"], limit=10)
-        rows_html = "".join(
-            f"<tr><td>{fmt_ts(t['ts'])}</td><td>{html_lib.escape(t['from_name'] or '-')}</td>"
-            f"<td>{html_lib.escape(t['to_name'] or '-')}</td><td>{fmt_bonsaura(t['amount'])}</td>"
-            f"<td>{html_lib.escape(t['reason'] or '')}</td></tr>"
-            for t in recent
-        ) or '<tr><td colspan="5" class="muted">Nessuna transazione</td></tr>'
-
-        inner = f"""
-          <h2>{html_lib.escape(site['name'])}</h2>
-          <p><strong>Saldo:</strong> {fmt_bonsaura(site['balance'])}</p>
-          <p class="muted">{html_lib.escape(site.get('description') or '')}</p>
-
-          <h4>Invia denaro</h4>
-          <form method="post" action="/transfer">
-            <input type="hidden" name="from_token" value="{html_lib.escape(site['token'])}">
-            <label>Banca destinataria</label>
-            <select name="to_name" required>
-              <option value="" disabled selected>Seleziona banca…</option>
-              {options_html}
-            </select>
-            <input name="amount" type="number" step="0.01" placeholder="Importo" required>
-            <textarea name="reason" rows="2" placeholder="Motivazione (obbligatoria)" required></textarea>
-            <button class="btn primary" type="submit">Invia</button>
-          </form>
-
-          <h4 style="margin-top:16px">Ultime operazioni</h4>
-          <table>
-            <thead><tr><th>Data</th><th>Da</th><th>A</th><th>Importo</th><th>Motivazione</th></tr></thead>
-            <tbody>{rows_html}</tbody>
-          </table>
-        """
-        return render_page(inner, site["name"])
-
-    @app.post("/transfer", response_class=HTMLResponse)
-    def transfer(request: Request,
-                 from_token: str = Form(...),
-                 to_name: str = Form(...),
-                 amount: str = Form(...),
-                 reason: str = Form(...)):
-        from_site = get_by_token(from_token)
-        if not from_site: return render_page("<h3>Mittente non trovato</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if not from_site["bound_device_id"] or from_site["bound_device_id"] != device_id:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-
-        to_name = (to_name or "").strip()
-        if not to_name:
-            return render_page("<h3>Seleziona una banca destinataria</h3>", "Errore")
-
-        reason = (reason or "").strip()
-        if not reason: return render_page("<h3>Motivazione obbligatoria</h3>", "Errore")
-        if len(reason) > 300: return render_page("<h3>Motivazione troppo lunga</h3>", "Errore")
-
-        try: amt = float(amount)
-        except: return render_page("<h3>Importo non valido</h3>", "Errore")
-        if amt <= 0: return render_page("<h3>Importo deve essere positivo</h3>", "Errore")
-        if from_site["balance"] < amt:
-            return render_page(f"<h3>Saldo insufficiente ({fmt_bonsaura(from_site['balance'])})</h3>", "Errore")
-
-        dest = get_by_name(to_name)
-        if not dest:
-            return render_page(
-                f"<h3>Banca '{html_lib.escape(to_name)}' non trovata</h3>"
-                f"<p>Nessun punto inviato.</p>"
-                f"<p><a href='/bank'>Torna</a></p>", "Errore")
-
-        update_balance_by_token(from_site["token"], from_site["balance"] - amt)
-        update_balance_by_token(dest["token"], dest["balance"] + amt)
-        log_transaction(from_site["token"], from_site["name"], dest["token"], dest["name"], amt, reason)
-        return render_page(
-            f"<h3>Trasferimento di {fmt_bonsaura(amt)} a {html_lib.escape(to_name)} eseguito.</h3>"
-            f"<p>Motivazione: {html_lib.escape(reason)}</p><p><a href='/card'>Torna</a></p>", "OK")
-
-    # ---------- ADMIN ----------
-    def require_key(key: str) -> bool:
-        return key == ADMIN_KEY
-
-    @app.get("/lista", response_class=HTMLResponse)
-    def lista(key: str = ""):
-        if not require_key(key):
-            return render_page("<h3>Accesso negato</h3>", "403")
-        rows = exec_sql("SELECT name,balance,bound_device_id,token_used,description FROM cards ORDER BY id", fetch="all")
-        body = ""
-        for name, balance, bound, used, desc in rows or []:
-            body += f"""
-              <tr>
-                <td>{html_lib.escape(name)}</td>
-                <td>{fmt_bonsaura(balance)}</td>
-                <td><span class="pill">{'associata' if bound else 'libera'}</span></td>
-                <td>{'sì' if used else 'no'}</td>
-                <td>{html_lib.escape(desc or '')}</td>
-              </tr>
-            """
-        inner = f"""
-          <h2>Lista carte</h2>
-          <table>
-            <thead><tr><th>Nome</th><th>Saldo</th><th>Binding</th><th>Usata</th><th>Descrizione</th></tr></thead>
-            <tbody>{body or '<tr><td colspan=5 class=muted>Nessuna carta</td></tr>'}</tbody>
-          </table>
-          <p class="muted">I token non sono mostrati.</p>
-        """
-        return render_page(inner, "Lista carte")
-
-    @app.get("/admin", response_class=HTMLResponse)
-    def admin_panel(request: Request, key: str = ""):
-        if not require_key(key):
-            return render_page("<h3>Accesso negato</h3>", "403")
-        s = get_settings()
-        base = str(request.base_url).rstrip("/")
-        rows = exec_sql("SELECT name,token,balance,bound_device_id,description FROM cards ORDER BY id", fetch="all")
-        cards_html = ""
-        for name, token, balance, bound, desc in rows or []:
-            token_e = html_lib.escape(token)
-            url_nfc = html_lib.escape(f"{base}/launch/{token}")
-            cards_html += f"""
-              <tr>
-                <td>{html_lib.escape(name)}<br>
-                  <span class="muted">token:</span> <code class="mono">{token_e}</code><br>
-                  <div style="display:flex;gap:6px;margin-top:6px">
-                    <button class="btn" type="button" onclick="copyText('{token_e}')">Copia token</button>
-                    <button class="btn secondary" type="button" onclick="copyText('{url_nfc}')">Copia URL NFC</button>
-                  </div>
-                </td>
-                <td>{fmt_bonsaura(balance)}</td>
-                <td><span class="pill">{'associata' if bound else 'libera'}</span></td>
-                <td>{html_lib.escape(desc or '')}</td>
-                <td style="min-width:260px">
-                  <form style="display:inline-block" method="post" action="/admin/adjust">
-                    <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                    <input type="hidden" name="token" value="{token_e}">
-                    <input name="delta" type="number" step="0.01" placeholder="+/-" required style="width:110px">
-                    <button class="btn success" type="submit">Applica</button>
-                  </form>
-                  <form style="display:inline-block" method="post" action="/admin/reset">
-                    <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                    <input type="hidden" name="token" value="{token_e}">
-                    <button class="btn secondary" type="submit">Reset bind</button>
-                  </form>
-                  <form style="display:inline-block" method="post" action="/admin/delete">
-                    <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                    <input type="hidden" name="token" value="{token_e}">
-                    <button class="btn danger" type="submit" onclick="return confirm('Eliminare?')">Elimina</button>
-                  </form>
-                </td>
-              </tr>
-            """
-        inner = f"""
-          <h2>Admin</h2>
-          <div class="grid cols-2">
-            <div>
-              <h3>Crea carta</h3>
-              <form method="post" action="/admin/create">
-                <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                <input name="name" placeholder="Nome" required>
-                <input name="pin" placeholder="PIN" required>
-                <input name="initial" type="number" step="0.01" placeholder="Saldo iniziale" value="0">
-                <input name="desc" placeholder="Descrizione">
-                <button class="btn primary" type="submit">Crea</button>
-              </form>
-            </div>
-            <div>
-              <h3>Personalizzazione</h3>
-                <form method="post" action="/admin/settings">
-                  <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                  <input name="bank_name" placeholder="Nome banca" value="{html_lib.escape(s['bank_name'])}">
-                  <input name="logo_url" placeholder="Logo URL" value="{html_lib.escape(s['logo_url'])}">
-                  <input name="gradient_from" placeholder="Gradiente da" value="{html_lib.escape(s['gradient_from'])}">
-                  <input name="gradient_to" placeholder="Gradiente a" value="{html_lib.escape(s['gradient_to'])}">
-                  <input name="font_name" placeholder="Font Google" value="{html_lib.escape(s['font_name'])}">
-                  <button class="btn primary" type="submit">Salva stile</button>
-                </form>
-            </div>
-          </div>
-          <h3>Carte</h3>
-          <table>
-            <thead><tr><th>Nome/Token</th><th>Saldo</th><th>Binding</th><th>Descrizione</th><th>Azioni</th></tr></thead>
-            <tbody>{cards_html or '<tr><td colspan=5 class=muted>Nessuna carta</td></tr>'}</tbody>
-          </table>
-          <script>
-            function copyText(t) {{
-              if (navigator.clipboard) {{
-                navigator.clipboard.writeText(t).then(()=>alert('Copiato')).catch(()=>window.prompt('Copia:', t));
-              }} else window.prompt('Copia:', t);
-            }}
-          </script>
-        """
-        return render_page(inner, "Admin")
-
-    @app.post("/admin/create", response_class=HTMLResponse)
-    def admin_create(name: str = Form(""), pin: str = Form(""), initial: float = Form(0.0),
-                     desc: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        if not name or not pin: return render_page("<h3>Nome e PIN richiesti</h3>", "Errore")
-        cnt = exec_sql("SELECT COUNT(*) FROM cards", fetch="one")[0]
-        if cnt >= 10: return render_page("<h3>Limite 10 carte raggiunto</h3>", "Limite")
-        token = create_site(name, pin, initial, desc)
-        if not token: return render_page("<h3>Nome già esistente</h3>", "Errore")
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/adjust", response_class=HTMLResponse)
-    def admin_adjust(token: str = Form(""), delta: float = Form(0.0), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        site = get_by_token(token)
-        if not site: return render_page("<h3>Carta non trovata</h3>", "Errore")
-        try: float(delta)
-        except: return render_page("<h3>Delta non valido</h3>", "Errore")
-        adjust_balance(token, float(delta))
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/reset", response_class=HTMLResponse)
-    def admin_reset(token: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        if not get_by_token(token): return render_page("<h3>Token non trovato</h3>", "Errore")
-        unbind_device_id(token)
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/delete", response_class=HTMLResponse)
-    def admin_delete(token: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        if not get_by_token(token): return render_page("<h3>Token non trovato</h3>", "Errore")
-        exec_sql("DELETE FROM cards WHERE token=?", (token,))
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/settings", response_class=HTMLResponse)
-    def admin_settings(bank_name: str = Form(""), logo_url: str = Form(""),
-                       gradient_from: str = Form(""), gradient_to: str = Form(""),
-                       font_name: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        update_settings(bank_name or "Banca NFC", logo_url or "", gradient_from or "#0ea5e9",
-                        gradient_to or "#8b5cf6", font_name or "Poppins")
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    # ---------- SHOP ----------
-    @app.get("/shop", response_class=HTMLResponse)
-    def shop(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        site = get_by_token(session["token"])
-        if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-        if site["balance"] < 30.0:
-            return render_page("<h3>Negozio bloccato</h3><p>Saldo minimo 30.</p>", "Negozio")
-        r = exec_sql("SELECT next_charge_at FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                     (site["token"],), fetch="one")
-        status_html = ""
-        action_html = ""
-        if r:
-            nxt = time.strftime("%Y-%m-%d", time.localtime(int(r[0] or 0)))
-            status_html = f"<p class='muted'>Moccolone attivo. Prossimo addebito: {html_lib.escape(nxt)} (-3/settimana)</p>"
-        else:
-            action_html = """
-              <form method="post" action="/buy">
-                <input type="hidden" name="item_code" value="moccolone">
-                <button class="btn success" type="submit">Compra "Moccolone pencs" (+35, poi -3/settimana)</button>
-              </form>
-            """
-        inner = f"""
-          <h2>Negozio</h2>
-          <div class="content" style="margin:0">
-            <h3>Moccolone pencs</h3>
-            <p>Bonus immediato +35, costo ricorrente -3 Bonsaura / settimana.</p>
-            {status_html}{action_html}
-          </div>
-          <p class="muted">Saldo attuale: {fmt_bonsaura(site['balance'])}</p>
-          <div class="grid cols-3">
-            <a class="btn secondary" href="/leaderboard">Classifica</a>
-            <a class="btn primary" href="/bank">Banca</a>
-            <a class="btn" href="/">Home</a>
-          </div>
-        """
-        return render_page(inner, "Negozio")
-
-    @app.post("/buy", response_class=HTMLResponse)
-    def buy(request: Request, item_code: str = Form(...)):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        site = get_by_token(session["token"])
-        if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-        if site["balance"] < 30.0:
-            return render_page("<h3>Negozio bloccato (saldo < 30)</h3>", "Negozio")
-        if item_code != "moccolone":
-            return render_page("<h3>Articolo non valido</h3>", "Errore")
-        r = exec_sql("SELECT 1 FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                     (site["token"],), fetch="one")
-        if r:
-            return render_page("<h3>Già possiedi Moccolone</h3><p><a href='/shop'>Indietro</a></p>", "Negozio")
-        now = int(time.time())
-        exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (35.0, site["token"]))
-        exec_sql("INSERT INTO purchases (token,item_code,item_name,weekly_deduction,next_charge_at,started_at,active) VALUES (?,?,?,?,?,?,1)",
-                 (site["token"], "moccolone", "Moccolone pencs", 3.0, now + WEEK_SECONDS, now))
-        log_transaction(None, "Negozio", site["token"], site["name"], 35.0,
-                        "Acquisto Moccolone: bonus iniziale +35; addebito -3/settimana")
-        return RedirectResponse("/shop", 302)
-    # main.py
-    # Requisiti: fastapi, uvicorn, python-multipart, (opzionale) psycopg2-binary per Postgres
-    # Avvio: uvicorn main:app --host 0.0.0.0 --port 8000
-
-    from fastapi import FastAPI, Request, Form
-    from fastapi.responses import HTMLResponse, RedirectResponse
-    import os, sqlite3, secrets, hashlib, time, html as html_lib
-
-    # ---------- CONFIG ----------
-    DB_FILE = os.environ.get("DB_PATH", "cards.db")
-    DATABASE_URL = os.environ.get("DATABASE_URL", "").strip()
-    try:
-        import psycopg2
-    except ImportError:
-        psycopg2 = None
-    USE_PG = DATABASE_URL.startswith("postgres") and psycopg2 is not None
-    if DATABASE_URL.startswith("postgres") and not USE_PG:
-        print("ATTENZIONE: psycopg2-binary non installato, fallback a SQLite.")
-
-    SESSION_TTL = 60 * 5
-    SCAN_WINDOW = 30
-    DEVICE_COOKIE_NAME = "device_id"
-    SESSION_COOKIE_NAME = "session"
-    WEEK_SECONDS = 7 * 24 * 60 * 60
-    ADMIN_KEY = os.environ.get("ADMIN_KEY", "bunald")
-
-    app = FastAPI()
-
-    # ---------- DB LAYER ----------
-    def get_conn():
-        if USE_PG:
-            return psycopg2.connect(DATABASE_URL)
-        return sqlite3.connect(DB_FILE)
-
-    def adapt_sql(sql: str) -> str:
-        return sql.replace("?", "%s") if USE_PG else sql
-
-    def exec_sql(sql: str, params=(), fetch=None):
-        conn = get_conn(); c = conn.cursor()
-        c.execute(adapt_sql(sql), params)
-        data = None
-        if fetch == "one":
-            data = c.fetchone()
-        elif fetch == "all":
-            data = c.fetchall()
-        conn.commit()
-        conn.close()
-        return data
-
-    def init_db():
-        if not USE_PG:
-            d = os.path.dirname(DB_FILE)
-            if d and not os.path.exists(d):
-                os.makedirs(d, exist_ok=True)
-        conn = get_conn(); c = conn.cursor()
-        if USE_PG:
-            c.execute("""CREATE TABLE IF NOT EXISTS cards(
-                id SERIAL PRIMARY KEY,
-                name TEXT UNIQUE,
-                token TEXT UNIQUE,
-                pin_hash TEXT,
-                balance DOUBLE PRECISION DEFAULT 0,
-                bound_device_id TEXT,
-                token_used INTEGER DEFAULT 0,
-                description TEXT DEFAULT ''
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-                sid TEXT PRIMARY KEY,
-                token TEXT,
-                expires BIGINT,
-                created_at BIGINT DEFAULT 0
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS transactions(
-                id SERIAL PRIMARY KEY,
-                ts BIGINT NOT NULL,
-                from_token TEXT,
-                from_name TEXT,
-                to_token TEXT,
-                to_name TEXT,
-                amount DOUBLE PRECISION NOT NULL,
-                reason TEXT
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS purchases(
-                id SERIAL PRIMARY KEY,
-                token TEXT NOT NULL,
-                item_code TEXT NOT NULL,
-                item_name TEXT NOT NULL,
-                weekly_deduction DOUBLE PRECISION NOT NULL,
-                next_charge_at BIGINT NOT NULL,
-                started_at BIGINT NOT NULL,
-                active INTEGER DEFAULT 1
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS settings(
-                id INTEGER PRIMARY KEY,
-                bank_name TEXT,
-                logo_url TEXT,
-                gradient_from TEXT,
-                gradient_to TEXT,
-                font_name TEXT
-            )""")
-        else:
-            c.execute("""CREATE TABLE IF NOT EXISTS cards(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE,
-                token TEXT UNIQUE,
-                pin_hash TEXT,
-                balance REAL DEFAULT 0,
-                bound_device_id TEXT,
-                token_used INTEGER DEFAULT 0,
-                description TEXT DEFAULT ''
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-                sid TEXT PRIMARY KEY,
-                token TEXT,
-                expires INTEGER,
-                created_at INTEGER DEFAULT 0
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS transactions(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ts INTEGER NOT NULL,
-                from_token TEXT,
-                from_name TEXT,
-                to_token TEXT,
-                to_name TEXT,
-                amount REAL NOT NULL,
-                reason TEXT
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS purchases(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                token TEXT NOT NULL,
-                item_code TEXT NOT NULL,
-                item_name TEXT NOT NULL,
-                weekly_deduction REAL NOT NULL,
-                next_charge_at INTEGER NOT NULL,
-                started_at INTEGER NOT NULL,
-                active INTEGER DEFAULT 1
-            )""")
-            c.execute("""CREATE TABLE IF NOT EXISTS settings(
-                id INTEGER PRIMARY KEY CHECK(id=1),
-                bank_name TEXT,
-                logo_url TEXT,
-                gradient_from TEXT,
-                gradient_to TEXT,
-                font_name TEXT
-            )""")
-        c.execute("SELECT id FROM settings WHERE id = 1")
-        if not c.fetchone():
-            c.execute(adapt_sql(
-                "INSERT INTO settings (id, bank_name, logo_url, gradient_from, gradient_to, font_name) VALUES (1, ?, ?, ?, ?, ?)"
-            ), ("Banca NFC", "", "#0ea5e9", "#8b5cf6", "Poppins"))
-        conn.commit(); conn.close()
-
-    init_db()
-
-    # ---------- HELPERS CARD ----------
-    def hash_pin(pin: str) -> str:
-        return hashlib.sha256(pin.encode()).hexdigest()
-
-    def create_site(name: str, pin: str, initial: float = 0.0, description: str = ""):
-        token = secrets.token_urlsafe(16)
-        try:
-            exec_sql("INSERT INTO cards (name, token, pin_hash, balance, description) VALUES (?, ?, ?, ?, ?)",
-                     (name, token, hash_pin(pin), float(initial), description.strip()))
-            return token
-        except Exception:
-            return None
-
-    def get_by_token(token: str):
-        r = exec_sql(
-            "SELECT id,name,token,pin_hash,balance,bound_device_id,token_used,description FROM cards WHERE token=?",
-            (token,), fetch="one")
-        if not r: return None
-        return {
-            "id": r[0], "name": r[1], "token": r[2], "pin_hash": r[3], "balance": r[4],
-            "bound_device_id": r[5], "token_used": r[6], "description": r[7]
-        }
-
-    def get_by_name(name: str):
-        r = exec_sql(
-            "SELECT id,name,token,pin_hash,balance,bound_device_id,token_used,description FROM cards WHERE name=?",
-            (name,), fetch="one")
-        if not r: return None
-        return {
-            "id": r[0], "name": r[1], "token": r[2], "pin_hash": r[3], "balance": r[4],
-            "bound_device_id": r[5], "token_used": r[6], "description": r[7]
-        }
-
-    def mark_token_used(token: str):
-        exec_sql("UPDATE cards SET token_used=1 WHERE token=?", (token,))
-
-    def bind_device_id(token: str, device_id: str):
-        exec_sql("UPDATE cards SET bound_device_id=? WHERE token=?", (device_id, token))
-
-    def unbind_device_id(token: str):
-        exec_sql("UPDATE cards SET bound_device_id=NULL, token_used=0 WHERE token=?", (token,))
-
-    def update_balance_by_token(token: str, newbal: float):
-        exec_sql("UPDATE cards SET balance=? WHERE token=?", (float(newbal), token))
-
-    def adjust_balance(token: str, delta: float):
-        exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (float(delta), token))
-
-    def log_transaction(from_token, from_name, to_token, to_name, amount, reason):
-        exec_sql("INSERT INTO transactions (ts,from_token,from_name,to_token,to_name,amount,reason) VALUES (?,?,?,?,?,?,?)",
-                 (int(time.time()), from_token, from_name, to_token, to_name, float(amount), reason))
-
-    def get_recent_transactions(token: str, limit: int = 10):
-        placeholder = "%s" if USE_PG else "?"
-        conn = get_conn(); c = conn.cursor()
-        c.execute(f"""
-            SELECT ts, from_name, to_name, amount, reason
-            FROM transactions
-            WHERE from_token = {placeholder} OR to_token = {placeholder}
-            ORDER BY ts DESC
-            LIMIT {int(limit)}
-        """, (token, token))
-        rows = c.fetchall(); conn.close()
-        return [{"ts": r[0], "from_name": r[1], "to_name": r[2], "amount": r[3], "reason": r[4]} for r in rows]
-
-    def fmt_ts(ts: int) -> str:
-        try: return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(ts)))
-        except: return str(ts)
-
-    def get_settings():
-        r = exec_sql("SELECT bank_name,logo_url,gradient_from,gradient_to,font_name FROM settings WHERE id=1", fetch="one")
-        if not r:
-            return {"bank_name":"Banca NFC","logo_url":"","gradient_from":"#0ea5e9","gradient_to":"#8b5cf6","font_name":"Poppins"}
-        return {"bank_name": r[0] or "Banca NFC", "logo_url": r[1] or "", "gradient_from": r[2] or "#0ea5e9",
-                "gradient_to": r[3] or "#8b5cf6", "font_name": r[4] or "Poppins"}
-
-    def update_settings(bank_name, logo_url, gradient_from, gradient_to, font_name):
-        exec_sql("UPDATE settings SET bank_name=?,logo_url=?,gradient_from=?,gradient_to=?,font_name=? WHERE id=1",
-                 (bank_name.strip(), logo_url.strip(), gradient_from.strip(), gradient_to.strip(), font_name.strip()))
-
-    # ---------- SESSIONS ----------
-    def create_session_for_token(token: str):
-        sid = secrets.token_urlsafe(24)
-        now = int(time.time())
-        exec_sql(
-            "INSERT INTO sessions (sid, token, expires, created_at) VALUES (?, ?, ?, ?)",
-            (sid, token, now + SESSION_TTL, now)
-        )
-        return sid
-
-    def get_session_info(sid: str):
-        r = exec_sql("SELECT token,expires,created_at FROM sessions WHERE sid=?", (sid,), fetch="one")
-        if not r: return None
-        token, expires, created_at = r
-        now = int(time.time())
-        if now > (expires or 0):
-            exec_sql("DELETE FROM sessions WHERE sid=?", (sid,))
-            return None
-        return {"token": token, "expires": int(expires or 0), "created_at": int(created_at or 0)}
-
-    def delete_session(sid: str):
-        exec_sql("DELETE FROM sessions WHERE sid=?", (sid,))
-
-    # ---------- COOKIE / RENDER ----------
-    def is_https(request: Request) -> bool:
-        xf = request.headers.get("x-forwarded-proto", "")
-        return (request.url.scheme == "https") or ("https" in xf)
-
-    def set_cookie(resp, name, value, max_age=None, httponly=False, request: Request = None):
-        resp.set_cookie(name, value, max_age=max_age, samesite="Lax", httponly=httponly,
-                        secure=is_https(request) if request else False, path="/")
-
-    def render_page(inner_html: str, title: str = "") -> HTMLResponse:
-        s = get_settings()
-        title_text = title or s["bank_name"]
-        font = s["font_name"] or "Poppins"
-        google_font = font.replace(" ", "+")
-        logo_html = f"<img src='{html_lib.escape(s['logo_url'])}' alt='' style='height:28px;margin-right:10px;border-radius:6px'>" if s["logo_url"] else ""
-        header_name = html_lib.escape(s["bank_name"])
-        html = f"""<!doctype html><html lang="it"><head>
-          <meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
-          <title>{html_lib.escape(title_text)}</title>
-          <link href="https://fonts.googleapis.com/css2?family={google_font}:wght@400;600;700&display=swap" rel="stylesheet">
-          <style>
-            :root {{ --grad-from:{html_lib.escape(s["gradient_from"])}; --grad-to:{html_lib.escape(s["gradient_to"])}; }}
-            body {{ margin:0;font-family:'{font}',system-ui,-apple-system,Segoe UI,Roboto,Arial,sans-serif;
-              background:linear-gradient(135deg,var(--grad-from),var(--grad-to));min-height:100vh;color:#0f172a; }}
-            .wrap {{ max-width:980px;margin:0 auto;padding:16px; }}
-            .nav {{ display:flex;justify-content:space-between;align-items:center;background:rgba(255,255,255,0.85);
-              backdrop-filter:blur(6px);border:1px solid rgba(255,255,255,0.6);border-radius:14px;padding:10px 14px;margin:16px 0; }}
-            .brand {{ display:flex;align-items:center;font-weight:700;font-size:18px; }}
-            .content {{ background:rgba(255,255,255,0.92);border:1px solid rgba(255,255,255,0.6);border-radius:16px;padding:18px;margin:16px 0; }}
-            .btn {{ display:inline-block;padding:10px 14px;border:none;border-radius:10px;cursor:pointer;font-weight:600;
-              text-decoration:none;color:#0f172a;background:#e2e8f0; }}
-            .btn.primary {{ background:#0ea5e9;color:#fff; }} .btn.secondary {{ background:#64748b;color:#fff; }}
-            .btn.danger {{ background:#ef4444;color:#fff; }} .btn.success {{ background:#10b981;color:#fff; }}
-            input,select,textarea {{ width:100%;padding:10px;border:1px solid #e2e8f0;border-radius:10px;box-sizing:border-box;margin-top:6px;margin-bottom:8px; }}
-            table {{ width:100%;border-collapse:collapse; }} th,td {{ padding:10px;border-bottom:1px solid #e2e8f0;text-align:left; }}
-            .muted {{ color:#475569;font-size:13px; }} .pill {{ display:inline-block;padding:2px 8px;border-radius:999px;background:#e2e8f0;font-size:12px; }}
-            .mono {{ font-family:ui-monospace,Consolas,monospace; }} .grid {{ display:grid;gap:12px; }}
-            @media(min-width:720px) {{ .grid.cols-2 {{ grid-template-columns:1fr 1fr; }} .grid.cols-3 {{ grid-template-columns:1fr 1fr 1fr; }} }}
-          </style></head><body>
-          <div class="wrap">
-            <div class="nav">
-              <div class="brand">{logo_html}<span>{header_name}</span></div>
-              <div style="display:flex;gap:8px"><a class="btn" href="/">Home</a></div>
-            </div>
-            <div class="content">{inner_html}</div>
-          </div></body></html>"""
-        return HTMLResponse(html)
-
-    def fmt_bonsaura(a: float) -> str:
-        try: return f"{float(a):.2f} Bonsaura"
-        except: return f"{a} Bonsaura"
-
-    # ---------- RECURRING CHARGES ----------
-    def apply_recurring_charges(token: str):
-        now = int(time.time())
-        r = exec_sql("SELECT name FROM cards WHERE token=?", (token,), fetch="one")
-        from_name = r[0] if r else ""
-        conn = get_conn(); c = conn.cursor()
-        c.execute(adapt_sql("SELECT id,item_name,weekly_deduction,next_charge_at FROM purchases WHERE token=? AND active=1"), (token,))
-        rows = c.fetchall()
-        for pid, item_name, weekly, next_ts in rows:
-            ts = int(next_ts or 0)
-            charges = 0
-            while ts and ts <= now:
-                charges += 1
-                ts += WEEK_SECONDS
-            if charges > 0:
-                amount = float(weekly) * charges
-                c.execute(adapt_sql("UPDATE cards SET balance = balance - ? WHERE token=?"), (amount, token))
-                c.execute(adapt_sql("UPDATE purchases SET next_charge_at=? WHERE id=?"), (ts, pid))
-                c.execute(adapt_sql(
-                    "INSERT INTO transactions (ts,from_token,from_name,to_token,to_name,amount,reason) VALUES (?,?,?,?,?,?,?)"),
-                    (now, token, from_name, None, "Negozio", -amount,
-                     f"Addebito {item_name} (-{weekly:.0f}/settimana) x{charges}"))
-        conn.commit(); conn.close()
-
-    # ---------- ROUTES ----------
-    @app.get("/", response_class=HTMLResponse)
-    def home():
-        inner = f"""
-          <h2>Benvenuto</h2>
-          <p class="muted">Accedi al pannello amministrativo o visualizza la lista carte. Inserisci la key.</p>
-          <form class="grid cols-3" method="get" action="/go">
-            <div><input name="key" placeholder="Chiave admin" required></div>
-            <div><button class="btn primary" type="submit" name="dest" value="admin">Admin</button></div>
-            <div><button class="btn secondary" type="submit" name="dest" value="lista">Lista</button></div>
-          </form>
-          <p class="muted">Per usare una carta: tap NFC su /launch/&lt;token&gt; (valido per {SCAN_WINDOW}s).</p>
-        """
-        return render_page(inner, "Home")
-
-    @app.get("/go")
-    def go(dest: str = "", key: str = ""):
-        if dest == "admin": return RedirectResponse(f"/admin?key={key}", 302)
-        if dest == "lista": return RedirectResponse(f"/lista?key={key}", 302)
-        return render_page("<h3>Destinazione non valida</h3>", "Errore")
-
-    @app.get("/create", response_class=HTMLResponse)
-    def create_via_link(request: Request, name: str = "", code: str = "", initial: float = 0.0, desc: str = ""):
-        if not name or not code:
-            return render_page("<h3>Parametri mancanti (?name=&code=)</h3>", "Errore")
-        r = exec_sql("SELECT COUNT(*) FROM cards", fetch="one")
-        if (r[0] if r else 0) >= 10:
-            return render_page("<h3>Limite 10 carte raggiunto</h3>", "Limite")
-        token = create_site(name, code, initial, desc)
-        if not token:
-            return render_page("<h3>Nome già esistente</h3>", "Errore")
-        base = str(request.base_url).rstrip("/")
-        url = f"{base}/launch/{token}"
-        inner = f"""
-          <h3>✅ Carta '{html_lib.escape(name)}' creata</h3>
-          <p>Saldo iniziale: {fmt_bonsaura(initial)}</p>
-          <p>URL NFC:</p><pre class="mono">{html_lib.escape(url)}</pre>
-        """
-        return render_page(inner, "Carta creata")
-
-    @app.get("/launch/{token}")
-    @app.head("/launch/{token}")
-    def launch(token: str, request: Request):
-        site = get_by_token(token)
-        if not site:
-            return render_page("<h3>Tag non valido</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if site["bound_device_id"] and device_id != site["bound_device_id"]:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-        resp = RedirectResponse("/card", 302)
-        if not device_id:
-            device_id = secrets.token_hex(16)
-            set_cookie(resp, DEVICE_COOKIE_NAME, device_id, max_age=60*60*24*365, httponly=True, request=request)
-        sid = create_session_for_token(token)
-        set_cookie(resp, SESSION_COOKIE_NAME, sid, max_age=SESSION_TTL, httponly=True, request=request)
-        return resp
-
-    @app.get("/card", response_class=HTMLResponse)
-    def card_from_session(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid:
-            return render_page(f"<h3>Sessione mancante</h3><p>Tap NFC (entro {SCAN_WINDOW}s).</p>", "Richiesto NFC")
-        session = get_session_info(sid)
-        if not session:
-            return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida (scaduto timeout NFC)</h3>", "Non valida")
-        site = get_by_token(session["token"])
-        if not site:
-            return render_page("<h3>Tag non valido</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if site["bound_device_id"] and site["bound_device_id"] != device_id:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-        inner = f"""
-          <h2>{html_lib.escape(site['name'])}</h2>
-          <p><strong>Saldo:</strong> {fmt_bonsaura(site['balance'])}</p>
-          <p class="muted">{html_lib.escape(site.get('description') or '')}</p>
-          <h4>Accedi</h4>
-          <form method="post" action="/unlock">
-            <input type="hidden" name="token" value="{html_lib.escape(site['token'])}">
-            <input name="pin" type="password" placeholder="PIN" required>
-            <button class="btn primary" type="submit">Accedi</button>
-          </form>
-          <p class="muted">Completa entro {SCAN_WINDOW}s dal tap.</p>
-        """
-        return render_page(inner, site["name"])
-
-    @app.post("/unlock", response_class=HTMLResponse)
-    def unlock(request: Request, token: str = Form(...), pin: str = Form(...)):
-        site = get_by_token(token)
-        if not site: return render_page("<h3>Token non valido</h3>", "Errore")
-        if site["pin_hash"] != hash_pin(pin):
-            return render_page("<h3>PIN errato</h3><p><a href='/card'>Riprova</a></p>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if not device_id:
-            return render_page("<h3>Cookie dispositivo mancante (rifai tap)</h3>", "Errore")
-        if not site["bound_device_id"]:
-            bind_device_id(token, device_id)
-            mark_token_used(token)
-            site = get_by_token(token)
-        if site["bound_device_id"] != device_id:
-            return render_page("<h3>Dispositivo non autorizzato</h3>", "Bloccato")
-        apply_recurring_charges(site["token"])
-        site = get_by_token(token)
-        can_shop = site["balance"] >= 30.0
-        shop_btn = '<a class="btn" href="/shop">Negozio</a>' if can_shop else '<button class="btn" disabled>Negozio (saldo &lt; 30)</button>'
-        inner = f"""
-          <h2>Benvenuto, {html_lib.escape(site['name'])}</h2>
-          <p class="muted">Saldo: {fmt_bonsaura(site['balance'])}</p>
-          <div class="grid cols-3">
-            <div><a class="btn secondary" href="/leaderboard">Classifica</a></div>
-            <div><a class="btn primary" href="/bank">Banca</a></div>
-            <div>{shop_btn}</div>
-          </div>
-          <p class="muted">Oggetto disponibile: “Moccolone pencs” (+35 subito, -3/settimana).</p>
-        """
-        return render_page(inner, "Menu")
-
-    @app.get("/leaderboard", response_class=HTMLResponse)
-    def leaderboard(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        rows = exec_sql("SELECT name,balance,token FROM cards ORDER BY balance DESC, id ASC", fetch="all")
-        palette = ["#ef4444","#f97316","#f59e0b","#eab308","#84cc16","#22c55e","#06b6d4","#3b82f6","#8b5cf6","#db2777"]
-        body = []
-        for idx, r in enumerate(rows or [], start=1):
-            name, balance, token = r
-            me = token == session["token"]
-            color = palette[(idx-1)%len(palette)]
-            mark = " — tu" if me else ""
-            body.append(f"""
-              <tr style="border-left:8px solid {html_lib.escape(color)};{'font-weight:700;background:rgba(0,0,0,0.03);' if me else ''}">
-                <td>#{idx}</td><td>{html_lib.escape(name)}{mark}</td><td>{fmt_bonsaura(balance)}</td>
-              </tr>
-            """)
-        inner = f"""
-          <h2>Classifica Bonsaura</h2>
-          <table><thead><tr><th>Pos</th><th>Banca</th><th>Punti</th></tr></thead>
-          <tbody>{''.join(body) or '<tr><td colspan=3 class=muted>Nessuna carta</td></tr>'}</tbody></table>
-          <div class="grid cols-2" style="margin-top:12px">
-            <div><a class="btn secondary" href="/bank">Banca</a></div>
-            <div><a class="btn" href="/">Home</a></div>
-          </div>
-        """
-        return render_page(inner, "Classifica")
-
-    @app.get("/bank", response_class=HTMLResponse)
-    def bank(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        site = get_by_token(session["token"])
-        if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if site["bound_device_id"] and site["bound_device_id"] != device_id:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-
-        dest_rows = exec_sql("SELECT name FROM cards WHERE token <> ? ORDER BY name", (site["token"],), fetch="all") or []
-        options_html = "".join(
-            f"<option value=\"{html_lib.escape(n[0])}\">{html_lib.escape(n[0])}</option>" for n in dest_rows
-        )
-
-        recent = get_recent_transactions(site["token"], limit=10)
-        rows_html = "".join(
-            f"<tr><td>{fmt_ts(t['ts'])}</td><td>{html_lib.escape(t['from_name'] or '-')}</td>"
-            f"<td>{html_lib.escape(t['to_name'] or '-')}</td><td>{fmt_bonsaura(t['amount'])}</td>"
-            f"<td>{html_lib.escape(t['reason'] or '')}</td></tr>"
-            for t in recent
-        ) or '<tr><td colspan="5" class="muted">Nessuna transazione</td></tr>'
-
-        inner = f"""
-          <h2>{html_lib.escape(site['name'])}</h2>
-          <p><strong>Saldo:</strong> {fmt_bonsaura(site['balance'])}</p>
-          <p class="muted">{html_lib.escape(site.get('description') or '')}</p>
-
-          <h4>Invia denaro</h4>
-          <form method="post" action="/transfer">
-            <input type="hidden" name="from_token" value="{html_lib.escape(site['token'])}">
-            <label>Banca destinataria</label>
-            <select name="to_name" required>
-              <option value="" disabled selected>Seleziona banca…</option>
-              {options_html}
-            </select>
-            <input name="amount" type="number" step="0.01" placeholder="Importo" required>
-            <textarea name="reason" rows="2" placeholder="Motivazione (obbligatoria)" required></textarea>
-            <button class="btn primary" type="submit">Invia</button>
-          </form>
-
-          <h4 style="margin-top:16px">Ultime operazioni</h4>
-          <table>
-            <thead><tr><th>Data</th><th>Da</th><th>A</th><th>Importo</th><th>Motivazione</th></tr></thead>
-            <tbody>{rows_html}</tbody>
-          </table>
-        """
-        return render_page(inner, site["name"])
-
-    @app.post("/transfer", response_class=HTMLResponse)
-    def transfer(request: Request,
-                 from_token: str = Form(...),
-                 to_name: str = Form(...),
-                 amount: str = Form(...),
-                 reason: str = Form(...)):
-        from_site = get_by_token(from_token)
-        if not from_site: return render_page("<h3>Mittente non trovato</h3>", "Errore")
-        device_id = request.cookies.get(DEVICE_COOKIE_NAME)
-        if not from_site["bound_device_id"] or from_site["bound_device_id"] != device_id:
-            return render_page("<h3>Accesso non autorizzato</h3>", "Bloccato")
-
-        to_name = (to_name or "").strip()
-        if not to_name:
-            return render_page("<h3>Seleziona una banca destinataria</h3>", "Errore")
-
-        reason = (reason or "").strip()
-        if not reason: return render_page("<h3>Motivazione obbligatoria</h3>", "Errore")
-        if len(reason) > 300: return render_page("<h3>Motivazione troppo lunga</h3>", "Errore")
-
-        try: amt = float(amount)
-        except: return render_page("<h3>Importo non valido</h3>", "Errore")
-        if amt <= 0: return render_page("<h3>Importo deve essere positivo</h3>", "Errore")
-        if from_site["balance"] < amt:
-            return render_page(f"<h3>Saldo insufficiente ({fmt_bonsaura(from_site['balance'])})</h3>", "Errore")
-
-        dest = get_by_name(to_name)
-        if not dest:
-            return render_page(
-                f"<h3>Banca '{html_lib.escape(to_name)}' non trovata</h3>"
-                f"<p>Nessun punto inviato.</p>"
-                f"<p><a href='/bank'>Torna</a></p>", "Errore")
-
-        update_balance_by_token(from_site["token"], from_site["balance"] - amt)
-        update_balance_by_token(dest["token"], dest["balance"] + amt)
-        log_transaction(from_site["token"], from_site["name"], dest["token"], dest["name"], amt, reason)
-        return render_page(
-            f"<h3>Trasferimento di {fmt_bonsaura(amt)} a {html_lib.escape(to_name)} eseguito.</h3>"
-            f"<p>Motivazione: {html_lib.escape(reason)}</p><p><a href='/card'>Torna</a></p>", "OK")
-
-    # ---------- ADMIN ----------
-    def require_key(key: str) -> bool:
-        return key == ADMIN_KEY
-
-    @app.get("/lista", response_class=HTMLResponse)
-    def lista(key: str = ""):
-        if not require_key(key):
-            return render_page("<h3>Accesso negato</h3>", "403")
-        rows = exec_sql("SELECT name,balance,bound_device_id,token_used,description FROM cards ORDER BY id", fetch="all")
-        body = ""
-        for name, balance, bound, used, desc in rows or []:
-            body += f"""
-              <tr>
-                <td>{html_lib.escape(name)}</td>
-                <td>{fmt_bonsaura(balance)}</td>
-                <td><span class="pill">{'associata' if bound else 'libera'}</span></td>
-                <td>{'sì' if used else 'no'}</td>
-                <td>{html_lib.escape(desc or '')}</td>
-              </tr>
-            """
-        inner = f"""
-          <h2>Lista carte</h2>
-          <table>
-            <thead><tr><th>Nome</th><th>Saldo</th><th>Binding</th><th>Usata</th><th>Descrizione</th></tr></thead>
-            <tbody>{body or '<tr><td colspan=5 class=muted>Nessuna carta</td></tr>'}</tbody>
-          </table>
-          <p class="muted">I token non sono mostrati.</p>
-        """
-        return render_page(inner, "Lista carte")
-
-    @app.get("/admin", response_class=HTMLResponse)
-    def admin_panel(request: Request, key: str = ""):
-        if not require_key(key):
-            return render_page("<h3>Accesso negato</h3>", "403")
-        s = get_settings()
-        base = str(request.base_url).rstrip("/")
-        rows = exec_sql("SELECT name,token,balance,bound_device_id,description FROM cards ORDER BY id", fetch="all")
-        cards_html = ""
-        for name, token, balance, bound, desc in rows or []:
-            token_e = html_lib.escape(token)
-            url_nfc = html_lib.escape(f"{base}/launch/{token}")
-            cards_html += f"""
-              <tr>
-                <td>{html_lib.escape(name)}<br>
-                  <span class="muted">token:</span> <code class="mono">{token_e}</code><br>
-                  <div style="display:flex;gap:6px;margin-top:6px">
-                    <button class="btn" type="button" onclick="copyText('{token_e}')">Copia token</button>
-                    <button class="btn secondary" type="button" onclick="copyText('{url_nfc}')">Copia URL NFC</button>
-                  </div>
-                </td>
-                <td>{fmt_bonsaura(balance)}</td>
-                <td><span class="pill">{'associata' if bound else 'libera'}</span></td>
-                <td>{html_lib.escape(desc or '')}</td>
-                <td style="min-width:260px">
-                  <form style="display:inline-block" method="post" action="/admin/adjust">
-                    <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                    <input type="hidden" name="token" value="{token_e}">
-                    <input name="delta" type="number" step="0.01" placeholder="+/-" required style="width:110px">
-                    <button class="btn success" type="submit">Applica</button>
-                  </form>
-                  <form style="display:inline-block" method="post" action="/admin/reset">
-                    <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                    <input type="hidden" name="token" value="{token_e}">
-                    <button class="btn secondary" type="submit">Reset bind</button>
-                  </form>
-                  <form style="display:inline-block" method="post" action="/admin/delete">
-                    <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                    <input type="hidden" name="token" value="{token_e}">
-                    <button class="btn danger" type="submit" onclick="return confirm('Eliminare?')">Elimina</button>
-                  </form>
-                </td>
-              </tr>
-            """
-        inner = f"""
-          <h2>Admin</h2>
-          <div class="grid cols-2">
-            <div>
-              <h3>Crea carta</h3>
-              <form method="post" action="/admin/create">
-                <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                <input name="name" placeholder="Nome" required>
-                <input name="pin" placeholder="PIN" required>
-                <input name="initial" type="number" step="0.01" placeholder="Saldo iniziale" value="0">
-                <input name="desc" placeholder="Descrizione">
-                <button class="btn primary" type="submit">Crea</button>
-              </form>
-            </div>
-            <div>
-              <h3>Personalizzazione</h3>
-                <form method="post" action="/admin/settings">
-                  <input type="hidden" name="key" value="{html_lib.escape(key)}">
-                  <input name="bank_name" placeholder="Nome banca" value="{html_lib.escape(s['bank_name'])}">
-                  <input name="logo_url" placeholder="Logo URL" value="{html_lib.escape(s['logo_url'])}">
-                  <input name="gradient_from" placeholder="Gradiente da" value="{html_lib.escape(s['gradient_from'])}">
-                  <input name="gradient_to" placeholder="Gradiente a" value="{html_lib.escape(s['gradient_to'])}">
-                  <input name="font_name" placeholder="Font Google" value="{html_lib.escape(s['font_name'])}">
-                  <button class="btn primary" type="submit">Salva stile</button>
-                </form>
-            </div>
-          </div>
-          <h3>Carte</h3>
-          <table>
-            <thead><tr><th>Nome/Token</th><th>Saldo</th><th>Binding</th><th>Descrizione</th><th>Azioni</th></tr></thead>
-            <tbody>{cards_html or '<tr><td colspan=5 class=muted>Nessuna carta</td></tr>'}</tbody>
-          </table>
-          <script>
-            function copyText(t) {{
-              if (navigator.clipboard) {{
-                navigator.clipboard.writeText(t).then(()=>alert('Copiato')).catch(()=>window.prompt('Copia:', t));
-              }} else window.prompt('Copia:', t);
-            }}
-          </script>
-        """
-        return render_page(inner, "Admin")
-
-    @app.post("/admin/create", response_class=HTMLResponse)
-    def admin_create(name: str = Form(""), pin: str = Form(""), initial: float = Form(0.0),
-                     desc: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        if not name or not pin: return render_page("<h3>Nome e PIN richiesti</h3>", "Errore")
-        cnt = exec_sql("SELECT COUNT(*) FROM cards", fetch="one")[0]
-        if cnt >= 10: return render_page("<h3>Limite 10 carte raggiunto</h3>", "Limite")
-        token = create_site(name, pin, initial, desc)
-        if not token: return render_page("<h3>Nome già esistente</h3>", "Errore")
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/adjust", response_class=HTMLResponse)
-    def admin_adjust(token: str = Form(""), delta: float = Form(0.0), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        site = get_by_token(token)
-        if not site: return render_page("<h3>Carta non trovata</h3>", "Errore")
-        try: float(delta)
-        except: return render_page("<h3>Delta non valido</h3>", "Errore")
-        adjust_balance(token, float(delta))
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/reset", response_class=HTMLResponse)
-    def admin_reset(token: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        if not get_by_token(token): return render_page("<h3>Token non trovato</h3>", "Errore")
-        unbind_device_id(token)
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/delete", response_class=HTMLResponse)
-    def admin_delete(token: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        if not get_by_token(token): return render_page("<h3>Token non trovato</h3>", "Errore")
-        exec_sql("DELETE FROM cards WHERE token=?", (token,))
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    @app.post("/admin/settings", response_class=HTMLResponse)
-    def admin_settings(bank_name: str = Form(""), logo_url: str = Form(""),
-                       gradient_from: str = Form(""), gradient_to: str = Form(""),
-                       font_name: str = Form(""), key: str = Form("")):
-        if not require_key(key): return render_page("<h3>Accesso negato</h3>", "403")
-        update_settings(bank_name or "Banca NFC", logo_url or "", gradient_from or "#0ea5e9",
-                        gradient_to or "#8b5cf6", font_name or "Poppins")
-        return RedirectResponse(f"/admin?key={key}", 302)
-
-    # ---------- SHOP ----------
-    @app.get("/shop", response_class=HTMLResponse)
-    def shop(request: Request):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        site = get_by_token(session["token"])
-        if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-        if site["balance"] < 30.0:
-            return render_page("<h3>Negozio bloccato</h3><p>Saldo minimo 30.</p>", "Negozio")
-        r = exec_sql("SELECT next_charge_at FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                     (site["token"],), fetch="one")
-        status_html = ""
-        action_html = ""
-        if r:
-            nxt = time.strftime("%Y-%m-%d", time.localtime(int(r[0] or 0)))
-            status_html = f"<p class='muted'>Moccolone attivo. Prossimo addebito: {html_lib.escape(nxt)} (-3/settimana)</p>"
-        else:
-            action_html = """
-              <form method="post" action="/buy">
-                <input type="hidden" name="item_code" value="moccolone">
-                <button class="btn success" type="submit">Compra "Moccolone pencs" (+35, poi -3/settimana)</button>
-              </form>
-            """
-        inner = f"""
-          <h2>Negozio</h2>
-          <div class="content" style="margin:0">
-            <h3>Moccolone pencs</h3>
-            <p>Bonus immediato +35, costo ricorrente -3 Bonsaura / settimana.</p>
-            {status_html}{action_html}
-          </div>
-          <p class="muted">Saldo attuale: {fmt_bonsaura(site['balance'])}</p>
-          <div class="grid cols-3">
-            <a class="btn secondary" href="/leaderboard">Classifica</a>
-            <a class="btn primary" href="/bank">Banca</a>
-            <a class="btn" href="/">Home</a>
-          </div>
-        """
-        return render_page(inner, "Negozio")
-
-    @app.post("/buy", response_class=HTMLResponse)
-    def buy(request: Request, item_code: str = Form(...)):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        site = get_by_token(session["token"])
-        if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-        if site["balance"] < 30.0:
-            return render_page("<h3>Negozio bloccato (saldo < 30)</h3>", "Negozio")
-        if item_code != "moccolone":
-            return render_page("<h3>Articolo non valido</h3>", "Errore")
-        r = exec_sql("SELECT 1 FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                     (site["token"],), fetch="one")
-        if r:
-            return render_page("<h3>Già possiedi Moccolone</h3><p><a href='/shop'>Indietro</a></p>", "Negozio")
-        now = int(time.time())
-        exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (35.0, site["token"]))
-        exec_sql("INSERT INTO purchases (token,item_code,item_name,weekly_deduction,next_charge_at,started_at,active) VALUES (?,?,?,?,?,?,1)",
-                 (site["token"], "moccolone", "Moccolone pencs", 3.0, now + WEEK_SECONDS, now))
-        log_transaction(None, "Negozio", site["token"], site["name"], 35.0,
-                        "Acquisto Moccolone: bonus iniziale +35; addebito -3/settimana")
-        return RedirectResponse("/shop", 302)
-    @app.post("/buy", response_class=HTMLResponse)
-    def buy(request: Request, item_code: str = Form(...)):
-        sid = request.cookies.get(SESSION_COOKIE_NAME)
-        if not sid: return render_page("<h3>Sessione mancante</h3>", "Richiesto")
-        session = get_session_info(sid)
-        if not session: return render_page("<h3>Sessione scaduta</h3>", "Scaduta")
-        if int(time.time()) - session["created_at"] > SCAN_WINDOW:
-            return render_page("<h3>Sessione non valida</h3>", "Errore")
-        apply_recurring_charges(session["token"])
-        site = get_by_token(session["token"])
-        if not site: return render_page("<h3>Tag non valido</h3>", "Errore")
-        if site["balance"] < 30.0:
-            return render_page("<h3>Negozio bloccato (saldo < 30)</h3>", "Negozio")
-        if item_code != "moccolone":
-            return render_page("<h3>Articolo non valido</h3>", "Errore")
-        r = exec_sql("SELECT 1 FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                     (site["token"]), fetch="one")
-        # assicurati che params sia una tupla
-        if isinstance((site["token"]), str):
-            r = exec_sql("SELECT 1 FROM purchases WHERE token=? AND item_code='moccolone' AND active=1",
-                         (site["token"],), fetch="one")
-        if r:
-            return render_page("<h3>Già possiedi Moccolone</h3><p><a href='/shop'>Indietro</a></p>", "Negozio")
-        now = int(time.time())
-        exec_sql("UPDATE cards SET balance = balance + ? WHERE token=?", (35.0, site["token"]))
-        exec_sql("INSERT INTO purchases (token,item_code,item_name,weekly_deduction,next_charge_at,started_at,active) VALUES (?,?,?,?,?,?,1)",
-                 (site["token"], "moccolone", "Moccolone pencs", 3.0, now + WEEK_SECONDS, now))
-        log_transaction(None, "Negozio", site["token"], site["name"], 35.0,
-                        "Acquisto Moccolone: bonus iniziale +35; addebito -3/settimana")
-        return RedirectResponse("/shop", 302)
+    res = buy_item(site["token"], item)
+    if res["status"] == "owned":
+        return render_page(f"<h3>Già possiedi {html_lib.escape(item['name'])}</h3><p><a href='/shop'>Indietro</a></p>", "Negozio")
+    if res["status"] == "insufficient_funds":
+        return render_page("<h3>Saldo insufficiente</h3><p><a href='/shop'>Indietro</a></p>", "Negozio")
+    if res["status"] != "ok":
+        return render_page("<h3>Tag non valido</h3>", "Errore")
     return RedirectResponse("/shop", 302)
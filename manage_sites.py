@@ -1,47 +1,135 @@
 # manage_sites.py
-import sqlite3, secrets, hashlib, sys, os
+import sqlite3, sys, os
 
-DB = "cards.db"
+def migrate():
+    # usa le migrazioni di main.py (stessa configurazione DB_PATH / DATABASE_URL dell'app)
+    import main
+    print("Versione schema attuale:", main.schema_version())
+    applied = main.migrate()
+    if not applied:
+        print("Schema già aggiornato alla versione", main.LATEST_SCHEMA_VERSION)
+    elif not main.USE_PG and 9 in applied:
+        # tabelle ricreate senza token e nomi: VACUUM restituisce le pagine liberate e riduce il file
+        before = os.path.getsize(main.DB_FILE)
+        conn = sqlite3.connect(main.DB_FILE)
+        conn.execute("VACUUM")
+        conn.close()
+        print(f"VACUUM: {before // 1024} KB -> {os.path.getsize(main.DB_FILE) // 1024} KB")
 
-def hash_pin(pin: str) -> str:
-    import hashlib
-    return hashlib.sha256(pin.encode()).hexdigest()
+def bill():
+    # passata di fatturazione degli abbonamenti (per chi la lancia da cron con BILLING_INTERVAL=0)
+    import main
+    main.check_schema()
+    r = main.bill_due_subscriptions()
+    print(f"Abbonamenti addebitati: {r['subscriptions']}, addebiti: {r['charges']}, totale: {main.fmt_cents(r['amount'])}")
 
-def count_sites():
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM cards")
-    n = c.fetchone()[0]
-    conn.close()
-    return n
+def simulate(args):
+    # proiezione dei saldi: python manage_sites.py simulate [SETTIMANE] [codice=prezzo ...]
+    import main
+    weeks = int(args[0]) if args and "=" not in args[0] else 52
+    prices = main.parse_prices(" ".join(a for a in args if "=" in a))
+    r = main.simulate_balances(weeks, prices, limit=20)
+    shown = ", ".join(f"{code}={main.fmt_cents(cents)}" for code, cents in prices.items())
+    print(f"{r['cards']} carte, {r['subscriptions']} abbonamenti attivi, {weeks} settimane, prezzi simulati: {shown or '-'}")
+    print(f"lettura {r['load_seconds']}s, proiezione {r['project_seconds']}s")
+    print(f"negative ora: {r['negative_now']}, a fine periodo: {r['negative_by_week'][-1]}")
+    for key, label in (("cross_zero", "sotto zero"), ("cross_threshold", f"sotto {main.fmt_cents(main.SHOP_THRESHOLD, short=True)}")):
+        print(f"vanno {label}: {r[key]['count']}")
+        for c in r[key]["cards"]:
+            print(f"  {c['name']:<24} saldo {main.fmt_cents(c['balance']):>10}  settimana {c['week']:>3}  "
+                  f"finale {main.fmt_cents(c['final']):>10}")
 
-def create_site(name, pin, initial=100):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    token = secrets.token_urlsafe(12)
+def export(args):
+    # export transazioni: python manage_sites.py export [--format csv|ndjson] [--since AAAA-MM-GG] [--until AAAA-MM-GG]
+    #                                                   [--card NOME] [--out FILE]
+    import argparse
+    import main
+    p = argparse.ArgumentParser(prog="manage_sites.py export")
+    p.add_argument("--format", choices=["csv", "ndjson"], default="csv")
+    p.add_argument("--since", default="")
+    p.add_argument("--until", default="")
+    p.add_argument("--card", default="")
+    p.add_argument("--out", default="-")
+    a = p.parse_args(args)
+    start, end = main.parse_day(a.since), main.parse_day(a.until)
+    if end is not None:
+        end += 24 * 3600
+    token = None
+    if a.card:
+        site = main.get_by_name(a.card)
+        if not site:
+            print("Carta non trovata:", a.card, file=sys.stderr)
+            sys.exit(1)
+        token = site["token"]
+    out = sys.stdout if a.out == "-" else open(a.out, "w", encoding="utf-8", newline="")
     try:
-        c.execute("INSERT INTO cards (name, token, pin_hash, balance) VALUES (?, ?, ?, ?)",
-                  (name, token, hash_pin(pin), float(initial)))
-        conn.commit()
-    except sqlite3.IntegrityError as e:
-        print("Errore: nome già esistente o altro:", e)
-        conn.close()
-        return None
-    conn.close()
-    return token
+        for chunk in main.export_transactions(a.format, start, end, token):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+def archive(args):
+    # archiviazione transazioni vecchie: python manage_sites.py archive [GIORNI]
+    import main
+    days = float(args[0]) if args else main.ARCHIVE_AFTER_DAYS
+    if days <= 0:
+        print("Indicare i giorni (o ARCHIVE_AFTER_DAYS): python manage_sites.py archive GIORNI")
+        sys.exit(1)
+    r = main.archive_transactions(days)
+    if "skipped" in r:
+        print(r["skipped"])
+    else:
+        print(f"Archiviate {r['archived']} transazioni in {r['segments']} segmenti ({main.ARCHIVE_DIR})")
+
+def rebalance(args):
+    # dopo un cambio di SQLITE_SHARDS, ad app ferma: python manage_sites.py rebalance [--dry-run]
+    import main
+    dry_run = "--dry-run" in args
+    try:
+        r = main.rebalance_shards(dry_run=dry_run)
+    except RuntimeError as e:
+        print("Errore:", e)
+        sys.exit(1)
+    if "skipped" in r:
+        print(r["skipped"])
+        return
+    print(f"{r['shards']} shard, {r['files']} file: carte da spostare {r['cards']}, trasferimenti aperti {r['transfers']}")
+    if dry_run:
+        return
+    print(f"Movimenti riscritti: {r['transactions']}")
+    if r["extra_files"]:
+        print("File ora vuoti, si possono eliminare:", ", ".join(r["extra_files"]))
 
 if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] in ("migrate", "bill"):
+        {"migrate": migrate, "bill": bill}[sys.argv[1]]()
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] in ("simulate", "export", "archive", "rebalance"):
+        {"simulate": simulate, "export": export, "archive": archive, "rebalance": rebalance}[sys.argv[1]](sys.argv[2:])
+        sys.exit(0)
     if len(sys.argv) < 3:
         print("Uso: python manage_sites.py NOME PIN [SALDO_INIZIALE]")
+        print("     python manage_sites.py migrate")
+        print("     python manage_sites.py bill")
+        print("     python manage_sites.py simulate [SETTIMANE] [codice=prezzo ...]")
+        print("     python manage_sites.py export [--format csv|ndjson] [--since AAAA-MM-GG] [--until AAAA-MM-GG] [--card NOME] [--out FILE]")
+        print("     python manage_sites.py archive [GIORNI]")
+        print("     python manage_sites.py rebalance [--dry-run]")
         sys.exit(1)
     name = sys.argv[1]
     pin = sys.argv[2]
-    initial = float(sys.argv[3]) if len(sys.argv) > 3 else 100.0
-    if count_sites() >= 5:
+    import main
+    # main.create_site sceglie lo shard della carta (SQLITE_SHARDS) e invalida le cache
+    initial = main.to_cents(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    if main.count_cards() >= 5:
         print("Hai già raggiunto il limite di 5 siti.")
         sys.exit(1)
-    token = create_site(name, pin, initial)
-    if token:
+    token = main.create_site(name, pin, initial)
+    if not token:
+        print("Errore: nome già esistente o altro")
+        sys.exit(1)
+    else:
         print("Creato sito:", name)
         print("Token (URL da scrivere sul tag):")
         print(f"/card/{token}")